@@ -11,7 +11,7 @@ from train import remove_zero_bbox
 
 def check(dataset, model, i, target_height, max_width):
     img_id = dataset.ids[i]
-    bboxes, masks, labels, _, _ = dataset._get_annotations(i)
+    bboxes, labels, _, _ = dataset._get_bbox_annotations(i)
 
     orig_H = dataset.img_props[img_id]['height']
     orig_W = dataset.img_props[img_id]['width']
@@ -15,13 +15,14 @@ filepath = osp.abspath(osp.dirname(__file__))
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--gpu', default=0)
+    parser.add_argument('--gpu', default=0, type=int)
     parser.add_argument('-m', '--modelpath', default=None)
     args = parser.parse_args()
 
     # chainer config for demo
     gpu = args.gpu
-    chainer.cuda.get_device_from_id(gpu).use()
+    if gpu >= 0:
+        chainer.cuda.get_device_from_id(gpu).use()
     chainer.global_config.train = False
     chainer.global_config.enable_backprop = False
 
@@ -47,7 +48,8 @@ def main():
     if modelpath is None:
         modelpath = model.download()
     chainer.serializers.load_npz(modelpath, model)
-    model.to_gpu(gpu)
+    if gpu >= 0:
+        model.to_gpu(gpu)
 
     # load input images
     imgdir = osp.join(filepath, 'images')
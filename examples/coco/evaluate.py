@@ -3,6 +3,7 @@
 import argparse
 import chainer
 from easydict import EasyDict
+import multiprocessing
 import os.path as osp
 import time
 import yaml
@@ -19,13 +20,27 @@ filepath = osp.abspath(osp.dirname(__file__))
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data-dir')
-    parser.add_argument('--gpu', default=0)
+    parser.add_argument('--gpu', default=0, type=int)
     parser.add_argument('-m', '--modelpath', default=None)
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--n-workers', default=0, type=int,
+                        help='number of processes for mask voting')
+    parser.add_argument('--second-iteration', default='all',
+                        choices=['all', 'topk', 'none'],
+                        help='rois used for the 2nd PSROI iteration')
+    parser.add_argument('--second-iteration-top-k', default=100, type=int)
     args = parser.parse_args()
 
+    # workers are forked before cuda is initialized
+    if args.n_workers > 0:
+        pool = multiprocessing.Pool(args.n_workers)
+    else:
+        pool = None
+
     # chainer config for demo
     gpu = args.gpu
-    chainer.cuda.get_device_from_id(gpu).use()
+    if gpu >= 0:
+        chainer.cuda.get_device_from_id(gpu).use()
     chainer.global_config.train = False
     chainer.global_config.enable_backprop = False
 
@@ -41,6 +56,12 @@ def main():
     mask_merge_thresh = config.mask_merge_thresh
     binary_thresh = config.binary_thresh
 
+    second_iteration = args.second_iteration != 'none'
+    if args.second_iteration == 'topk':
+        second_iteration_top_k = args.second_iteration_top_k
+    else:
+        second_iteration_top_k = None
+
     # load label_names
     n_class = len(coco_label_names)
 
@@ -50,7 +71,8 @@ def main():
     if modelpath is None:
         modelpath = model.download()
     chainer.serializers.load_npz(modelpath, model)
-    model.to_gpu(gpu)
+    if gpu >= 0:
+        model.to_gpu(gpu)
 
     dataset = fcis.datasets.coco.COCOInstanceSegmentationDataset(
         data_dir=args.data_dir, split='minival',
@@ -69,28 +91,45 @@ def main():
 
     print('start')
     start = time.time()
-    for i in range(len(dataset)):
-        img, gt_bbox, gt_mask, gt_label, gt_crowded, gt_area = dataset[i]
-        _, H, W = img.shape
-        sizes.append((H, W))
-        gt_bboxes.append(gt_bbox)
-        gt_masks.append(gt_mask)
-        gt_labels.append(gt_label)
-        gt_crowdeds.append(gt_crowded)
-        gt_areas.append(gt_area)
+    # predict chunks of images so that voting in the pool
+    # overlaps with the forward pass of the following batches
+    chunk_size = 100
+    for chunk_start in range(0, len(dataset), chunk_size):
+        imgs = []
+        for i in range(
+                chunk_start, min(chunk_start + chunk_size, len(dataset))):
+            img, gt_bbox, gt_mask, gt_label, gt_crowded, gt_area = \
+                dataset[i]
+            _, H, W = img.shape
+            imgs.append(img)
+            sizes.append((H, W))
+            gt_bboxes.append(gt_bbox)
+            gt_masks.append(gt_mask)
+            gt_labels.append(gt_label)
+            gt_crowdeds.append(gt_crowded)
+            gt_areas.append(gt_area)
 
         # prediction
         outputs = model.predict(
-            [img], target_height, max_width, score_thresh,
-            nms_thresh, mask_merge_thresh, binary_thresh)
-        pred_bboxes.append(outputs[0][0])
-        pred_masks.append(outputs[1][0])
-        pred_labels.append(outputs[2][0])
-        pred_scores.append(outputs[3][0])
-
-        if i % 100 == 0:
-            print('{} / {},   avg speed={:.2f}s'.format(
-                i, len(dataset), (time.time() - start) / (i + 1)))
+            imgs, target_height, max_width, score_thresh,
+            nms_thresh, mask_merge_thresh, binary_thresh,
+            batch_size=args.batch_size, pool=pool,
+            second_iteration=second_iteration,
+            second_iteration_top_k=second_iteration_top_k)
+        pred_bboxes.extend(outputs[0])
+        pred_masks.extend(outputs[1])
+        pred_labels.extend(outputs[2])
+        pred_scores.extend(outputs[3])
+
+        n_done = chunk_start + len(imgs)
+        print('{} / {},   avg speed={:.2f}s'.format(
+            n_done, len(dataset), (time.time() - start) / n_done))
+
+    elapsed_time = time.time() - start
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     results = eval_instance_segmentation_coco(
         sizes, pred_bboxes, pred_masks, pred_labels, pred_scores,
@@ -107,6 +146,16 @@ def main():
     for key in keys:
         print('m{}={}'.format(key, results['m' + key]))
 
+    # accuracy/latency trade-off of the 2nd iteration
+    if args.second_iteration == 'topk':
+        mode = 'topk (k={})'.format(second_iteration_top_k)
+    else:
+        mode = args.second_iteration
+    print('second_iteration={}:   mAP/iou@[0.5:0.95]={:.3f},   '
+          'total time={:.2f}s,   avg speed={:.2f}s'.format(
+              mode, results['m' + keys[0]],
+              elapsed_time, elapsed_time / len(dataset)))
+
 
 if __name__ == '__main__':
     main()
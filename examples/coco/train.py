@@ -4,8 +4,8 @@ from __future__ import division
 import argparse
 import chainer
 from chainer.datasets import TransformDataset
+from chainer.datasets import TupleDataset
 import chainercv
-import cupy
 import cv2
 import datetime
 import easydict
@@ -13,6 +13,7 @@ import fcis
 from fcis.datasets.coco.coco_utils import coco_label_names
 from fcis.datasets.coco import COCOInstanceSegmentationDataset
 # from fcis.extensions import InstanceSegmentationCOCOEvaluator
+import multiprocessing
 import numpy as np
 import os
 import os.path as osp
@@ -28,7 +29,7 @@ def remove_zero_bbox(dataset, target_height, max_width):
 
     for i in range(0, len(dataset)):
         img_id = dataset.ids[i]
-        bboxes, _, labels, _, _ = dataset._get_annotations(i)
+        bboxes, labels, _, _ = dataset._get_bbox_annotations(i)
         if len(bboxes) == 0:
             remove_ids.append(img_id)
         if len(labels) == 0:
@@ -51,7 +52,7 @@ def remove_zero_bbox(dataset, target_height, max_width):
         if len(masked_shapes) == 0:
             remove_ids.append(img_id)
 
-    remove_ids = list(set(remove_ids))
+    remove_ids = set(remove_ids)
     dataset.ids = [i for i in dataset.ids if i not in remove_ids]
     return dataset
 
@@ -76,6 +77,12 @@ class Transform(object):
         self.flip = flip
 
     def __call__(self, in_data):
+        in_data = self.prepare(in_data)
+        if self.flip:
+            in_data = self.random_flip(in_data)
+        return in_data
+
+    def prepare(self, in_data):
         orig_img, bboxes, whole_mask, labels = in_data
         _, orig_H, orig_W = orig_img.shape
         img = self.model.prepare(
@@ -84,14 +91,27 @@ class Transform(object):
         _, H, W = img.shape
         scale = H / orig_H
 
+        orig_bboxes = bboxes
         bboxes = chainercv.transforms.resize_bbox(
             bboxes, (orig_H, orig_W), (H, W))
 
         indices = get_keep_indices(bboxes)
         bboxes = bboxes[indices, :]
-        whole_mask = whole_mask[indices, :, :]
         labels = labels[indices]
 
+        if isinstance(whole_mask, list):
+            # box-cropped masks or RLEs are resized
+            # without decoding image-sized masks
+            orig_bboxes = orig_bboxes[indices, :]
+            mask = [whole_mask[i] for i in indices]
+            if len(mask) > 0 and isinstance(mask[0], dict):
+                mask = fcis.utils.rle2mask(mask, orig_bboxes)
+            whole_mask = fcis.utils.resize_mask(
+                mask, orig_bboxes, (orig_H, orig_W), bboxes, (H, W))
+            return img, bboxes, whole_mask, labels, scale
+
+        whole_mask = whole_mask[indices, :, :]
+
         whole_mask = whole_mask.transpose((1, 2, 0))
         whole_mask = cv2.resize(
             whole_mask.astype(np.uint8), (W, H),
@@ -99,28 +119,71 @@ class Transform(object):
         if whole_mask.ndim < 3:
             whole_mask = whole_mask.reshape((H, W, 1))
         whole_mask = whole_mask.transpose((2, 0, 1))
+        return img, bboxes, whole_mask, labels, scale
 
-        if self.flip:
-            img, params = chainercv.transforms.random_flip(
-                img, x_random=True, return_param=True)
+    def random_flip(self, in_data, return_param=False):
+        img, bboxes, whole_mask, labels, scale = in_data
+        _, H, W = img.shape
+        img, params = chainercv.transforms.random_flip(
+            img, x_random=True, return_param=True)
+        flipped_bboxes = chainercv.transforms.flip_bbox(
+            bboxes, (H, W), x_flip=params['x_flip'])
+        if isinstance(whole_mask, list):
+            if params['x_flip']:
+                whole_mask = fcis.utils.resize_mask(
+                    whole_mask, bboxes, (H, W), flipped_bboxes, (H, W),
+                    x_flip=True)
+        else:
             whole_mask = fcis.utils.flip_mask(
                 whole_mask, x_flip=params['x_flip'])
-            bboxes = chainercv.transforms.flip_bbox(
-                bboxes, (H, W), x_flip=params['x_flip'])
+        in_data = img, flipped_bboxes, whole_mask, labels, scale
+        if return_param:
+            return in_data, params
+        return in_data
 
-        return img, bboxes, whole_mask, labels, scale
+    def random_flip_with_key(self, in_data):
+        # res2 features are cached with the data id and the flip
+        in_data, data_id = in_data
+        in_data, params = self.random_flip(in_data, return_param=True)
+        return in_data + ((data_id, params['x_flip']),)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--gpu', default=0)
+    parser.add_argument('--gpu', default=0, type=int)
     parser.add_argument('--out', '-o', default=None)
     parser.add_argument('--config', default=None)
+    parser.add_argument('--use-annotation-index', action='store_true')
+    parser.add_argument('--mask-format', default='whole',
+                        choices=['whole', 'bbox', 'rle'])
+    parser.add_argument('--cache-size', default=0, type=int,
+                        help='memory budget of example cache in MB, '
+                        'split among loader processes')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory to cache resized examples')
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--aspect-grouping', action='store_true',
+                        help='batch images with the same orientation')
+    parser.add_argument('--loaderjob', default=0, type=int,
+                        help='number of processes to load examples')
+    parser.add_argument('--prefetch', default=None, type=int,
+                        help='number of batches loaded ahead')
+    parser.add_argument('--feature-cache-size', default=0, type=int,
+                        help='memory budget of res2 feature cache in MB')
+    parser.add_argument('--feature-cache-dir', default=None,
+                        help='directory to cache res2 features')
+    parser.add_argument('--n-accumulation', default=1, type=int,
+                        help='number of batches to accumulate gradients')
+    parser.add_argument('--overlap', action='store_true',
+                        help='load the next batch during computation')
+    parser.add_argument('--n-processes', default=1, type=int,
+                        help='number of data-parallel processes')
+    parser.add_argument('--communicator', default='shared_memory',
+                        choices=['shared_memory', 'tcp'])
     args = parser.parse_args()
-
-    # gpu
-    gpu = args.gpu
-    chainer.cuda.get_device_from_id(gpu).use()
+    if args.batch_size > 1 and (args.feature_cache_size > 0 or
+                                args.feature_cache_dir is not None):
+        parser.error('res2 features are cached only with --batch-size 1')
 
     # out
     out = args.out
@@ -138,6 +201,36 @@ def main():
 
     shutil.copy(cfgpath, osp.join(out, 'train.yaml'))
 
+    if args.n_processes > 1:
+        # pretrained ResNet101 is downloaded and converted once,
+        # and each process loads it in FCISResNet101.init_weight
+        chainer.links.ResNet101Layers(pretrained_model='auto')
+
+        # each process trains a replica with a shard of the dataset
+        comm = fcis.communicators.create_communicator(
+            args.communicator, args.n_processes)
+        processes = [
+            multiprocessing.Process(
+                target=train, args=(args, out, config, comm, rank))
+            for rank in range(args.n_processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        train(args, out, config)
+
+
+def train(args, out, config, comm=None, rank=0):
+    if comm is not None:
+        comm.setup(rank)
+
+    # gpu
+    gpu = args.gpu
+    if gpu >= 0:
+        gpu += rank
+        chainer.cuda.get_device_from_id(gpu).use()
+
     target_height = config.target_height
     max_width = config.max_width
     random_seed = config.random_seed
@@ -150,20 +243,42 @@ def main():
     lr_cooldown_factor = config.lr_cooldown_factor
 
     # set random seed
-    np.random.seed(random_seed)
-    cupy.random.seed(random_seed)
+    np.random.seed(random_seed + rank)
+    if gpu >= 0:
+        chainer.cuda.cupy.random.seed(random_seed + rank)
 
     # dataset
-    train_dataset = COCOInstanceSegmentationDataset(split='train')
+    train_dataset = COCOInstanceSegmentationDataset(
+        split='train', use_annotation_index=args.use_annotation_index,
+        mask_format=args.mask_format)
     train_dataset = remove_zero_bbox(train_dataset, target_height, max_width)
-    test_dataset = COCOInstanceSegmentationDataset(split='val')
+    test_dataset = COCOInstanceSegmentationDataset(
+        split='val', use_annotation_index=args.use_annotation_index,
+        mask_format=args.mask_format)
+
+    if args.aspect_grouping:
+        # sizes are read before the dataset is wrapped
+        train_img_sizes = train_dataset.get_img_sizes()
+
+    # res2 features are cached, as res1 and res2 are not updated
+    feature_cache = None
+    if args.feature_cache_dir is not None:
+        feature_cache = fcis.dataset.MemmapCache(osp.join(
+            args.feature_cache_dir, 'coco_train_res2_{}_{}'.format(
+                target_height, max_width)),
+            dtype=np.float16)
+    if args.feature_cache_size > 0:
+        feature_cache = fcis.dataset.LRUCache(
+            args.feature_cache_size * 1024 ** 2, next_cache=feature_cache)
 
     # model
     n_class = len(coco_label_names)
     fcis_model = fcis.models.FCISResNet101(n_class)
     fcis_model.init_weight()
-    model = fcis.models.FCISTrainChain(fcis_model)
-    model.to_gpu()
+    model = fcis.models.FCISTrainChain(
+        fcis_model, feature_cache=feature_cache)
+    if gpu >= 0:
+        model.to_gpu()
 
     # optimizer
     optimizer = chainer.optimizers.MomentumSGD(lr=lr, momentum=0.9)
@@ -183,27 +298,86 @@ def main():
     model.fcis.psroi_conv1.W.update_rule = update_rule
     model.fcis.psroi_conv1.b.update_rule = update_rule
 
-    train_dataset = TransformDataset(
-        train_dataset,
-        Transform(model.fcis, target_height, max_width))
+    if comm is not None:
+        # replicas start from the same parameters
+        comm.bcast_data(model)
+
+    transform = Transform(model.fcis, target_height, max_width)
+    train_ids = train_dataset.ids
+    cache = None
+    if args.cache_dir is not None:
+        cache = fcis.dataset.DiskCache(osp.join(
+            args.cache_dir, 'coco_train_{}_{}_{}'.format(
+                target_height, max_width, args.mask_format)))
+    if args.cache_size > 0:
+        # each loader process has its own copy of the cache
+        cache = fcis.dataset.LRUCache(
+            args.cache_size * 1024 ** 2 // max(args.loaderjob, 1),
+            next_cache=cache)
+    if cache is not None:
+        # resized examples are cached and only flipped in each epoch
+        train_dataset = fcis.dataset.CachedDataset(
+            train_dataset, cache, transform=transform.prepare,
+            keys=train_ids)
+    else:
+        train_dataset = TransformDataset(train_dataset, transform.prepare)
+    if feature_cache is not None:
+        train_dataset = TupleDataset(train_dataset, train_ids)
+        train_dataset = TransformDataset(
+            train_dataset, transform.random_flip_with_key)
+    else:
+        train_dataset = TransformDataset(
+            train_dataset, transform.random_flip)
     test_dataset = TransformDataset(
         test_dataset,
         Transform(model.fcis, target_height, max_width, flip=False))
 
+    if comm is not None:
+        train_dataset, indices = fcis.dataset.scatter_dataset(
+            train_dataset, comm, seed=random_seed, return_indices=True)
+        if args.aspect_grouping:
+            train_img_sizes = train_img_sizes[indices]
+
     # iterator
-    train_iter = chainer.iterators.SerialIterator(
-        train_dataset, batch_size=1)
+    if args.loaderjob > 0:
+        # examples are seeded with seed + epoch * len + index,
+        # so that seeds of processes do not overlap
+        loader_seed = random_seed + \
+            rank * (max_epoch + 1) * len(train_dataset)
+        train_iter = fcis.dataset.MultiprocessIterator(
+            train_dataset, batch_size=args.batch_size,
+            n_processes=args.loaderjob, n_prefetch=args.prefetch,
+            seed=loader_seed,
+            img_sizes=train_img_sizes if args.aspect_grouping else None)
+    elif args.aspect_grouping:
+        train_iter = fcis.dataset.AspectGroupedIterator(
+            train_dataset, batch_size=args.batch_size,
+            img_sizes=train_img_sizes)
+    else:
+        train_iter = chainer.iterators.SerialIterator(
+            train_dataset, batch_size=args.batch_size)
     test_iter = chainer.iterators.SerialIterator(
         test_dataset, batch_size=1, repeat=False, shuffle=False)
-    updater = chainer.training.updater.StandardUpdater(
+    updater = fcis.updaters.GradientAccumulationUpdater(
         train_iter, optimizer, converter=fcis.dataset.concat_examples,
-        device=gpu)
-
-    trainer = chainer.training.Trainer(
-        updater, (max_epoch, 'epoch'), out=out)
+        device=gpu, n_accumulation=args.n_accumulation,
+        overlap=args.overlap, communicator=comm)
+
+    if comm is None and args.n_accumulation == 1:
+        stop_trigger = max_epoch, 'epoch'
+    else:
+        # processes run the same number of iterations
+        # as they communicate in every update, and training
+        # stops at an update not to drop accumulated gradients
+        n_iteration = int(max_epoch * len(train_dataset) / args.batch_size)
+        n_iteration = -(-n_iteration // args.n_accumulation) \
+            * args.n_accumulation
+        stop_trigger = n_iteration, 'iteration'
+    trainer = chainer.training.Trainer(updater, stop_trigger, out=out)
 
     # lr scheduler
-    cooldown_iter = int(cooldown_epoch * len(train_dataset))
+    cooldown_iter = int(
+        cooldown_epoch * len(train_dataset) / args.batch_size)
     trainer.extend(
         chainer.training.extensions.ExponentialShift('lr', lr_warmup_factor),
         trigger=chainer.training.triggers.ManualScheduleTrigger(
@@ -213,6 +387,12 @@ def main():
         trigger=chainer.training.triggers.ManualScheduleTrigger(
             [cooldown_iter], 'iteration'))
 
+    if rank != 0:
+        # only the first process evaluates and writes logs
+        trainer.run()
+        comm.finalize()
+        return
+
     # interval
     save_interval = 1, 'epoch'
     log_interval = 20, 'iteration'
@@ -283,6 +463,8 @@ def main():
     trainer.extend(chainer.training.extensions.dump_graph('main/loss'))
 
     trainer.run()
+    if comm is not None:
+        comm.finalize()
 
 
 if __name__ == '__main__':
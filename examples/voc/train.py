@@ -4,8 +4,8 @@ from __future__ import division
 import argparse
 import chainer
 from chainer.datasets import TransformDataset
+from chainer.datasets import TupleDataset
 import chainercv
-import cupy
 import cv2
 import datetime
 import easydict
@@ -43,6 +43,12 @@ class Transform(object):
         self.flip = flip
 
     def __call__(self, in_data):
+        in_data = self.prepare(in_data)
+        if self.flip:
+            in_data = self.random_flip(in_data)
+        return in_data
+
+    def prepare(self, in_data):
         orig_img, bboxes, whole_mask, labels = in_data
         _, orig_H, orig_W = orig_img.shape
         img = self.model.prepare(
@@ -67,28 +73,65 @@ class Transform(object):
         if whole_mask.ndim < 3:
             whole_mask = whole_mask.reshape((H, W, 1))
         whole_mask = whole_mask.transpose((2, 0, 1))
-
-        if self.flip:
-            img, params = chainercv.transforms.random_flip(
-                img, x_random=True, return_param=True)
-            whole_mask = fcis.utils.flip_mask(
-                whole_mask, x_flip=params['x_flip'])
-            bboxes = chainercv.transforms.flip_bbox(
-                bboxes, (H, W), x_flip=params['x_flip'])
-
         return img, bboxes, whole_mask, labels, scale
 
+    def random_flip(self, in_data, return_param=False):
+        img, bboxes, whole_mask, labels, scale = in_data
+        _, H, W = img.shape
+        img, params = chainercv.transforms.random_flip(
+            img, x_random=True, return_param=True)
+        whole_mask = fcis.utils.flip_mask(
+            whole_mask, x_flip=params['x_flip'])
+        bboxes = chainercv.transforms.flip_bbox(
+            bboxes, (H, W), x_flip=params['x_flip'])
+        in_data = img, bboxes, whole_mask, labels, scale
+        if return_param:
+            return in_data, params
+        return in_data
+
+    def random_flip_with_key(self, in_data):
+        # res2 features are cached with the data id and the flip
+        in_data, data_id = in_data
+        in_data, params = self.random_flip(in_data, return_param=True)
+        return in_data + ((data_id, params['x_flip']),)
+
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--gpu', default=0)
+    parser.add_argument('--gpu', default=0, type=int)
     parser.add_argument('--out', '-o', default=None)
     parser.add_argument('--config', default=None)
+    parser.add_argument('--use-annotation-index', action='store_true',
+                        help='read SBD annotations from a compiled index')
+    parser.add_argument('--cache-size', default=0, type=int,
+                        help='memory budget of example cache in MB, '
+                        'split among loader processes')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory to cache resized examples')
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--aspect-grouping', action='store_true',
+                        help='batch images with the same orientation')
+    parser.add_argument('--loaderjob', default=0, type=int,
+                        help='number of processes to load examples')
+    parser.add_argument('--prefetch', default=None, type=int,
+                        help='number of batches loaded ahead')
+    parser.add_argument('--feature-cache-size', default=0, type=int,
+                        help='memory budget of res2 feature cache in MB')
+    parser.add_argument('--feature-cache-dir', default=None,
+                        help='directory to cache res2 features')
+    parser.add_argument('--n-accumulation', default=1, type=int,
+                        help='number of batches to accumulate gradients')
+    parser.add_argument('--overlap', action='store_true',
+                        help='load the next batch during computation')
     args = parser.parse_args()
+    if args.batch_size > 1 and (args.feature_cache_size > 0 or
+                                args.feature_cache_dir is not None):
+        parser.error('res2 features are cached only with --batch-size 1')
 
     # gpu
     gpu = args.gpu
-    chainer.cuda.get_device_from_id(gpu).use()
+    if gpu >= 0:
+        chainer.cuda.get_device_from_id(gpu).use()
 
     # out
     out = args.out
@@ -117,15 +160,34 @@ def main():
 
     # set random seed
     np.random.seed(random_seed)
-    cupy.random.seed(random_seed)
+    if gpu >= 0:
+        chainer.cuda.cupy.random.seed(random_seed)
 
     # dataset
     if config.use_sbd:
-        dataset_class = SBDInstanceSegmentationDataset
+        train_dataset = SBDInstanceSegmentationDataset(
+            split='train', use_annotation_index=args.use_annotation_index)
+        test_dataset = SBDInstanceSegmentationDataset(
+            split='val', use_annotation_index=args.use_annotation_index)
     else:
-        dataset_class = VOCInstanceSegmentationDataset
-    train_dataset = dataset_class(split='train')
-    test_dataset = dataset_class(split='val')
+        train_dataset = VOCInstanceSegmentationDataset(split='train')
+        test_dataset = VOCInstanceSegmentationDataset(split='val')
+
+    if args.aspect_grouping:
+        # sizes are read before the dataset is wrapped
+        train_img_sizes = train_dataset.get_img_sizes()
+
+    # res2 features are cached, as res1 and res2 are not updated
+    feature_cache = None
+    if args.feature_cache_dir is not None:
+        feature_cache = fcis.dataset.MemmapCache(osp.join(
+            args.feature_cache_dir, '{}_train_res2_{}_{}'.format(
+                'sbd' if config.use_sbd else 'voc',
+                target_height, max_width)),
+            dtype=np.float16)
+    if args.feature_cache_size > 0:
+        feature_cache = fcis.dataset.LRUCache(
+            args.feature_cache_size * 1024 ** 2, next_cache=feature_cache)
 
     # model
     n_class = len(voc_label_names)
@@ -138,8 +200,10 @@ def main():
     model = fcis.models.FCISTrainChain(
         fcis_model,
         n_sample=128,
-        bg_iou_thresh_lo=0.1)
-    model.to_gpu()
+        bg_iou_thresh_lo=0.1,
+        feature_cache=feature_cache)
+    if gpu >= 0:
+        model.to_gpu()
 
     # optimizer
     optimizer = chainer.optimizers.MomentumSGD(lr=lr, momentum=0.9)
@@ -159,24 +223,67 @@ def main():
     model.fcis.psroi_conv1.W.update_rule = update_rule
     model.fcis.psroi_conv1.b.update_rule = update_rule
 
-    train_dataset = TransformDataset(
-        train_dataset,
-        Transform(model.fcis, target_height, max_width))
+    transform = Transform(model.fcis, target_height, max_width)
+    train_ids = train_dataset.ids
+    cache = None
+    if args.cache_dir is not None:
+        cache = fcis.dataset.DiskCache(osp.join(
+            args.cache_dir, '{}_train_{}_{}'.format(
+                'sbd' if config.use_sbd else 'voc',
+                target_height, max_width)))
+    if args.cache_size > 0:
+        # each loader process has its own copy of the cache
+        cache = fcis.dataset.LRUCache(
+            args.cache_size * 1024 ** 2 // max(args.loaderjob, 1),
+            next_cache=cache)
+    if cache is not None:
+        # resized examples are cached and only flipped in each epoch
+        train_dataset = fcis.dataset.CachedDataset(
+            train_dataset, cache, transform=transform.prepare,
+            keys=train_ids)
+    else:
+        train_dataset = TransformDataset(train_dataset, transform.prepare)
+    if feature_cache is not None:
+        train_dataset = TupleDataset(train_dataset, train_ids)
+        train_dataset = TransformDataset(
+            train_dataset, transform.random_flip_with_key)
+    else:
+        train_dataset = TransformDataset(
+            train_dataset, transform.random_flip)
     test_dataset = TransformDataset(
         test_dataset,
         Transform(model.fcis, target_height, max_width, flip=False))
 
     # iterator
-    train_iter = chainer.iterators.SerialIterator(
-        train_dataset, batch_size=1)
+    if args.loaderjob > 0:
+        train_iter = fcis.dataset.MultiprocessIterator(
+            train_dataset, batch_size=args.batch_size,
+            n_processes=args.loaderjob, n_prefetch=args.prefetch,
+            seed=random_seed,
+            img_sizes=train_img_sizes if args.aspect_grouping else None)
+    elif args.aspect_grouping:
+        train_iter = fcis.dataset.AspectGroupedIterator(
+            train_dataset, batch_size=args.batch_size,
+            img_sizes=train_img_sizes)
+    else:
+        train_iter = chainer.iterators.SerialIterator(
+            train_dataset, batch_size=args.batch_size)
     test_iter = chainer.iterators.SerialIterator(
         test_dataset, batch_size=1, repeat=False, shuffle=False)
-    updater = chainer.training.updater.StandardUpdater(
+    updater = fcis.updaters.GradientAccumulationUpdater(
         train_iter, optimizer, converter=fcis.dataset.concat_examples,
-        device=gpu)
+        device=gpu, n_accumulation=args.n_accumulation,
+        overlap=args.overlap)
 
-    trainer = chainer.training.Trainer(
-        updater, (max_epoch, 'epoch'), out=out)
+    if args.n_accumulation == 1:
+        stop_trigger = max_epoch, 'epoch'
+    else:
+        # training stops at an update not to drop accumulated gradients
+        n_iteration = int(max_epoch * len(train_dataset) / args.batch_size)
+        n_iteration = -(-n_iteration // args.n_accumulation) \
+            * args.n_accumulation
+        stop_trigger = n_iteration, 'iteration'
+    trainer = chainer.training.Trainer(updater, stop_trigger, out=out)
 
     # lr scheduler
     trainer.extend(
@@ -1,3 +1,5 @@
+from fcis import anchor_target_creator  # NOQA
+from fcis import communicators  # NOQA
 from fcis import dataset  # NOQA
 from fcis import datasets  # NOQA
 from fcis import extensions  # NOQA
@@ -5,4 +7,5 @@ from fcis import functions  # NOQA
 from fcis import mask  # NOQA
 from fcis import models  # NOQA
 from fcis import proposal_target_creator  # NOQA
+from fcis import updaters  # NOQA
 from fcis import utils  # NOQA
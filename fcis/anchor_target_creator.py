@@ -0,0 +1,128 @@
+# this is originally from https://github.com/chainer/chainercv
+# and worked by Yusuke Niitani (@yuyu2172)
+# modified by Shingo Kitagawa (@knorth55)
+
+from chainer import cuda
+from chainercv.links.model.faster_rcnn.utils.bbox2loc import bbox2loc
+from chainercv.utils.bbox.bbox_iou import bbox_iou
+import numpy as np
+
+
+class AnchorTargetCreator(object):
+    """Assign ground truth bounding boxes to anchors.
+
+    This is the same as :class:`chainercv.links.model.faster_rcnn.
+    AnchorTargetCreator` except that targets are computed with the
+    array module of :obj:`anchor`, so that no array is transferred
+    between host and device.
+
+    """
+
+    def __init__(
+            self, n_sample=256,
+            pos_iou_thresh=0.7, neg_iou_thresh=0.3,
+            pos_ratio=0.5):
+        self.n_sample = n_sample
+        self.pos_iou_thresh = pos_iou_thresh
+        self.neg_iou_thresh = neg_iou_thresh
+        self.pos_ratio = pos_ratio
+
+    def __call__(self, bbox, anchor, img_size):
+        xp = cuda.get_array_module(anchor)
+        bbox = xp.asarray(bbox)
+
+        img_H, img_W = img_size
+
+        n_anchor = len(anchor)
+        inside_index = _get_inside_index(anchor, img_H, img_W)
+        anchor = anchor[inside_index]
+        argmax_ious, label = self._create_label(anchor, bbox)
+
+        # compute bounding box regression targets
+        loc = bbox2loc(anchor, bbox[argmax_ious])
+
+        # map up to original set of anchors
+        label = _unmap(label, n_anchor, inside_index, fill=-1)
+        loc = _unmap(loc, n_anchor, inside_index, fill=0)
+
+        return loc, label
+
+    def _create_label(self, anchor, bbox):
+        xp = cuda.get_array_module(anchor)
+
+        # label: 1 is positive, 0 is negative, -1 is dont care
+        label = xp.full((len(anchor),), -1, dtype=np.int32)
+
+        argmax_ious, max_ious, gt_argmax_ious = self._calc_ious(anchor, bbox)
+
+        # assign negative labels first so that positive labels can clobber
+        label[max_ious < self.neg_iou_thresh] = 0
+
+        # positive label: for each gt, anchor with highest iou
+        label[gt_argmax_ious] = 1
+
+        # positive label: above threshold IOU
+        label[max_ious >= self.pos_iou_thresh] = 1
+
+        # subsample positive labels if we have too many
+        n_pos = int(self.pos_ratio * self.n_sample)
+        pos_index = xp.where(label == 1)[0]
+        if len(pos_index) > n_pos:
+            disable_index = _random_choice(
+                pos_index, len(pos_index) - n_pos)
+            label[disable_index] = -1
+
+        # subsample negative labels if we have too many
+        n_neg = self.n_sample - int((label == 1).sum())
+        neg_index = xp.where(label == 0)[0]
+        if len(neg_index) > n_neg:
+            disable_index = _random_choice(
+                neg_index, len(neg_index) - n_neg)
+            label[disable_index] = -1
+
+        return argmax_ious, label
+
+    def _calc_ious(self, anchor, bbox):
+        xp = cuda.get_array_module(anchor)
+
+        # ious between the anchors and the gt boxes
+        ious = bbox_iou(anchor, bbox)
+        argmax_ious = ious.argmax(axis=1)
+        max_ious = ious[xp.arange(len(anchor)), argmax_ious]
+        gt_argmax_ious = ious.argmax(axis=0)
+        gt_max_ious = ious[gt_argmax_ious, xp.arange(ious.shape[1])]
+        gt_argmax_ious = xp.where(ious == gt_max_ious)[0]
+
+        return argmax_ious, max_ious, gt_argmax_ious
+
+
+def _random_choice(indices, size):
+    # same as np.random.choice(indices, size, replace=False),
+    # and the random state is shared by CPU and GPU.
+    xp = cuda.get_array_module(indices)
+    order = np.random.permutation(len(indices))[:size]
+    return indices[xp.asarray(order)]
+
+
+def _unmap(data, count, index, fill=0):
+    # Unmap a subset of item (data) back to the original set of items (of
+    # size count)
+    xp = cuda.get_array_module(data)
+
+    ret = xp.full((count,) + data.shape[1:], fill, dtype=data.dtype)
+    ret[index] = data
+    return ret
+
+
+def _get_inside_index(anchor, H, W):
+    # Calc indices of anchors which are located completely inside of the
+    # image whose size is specified.
+    xp = cuda.get_array_module(anchor)
+
+    index_inside = xp.where(
+        (anchor[:, 0] >= 0) &
+        (anchor[:, 1] >= 0) &
+        (anchor[:, 2] <= H) &
+        (anchor[:, 3] <= W)
+    )[0]
+    return index_inside
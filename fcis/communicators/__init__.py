@@ -0,0 +1,4 @@
+from fcis.communicators.communicator import CommunicatorBase  # NOQA
+from fcis.communicators.communicator import create_communicator  # NOQA
+from fcis.communicators.communicator import SharedMemoryCommunicator  # NOQA
+from fcis.communicators.communicator import TCPCommunicator  # NOQA
@@ -0,0 +1,288 @@
+import multiprocessing
+import numpy as np
+import socket
+import struct
+import time
+
+from chainer import cuda
+
+
+class CommunicatorBase(object):
+
+    """Base class of communicators between data-parallel processes.
+
+    A communicator is created before processes are started and is
+    passed to them. Each process calls :meth:`setup` with its rank
+    before communication. Arrays communicated are float32 arrays on
+    the host, and processes should call methods in the same order.
+
+    Args:
+        size (int): Number of processes.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.rank = None
+
+    def setup(self, rank):
+        self.rank = rank
+
+    def finalize(self):
+        pass
+
+    def allreduce(self, array):
+        """Average an array over processes in place."""
+        raise NotImplementedError
+
+    def bcast(self, array):
+        """Overwrite an array with that of rank 0."""
+        raise NotImplementedError
+
+    def allreduce_grad(self, model):
+        """Average gradients of parameters to be updated."""
+        params = [param for _, param in sorted(model.namedparams())
+                  if param.update_rule is None or param.update_rule.enabled]
+        buf = np.zeros(sum(param.data.size for param in params),
+                       dtype=np.float32)
+        offset = 0
+        for param in params:
+            size = param.data.size
+            if param.grad is not None:
+                buf[offset:offset + size] = cuda.to_cpu(param.grad).ravel()
+            offset += size
+
+        self.allreduce(buf)
+
+        offset = 0
+        for param in params:
+            size = param.data.size
+            xp = cuda.get_array_module(param.data)
+            param.grad = xp.asarray(
+                buf[offset:offset + size].reshape(param.data.shape))
+            offset += size
+
+    def bcast_data(self, model):
+        """Copy parameters of rank 0 to all processes."""
+        params = [param for _, param in sorted(model.namedparams())]
+        buf = np.concatenate(
+            [cuda.to_cpu(param.data).ravel() for param in params])
+        buf = buf.astype(np.float32, copy=False)
+
+        self.bcast(buf)
+
+        offset = 0
+        for param in params:
+            size = param.data.size
+            xp = cuda.get_array_module(param.data)
+            param.data[...] = xp.asarray(
+                buf[offset:offset + size].reshape(param.data.shape))
+            offset += size
+
+
+class SharedMemoryCommunicator(CommunicatorBase):
+
+    """Communicator through shared memory of processes on one host.
+
+    Arrays are exchanged in chunks of :obj:`chunk_size` elements, so
+    the size of shared memory does not depend on the model.
+
+    Args:
+        size (int): Number of processes.
+        chunk_size (int): Number of elements exchanged at once.
+
+    """
+
+    def __init__(self, size, chunk_size=4 * 1024 ** 2):
+        super(SharedMemoryCommunicator, self).__init__(size)
+        self.chunk_size = chunk_size
+        self._mem = multiprocessing.RawArray('f', size * chunk_size)
+        self._barrier = _Barrier(size)
+
+    def allreduce(self, array):
+        slots = np.frombuffer(self._mem, dtype=np.float32).reshape(
+            (self.size, self.chunk_size))
+        flat = array.reshape(-1)
+        for start in range(0, len(flat), self.chunk_size):
+            chunk = flat[start:start + self.chunk_size]
+            slots[self.rank, :len(chunk)] = chunk
+            self._barrier.wait()
+            chunk[...] = slots[:, :len(chunk)].mean(axis=0)
+            # wait for all processes to read slots
+            self._barrier.wait()
+        return array
+
+    def bcast(self, array):
+        slot = np.frombuffer(
+            self._mem, dtype=np.float32, count=self.chunk_size)
+        flat = array.reshape(-1)
+        for start in range(0, len(flat), self.chunk_size):
+            chunk = flat[start:start + self.chunk_size]
+            if self.rank == 0:
+                slot[:len(chunk)] = chunk
+            self._barrier.wait()
+            if self.rank != 0:
+                chunk[...] = slot[:len(chunk)]
+            self._barrier.wait()
+        return array
+
+
+class TCPCommunicator(CommunicatorBase):
+
+    """Communicator through TCP connections to the process of rank 0.
+
+    The process of rank 0 sums arrays received from the others and
+    sends back their average. It listens on :obj:`port` in
+    :meth:`setup`, and the others retry connecting to it until
+    :obj:`timeout`, so processes can be started in any order and
+    with any start method.
+
+    Args:
+        size (int): Number of processes.
+        host (str): Address of the process of rank 0.
+        port (int): Port of the process of rank 0. By default, a port
+            free when the communicator is created is used.
+        timeout (float): Seconds to wait for connections.
+
+    """
+
+    def __init__(self, size, host='127.0.0.1', port=None, timeout=60.):
+        super(TCPCommunicator, self).__init__(size)
+        if port is None:
+            port = _find_free_port(host)
+        self.address = host, port
+        self.timeout = timeout
+        self._conns = []
+
+    def setup(self, rank):
+        super(TCPCommunicator, self).setup(rank)
+        if rank == 0:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(self.address)
+            server.listen(self.size)
+            server.settimeout(self.timeout)
+            conns = [None] * self.size
+            try:
+                for _ in range(self.size - 1):
+                    conn, _ = server.accept()
+                    conn.settimeout(None)
+                    peer_rank, = struct.unpack('!i', _recv(conn, 4))
+                    conns[peer_rank] = conn
+            finally:
+                server.close()
+            self._conns = conns[1:]
+        else:
+            conn = _connect(self.address, self.timeout)
+            conn.sendall(struct.pack('!i', rank))
+            self._conns = [conn]
+        for conn in self._conns:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def finalize(self):
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+
+    def allreduce(self, array):
+        flat = array.reshape(-1)
+        if self.rank == 0:
+            buf = np.empty_like(flat)
+            for conn in self._conns:
+                _recv_into(conn, buf)
+                flat += buf
+            flat /= self.size
+            for conn in self._conns:
+                conn.sendall(flat.view(np.uint8))
+        else:
+            conn, = self._conns
+            conn.sendall(flat.view(np.uint8))
+            _recv_into(conn, flat)
+        return array
+
+    def bcast(self, array):
+        flat = array.reshape(-1)
+        if self.rank == 0:
+            for conn in self._conns:
+                conn.sendall(flat.view(np.uint8))
+        else:
+            conn, = self._conns
+            _recv_into(conn, flat)
+        return array
+
+
+def create_communicator(name, size, **kwargs):
+    """Create a communicator.
+
+    Args:
+        name (str): :obj:`'shared_memory'` or :obj:`'tcp'`.
+        size (int): Number of processes.
+        **kwargs: Arguments passed to the communicator.
+
+    Returns:
+        :class:`SharedMemoryCommunicator` or :class:`TCPCommunicator`
+
+    """
+    if name == 'shared_memory':
+        return SharedMemoryCommunicator(size, **kwargs)
+    elif name == 'tcp':
+        return TCPCommunicator(size, **kwargs)
+    raise ValueError('Unknown communicator: {}'.format(name))
+
+
+class _Barrier(object):
+
+    # multiprocessing.Barrier is not available in Python 2
+
+    def __init__(self, n):
+        self.n = n
+        self._count = multiprocessing.Value('i', 0, lock=False)
+        self._generation = multiprocessing.Value('i', 0, lock=False)
+        self._cond = multiprocessing.Condition()
+
+    def wait(self):
+        with self._cond:
+            generation = self._generation.value
+            self._count.value += 1
+            if self._count.value == self.n:
+                self._count.value = 0
+                self._generation.value += 1
+                self._cond.notify_all()
+            else:
+                while generation == self._generation.value:
+                    self._cond.wait()
+
+
+def _find_free_port(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def _connect(address, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(address)
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _recv(conn, nbytes):
+    buf = np.empty(nbytes, dtype=np.uint8)
+    _recv_into(conn, buf)
+    return buf.tobytes()
+
+
+def _recv_into(conn, array):
+    view = memoryview(array.reshape(-1).view(np.uint8))
+    while len(view) > 0:
+        n = conn.recv_into(view)
+        if n == 0:
+            raise RuntimeError('Connection is closed')
+        view = view[n:]
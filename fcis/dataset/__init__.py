@@ -1 +1,8 @@
+from fcis.dataset.aspect_grouped_iterator import AspectGroupedIterator  # NOQA
+from fcis.dataset.cache import CachedDataset  # NOQA
+from fcis.dataset.cache import DiskCache  # NOQA
+from fcis.dataset.cache import LRUCache  # NOQA
+from fcis.dataset.cache import MemmapCache  # NOQA
 from fcis.dataset.convert import concat_examples  # NOQA
+from fcis.dataset.multiprocess_iterator import MultiprocessIterator  # NOQA
+from fcis.dataset.scatter_dataset import scatter_dataset  # NOQA
@@ -0,0 +1,115 @@
+from __future__ import division
+
+import numpy as np
+
+from chainer.dataset import iterator
+
+
+class AspectGroupedIterator(iterator.Iterator):
+
+    """Iterator making batches of images with the same orientation.
+
+    Images are split into landscape (:math:`H \\le W`) and portrait
+    (:math:`H > W`) groups, and each batch is drawn from one group,
+    so that little area is wasted by padding images in a batch.
+    Batches of both groups are interleaved in random order.
+
+    Args:
+        dataset: Dataset to iterate.
+        batch_size (int): Number of examples within each batch.
+        img_sizes (array): Array of shape (N, 2) containing (H, W) of
+            the images, e.g. :meth:`get_img_sizes` of datasets.
+        repeat (bool): If :obj:`True`, it infinitely loops over the
+            dataset. Otherwise, it stops iteration at the end of the
+            first epoch.
+        shuffle (bool): If :obj:`True`, the order of examples and batches
+            is shuffled at the beginning of each epoch.
+
+    """
+
+    def __init__(self, dataset, batch_size, img_sizes,
+                 repeat=True, shuffle=True):
+        img_sizes = np.asarray(img_sizes)
+        if len(img_sizes) != len(dataset):
+            raise ValueError(
+                'The length of img_sizes and dataset should be the same')
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self._repeat = repeat
+        self._shuffle = shuffle
+        self._group_ids = (img_sizes[:, 0] > img_sizes[:, 1]).astype(
+            np.int32)
+
+        self.current_position = 0
+        self.epoch = 0
+        self.is_new_epoch = False
+        self._previous_epoch_detail = -1.
+        self._batches = self._make_batches()
+
+    def __next__(self):
+        if not self._repeat and self.epoch > 0:
+            raise StopIteration
+
+        self._previous_epoch_detail = self.epoch_detail
+
+        indices = self._batches[self.current_position]
+        batch = [self.dataset[index] for index in indices]
+
+        self.current_position += 1
+        if self.current_position == len(self._batches):
+            self.current_position = 0
+            self.epoch += 1
+            self.is_new_epoch = True
+            self._batches = self._make_batches()
+        else:
+            self.is_new_epoch = False
+        return batch
+
+    next = __next__
+
+    @property
+    def epoch_detail(self):
+        return self.epoch + self.current_position / len(self._batches)
+
+    @property
+    def previous_epoch_detail(self):
+        if self._previous_epoch_detail < 0:
+            return None
+        return self._previous_epoch_detail
+
+    def serialize(self, serializer):
+        self.current_position = serializer(
+            'current_position', self.current_position)
+        self.epoch = serializer('epoch', self.epoch)
+        self.is_new_epoch = serializer('is_new_epoch', self.is_new_epoch)
+        order = np.concatenate(self._batches)
+        sections = np.cumsum([len(b) for b in self._batches[:-1]])
+        order = serializer('order', order)
+        sections = serializer('sections', sections)
+        self._batches = np.split(order, sections)
+        self._previous_epoch_detail = serializer(
+            'previous_epoch_detail', self._previous_epoch_detail)
+
+    def reset(self):
+        self.current_position = 0
+        self.epoch = 0
+        self.is_new_epoch = False
+        self._previous_epoch_detail = -1.
+        self._batches = self._make_batches()
+
+    @property
+    def repeat(self):
+        return self._repeat
+
+    def _make_batches(self):
+        batches = []
+        for group_id in (0, 1):
+            indices = np.where(self._group_ids == group_id)[0]
+            if self._shuffle:
+                indices = np.random.permutation(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batches.append(indices[start:start + self.batch_size])
+        if self._shuffle:
+            batches = [batches[i]
+                       for i in np.random.permutation(len(batches))]
+        return batches
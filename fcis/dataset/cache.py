@@ -0,0 +1,202 @@
+import collections
+import numpy as np
+import os
+import os.path as osp
+import six
+import tempfile
+
+import chainer
+
+
+class LRUCache(object):
+
+    """In-memory cache with LRU eviction.
+
+    Args:
+        max_bytes (int): Memory budget. The least recently used values
+            are evicted when the total size of values exceeds it.
+            Memory-mapped arrays, e.g. values of :class:`MemmapCache`,
+            are not counted, as their pages are owned by the file.
+        next_cache: Cache looked up on a miss, e.g. :class:`DiskCache`.
+            Values are written to both caches.
+
+    """
+
+    def __init__(self, max_bytes, next_cache=None):
+        self.max_bytes = max_bytes
+        self.next_cache = next_cache
+        self.nbytes = 0
+        self._values = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        if key in self._values:
+            value, nbytes = self._values.pop(key)
+            self._values[key] = value, nbytes
+            return value
+        if self.next_cache is None:
+            return None
+        value = self.next_cache.get(key)
+        if value is not None:
+            self._add(key, value)
+        return value
+
+    def put(self, key, value):
+        if self.next_cache is not None:
+            self.next_cache.put(key, value)
+        self._add(key, value)
+
+    def _add(self, key, value):
+        if key in self._values:
+            _, nbytes = self._values.pop(key)
+            self.nbytes -= nbytes
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        self._values[key] = value, nbytes
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, nbytes) = self._values.popitem(last=False)
+            self.nbytes -= nbytes
+
+
+class DiskCache(object):
+
+    """Cache storing each value as a pickle file under a directory.
+
+    Values are written to a temporary file and renamed, so that
+    processes sharing :obj:`cache_dir` never read partial files.
+
+    Args:
+        cache_dir (str): Directory to store values.
+
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not osp.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not osp.isdir(cache_dir):
+                    raise
+
+    def get(self, key):
+        path = self._path(key)
+        if not osp.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return six.moves.cPickle.load(f)
+
+    def put(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            six.moves.cPickle.dump(
+                value, f, protocol=six.moves.cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self._path(key))
+
+    def _path(self, key):
+        return osp.join(self.cache_dir, '{}.pkl'.format(key))
+
+
+class MemmapCache(object):
+
+    """Cache storing each array as a npy file under a directory.
+
+    Arrays are loaded as memory-mapped arrays, so that only pages
+    read are loaded from disk. They are written in the same way as
+    :class:`DiskCache`.
+
+    Args:
+        cache_dir (str): Directory to store arrays.
+        dtype: Data type of stored arrays, e.g. :obj:`numpy.float16`
+            to halve the size of features. By default, the data type
+            of arrays is kept.
+
+    """
+
+    def __init__(self, cache_dir, dtype=None):
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        if not osp.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not osp.isdir(cache_dir):
+                    raise
+
+    def get(self, key):
+        path = self._path(key)
+        if not osp.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, value):
+        if self.dtype is not None:
+            value = value.astype(self.dtype, copy=False)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, value)
+        os.rename(tmp_path, self._path(key))
+
+    def _path(self, key):
+        return osp.join(self.cache_dir, '{}.npy'.format(key))
+
+
+class CachedDataset(chainer.dataset.DatasetMixin):
+
+    """Dataset wrapper caching examples of a dataset.
+
+    Args:
+        dataset: Dataset to be wrapped.
+        cache: :class:`LRUCache` or :class:`DiskCache`.
+        transform (callable): Deterministic function applied to examples
+            before they are cached, e.g. resizing and mean subtraction.
+        keys (list): Keys of the examples. Data ids should be given
+            if the order of examples may change, e.g. across runs
+            sharing a :class:`DiskCache`. By default, indices are used.
+
+    .. note::
+        With :class:`MultiprocessIterator`, each loader process has
+        its own copy of :obj:`cache`, so an :class:`LRUCache` uses up
+        to its :obj:`max_bytes` in each process.
+
+    """
+
+    def __init__(self, dataset, cache, transform=None, keys=None):
+        if keys is not None and len(keys) != len(dataset):
+            raise ValueError(
+                'The length of keys and dataset should be the same')
+        self._dataset = dataset
+        self._cache = cache
+        self._transform = transform
+        self._keys = keys
+
+    def __len__(self):
+        return len(self._dataset)
+
+    def get_example(self, i):
+        key = i if self._keys is None else self._keys[i]
+        example = self._cache.get(key)
+        if example is None:
+            example = self._dataset[i]
+            if self._transform is not None:
+                example = self._transform(example)
+            self._cache.put(key, example)
+        return example
+
+
+def _nbytes(value):
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, bytes):
+        return len(value)
+    return 0
@@ -1,21 +1,106 @@
+import numpy as np
 import six
 
-from chainer.dataset.convert import _concat_arrays
-from chainer.dataset.convert import to_device
+from chainer import cuda
 
 
-def concat_examples(batch, device=None):
-    # batch: img, bboxes, whole_mask, labels, scale
+def concat_examples(batch, device=None, stride=16):
+    """Concatenate training examples padding them to common shapes.
+
+    Images are zero padded to the smallest size divisible by
+    :obj:`stride` containing all of them. Zero padding is equal to
+    mean padding as images are mean subtracted. A batch of one image
+    is not padded, so that outputs do not change without batching.
+    Boxes, labels and image-sized masks are padded to the largest
+    number of instances, and the labels of padded instances are
+    :obj:`-1`. List representations of masks are returned as lists.
+    If examples have keys of cached features as their last elements,
+    they are returned as a list.
+
+    Only images are sent to :obj:`device`. The copy is asynchronous
+    with respect to the host.
+
+    Args:
+        batch (list): Examples of
+            :obj:`(img, bboxes, whole_mask, labels, scale)` or
+            :obj:`(img, bboxes, whole_mask, labels, scale, key)`.
+        device (int): Device ID to which images are sent.
+        stride (int): Images of batches of more than one image are
+            padded to multiples of it.
+
+    Returns:
+        tuple of :obj:`(img, bboxes, whole_mask, labels, scale,
+        n_bboxes, img_sizes)`, where :obj:`n_bboxes` is the number of
+        instances and :obj:`img_sizes` is the unpadded (H, W) of
+        each image. :obj:`keys` is appended to it if examples have
+        keys.
+
+    """
     if len(batch) == 0:
         raise ValueError('batch is empty')
 
-    first_elem = batch[0]
+    columns = list(six.moves.zip(*batch))
+    imgs, bboxes, whole_masks, labels, scales = columns[:5]
+    N = len(batch)
+    img_sizes = np.array(
+        [img.shape[1:] for img in imgs], dtype=np.int32)
+    H, W = img_sizes.max(axis=0)
+    if N > 1:
+        H, W = -(-np.array((H, W)) // stride) * stride
+    n_bboxes = np.array([len(bbox) for bbox in bboxes], dtype=np.int32)
+    R = n_bboxes.max()
+
+    pinned = device is not None and device >= 0
+    x = _empty((N, 3, H, W), np.float32, pinned)
+    x[...] = 0
+    padded_bboxes = np.zeros((N, R, 4), dtype=np.float32)
+    padded_labels = -np.ones((N, R), dtype=np.int32)
+    for i in six.moves.range(N):
+        img_H, img_W = img_sizes[i]
+        x[i, :, :img_H, :img_W] = imgs[i]
+        padded_bboxes[i, :n_bboxes[i]] = bboxes[i]
+        padded_labels[i, :n_bboxes[i]] = labels[i]
+
+    if isinstance(whole_masks[0], list):
+        padded_masks = list(whole_masks)
+    else:
+        padded_masks = np.zeros((N, R, H, W), dtype=whole_masks[0].dtype)
+        for i, whole_mask in enumerate(whole_masks):
+            _, mask_H, mask_W = whole_mask.shape
+            padded_masks[i, :n_bboxes[i], :mask_H, :mask_W] = whole_mask
+
+    if pinned:
+        x = _to_gpu_async(x, device)
+    out = (x, padded_bboxes, padded_masks, padded_labels,
+           np.array(scales, dtype=np.float32), n_bboxes, img_sizes)
+    if len(columns) > 5:
+        out += (list(columns[5]),)
+    return out
+
+
+# pinned buffers are kept until their copies finish
+_pinned_buffers = []
+_streams = {}
+
+
+def _empty(shape, dtype, pinned):
+    if not pinned:
+        return np.empty(shape, dtype=dtype)
+    size = int(np.prod(shape))
+    mem = cuda.cupy.cuda.alloc_pinned_memory(size * np.dtype(dtype).itemsize)
+    return np.frombuffer(mem, dtype, size).reshape(shape)
+
 
-    result = []
-    for i in six.moves.range(len(first_elem)):
-        array = _concat_arrays([example[i] for example in batch], None)
-        if i == 0:  # img
-            result.append(to_device(device, array))
-        else:
-            result.append(array)
-    return tuple(result)
+def _to_gpu_async(array, device):
+    _pinned_buffers[:] = [
+        (buf, event) for buf, event in _pinned_buffers if not event.done]
+    with cuda.get_device_from_id(device):
+        if device not in _streams:
+            # blocking stream, so that the default stream waits for copies
+            _streams[device] = cuda.cupy.cuda.Stream()
+        stream = _streams[device]
+        gpu_array = cuda.cupy.empty(array.shape, dtype=array.dtype)
+        gpu_array.set(array, stream=stream)
+        event = stream.record()
+    _pinned_buffers.append((array, event))
+    return gpu_array
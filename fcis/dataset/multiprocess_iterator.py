@@ -0,0 +1,264 @@
+from __future__ import division
+
+import collections
+import multiprocessing
+import numpy as np
+import random
+
+import chainer
+from chainer.dataset import iterator
+from chainer.iterators import SerialIterator
+
+from fcis.dataset.aspect_grouped_iterator import AspectGroupedIterator
+
+
+_SharedArray = collections.namedtuple(
+    '_SharedArray', ('offset', 'shape', 'dtype'))
+
+_EpochState = collections.namedtuple(
+    '_EpochState',
+    ('epoch', 'is_new_epoch', 'epoch_detail', 'previous_epoch_detail'))
+
+# set in worker processes
+_worker_dataset = None
+_worker_mem = None
+_worker_mem_size = None
+
+
+class MultiprocessIterator(iterator.Iterator):
+
+    """Iterator loading examples in worker processes.
+
+    Examples, including transforms of :obj:`dataset`, are computed by
+    worker processes. Arrays in examples are written to shared memory
+    and only their shapes are pickled. Examples larger than
+    :obj:`shared_mem` are pickled as a whole.
+
+    The order of examples is the same as :class:`SerialIterator` or,
+    if :obj:`img_sizes` is given, :class:`AspectGroupedIterator`.
+    Snapshots store the position before the batches prefetched, so
+    that they are loaded again when the iterator is resumed.
+
+    Args:
+        dataset: Dataset to iterate.
+        batch_size (int): Number of examples within each batch.
+        repeat (bool): If :obj:`True`, it infinitely loops over the
+            dataset.
+        shuffle (bool): If :obj:`True`, the order of examples is shuffled
+            at the beginning of each epoch.
+        n_processes (int): Number of worker processes. By default,
+            the number of CPUs is used.
+        n_prefetch (int): Number of batches loaded ahead. By default,
+            enough batches to keep all workers busy are loaded.
+        shared_mem (int): Size of shared memory per example in bytes.
+        seed (int): :mod:`numpy.random` and :mod:`random` are seeded
+            with :obj:`seed + epoch * len(dataset) + index` before each
+            example is loaded, so that random transforms do not depend
+            on the worker loading it.
+        img_sizes (array): (H, W) of the images to group batches by
+            orientation. See :class:`AspectGroupedIterator`.
+
+    """
+
+    def __init__(self, dataset, batch_size, repeat=True, shuffle=True,
+                 n_processes=None, n_prefetch=None,
+                 shared_mem=32 * 1024 ** 2, seed=0, img_sizes=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.n_processes = n_processes or multiprocessing.cpu_count()
+        if n_prefetch is None:
+            n_prefetch = max(-(-self.n_processes // batch_size), 1)
+        self.n_prefetch = n_prefetch
+        self.shared_mem = shared_mem
+        self.seed = seed
+
+        indices = np.arange(len(dataset))
+        if img_sizes is None:
+            self._index_iterator = SerialIterator(
+                indices, batch_size, repeat=repeat, shuffle=shuffle)
+        else:
+            self._index_iterator = AspectGroupedIterator(
+                indices, batch_size, img_sizes,
+                repeat=repeat, shuffle=shuffle)
+
+        self.epoch = 0
+        self.is_new_epoch = False
+        self._epoch_detail = 0.
+        self._previous_epoch_detail = None
+
+        self._pool = None
+        self._mem = None
+        self._free_slots = []
+        self._pending = collections.deque()
+
+    def __next__(self):
+        if self._pool is None:
+            self._start()
+        self._prefetch()
+        if len(self._pending) == 0:
+            raise StopIteration
+
+        result, slots, state, _ = self._pending.popleft()
+        batch = [_unpack(example, self._mem, slot * self.shared_mem)
+                 for example, slot in zip(result.get(), slots)]
+        self._free_slots.extend(slots)
+        self._prefetch()
+
+        self.epoch = state.epoch
+        self.is_new_epoch = state.is_new_epoch
+        self._epoch_detail = state.epoch_detail
+        self._previous_epoch_detail = state.previous_epoch_detail
+        return batch
+
+    next = __next__
+
+    @property
+    def epoch_detail(self):
+        return self._epoch_detail
+
+    @property
+    def previous_epoch_detail(self):
+        return self._previous_epoch_detail
+
+    @property
+    def repeat(self):
+        return self._index_iterator.repeat
+
+    def serialize(self, serializer):
+        if not isinstance(serializer, chainer.serializer.Deserializer):
+            if len(self._pending) == 0:
+                self._index_iterator.serialize(serializer)
+            else:
+                # the index iterator is ahead by the prefetched batches
+                index_state = self._pending[0][3]
+                for key, value in index_state.items():
+                    serializer(key, value)
+            return
+
+        self._wait_pending()
+        self._index_iterator.serialize(serializer)
+        self.epoch = self._index_iterator.epoch
+        self.is_new_epoch = self._index_iterator.is_new_epoch
+        self._epoch_detail = self._index_iterator.epoch_detail
+        self._previous_epoch_detail = \
+            self._index_iterator.previous_epoch_detail
+
+    def reset(self):
+        self._wait_pending()
+        self._index_iterator.reset()
+        self.epoch = 0
+        self.is_new_epoch = False
+        self._epoch_detail = 0.
+        self._previous_epoch_detail = None
+
+    def finalize(self):
+        if self._pool is None:
+            return
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+        self._pending.clear()
+
+    def _start(self):
+        n_slots = self.n_prefetch * self.batch_size
+        self._mem = multiprocessing.RawArray('b', n_slots * self.shared_mem)
+        self._free_slots = list(range(n_slots))
+        self._pool = multiprocessing.Pool(
+            self.n_processes, initializer=_init_worker,
+            initargs=(self.dataset, self._mem, self.shared_mem))
+
+    def _prefetch(self):
+        index_iterator = self._index_iterator
+        while len(self._pending) < self.n_prefetch:
+            if not index_iterator.repeat and index_iterator.epoch > 0:
+                return
+            index_serializer = chainer.serializers.DictionarySerializer()
+            index_iterator.serialize(index_serializer)
+            # arrays may be updated in place by the index iterator
+            index_state = dict(
+                (key, np.array(value))
+                for key, value in index_serializer.target.items())
+            epoch = index_iterator.epoch
+            if isinstance(index_iterator, SerialIterator):
+                n_rest = len(self.dataset) - index_iterator.current_position
+            else:
+                # batches do not cross epochs
+                n_rest = len(self.dataset)
+            indices = next(index_iterator)
+            # examples after n_rest are of the next epoch
+            seeds = [
+                self.seed + (epoch + int(k >= n_rest)) * len(self.dataset) +
+                int(index) for k, index in enumerate(indices)]
+            state = _EpochState(
+                index_iterator.epoch, index_iterator.is_new_epoch,
+                index_iterator.epoch_detail,
+                index_iterator.previous_epoch_detail)
+            slots = [self._free_slots.pop() for _ in indices]
+            result = self._pool.map_async(
+                _fetch, list(zip(indices, slots, seeds)))
+            self._pending.append((result, slots, state, index_state))
+
+    def _wait_pending(self):
+        while len(self._pending) > 0:
+            result, slots, _, _ = self._pending.popleft()
+            result.wait()
+            self._free_slots.extend(slots)
+
+
+def _init_worker(dataset, mem, mem_size):
+    global _worker_dataset, _worker_mem, _worker_mem_size
+    _worker_dataset = dataset
+    _worker_mem = mem
+    _worker_mem_size = mem_size
+
+
+def _fetch(args):
+    index, slot, seed = args
+    np.random.seed(seed % 2 ** 32)
+    random.seed(seed)
+    example = _worker_dataset[index]
+    buf = np.frombuffer(
+        _worker_mem, dtype=np.uint8, count=_worker_mem_size,
+        offset=slot * _worker_mem_size)
+    offset = [0]
+
+    def pack(value):
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            value = np.ascontiguousarray(value)
+            start = offset[0]
+            end = start + value.nbytes
+            if end > len(buf):
+                raise _SharedMemoryFull
+            buf[start:end] = value.reshape(-1).view(np.uint8)
+            # align to 16 bytes
+            offset[0] = (end + 15) // 16 * 16
+            return _SharedArray(start, value.shape, value.dtype.str)
+        if isinstance(value, tuple):
+            return tuple(pack(v) for v in value)
+        if isinstance(value, list):
+            return [pack(v) for v in value]
+        return value
+
+    try:
+        return pack(example)
+    except _SharedMemoryFull:
+        return example
+
+
+def _unpack(value, mem, mem_offset):
+    if isinstance(value, _SharedArray):
+        dtype = np.dtype(value.dtype)
+        count = int(np.prod(value.shape))
+        array = np.frombuffer(
+            mem, dtype=dtype, count=count,
+            offset=mem_offset + value.offset)
+        return array.reshape(value.shape).copy()
+    if isinstance(value, tuple):
+        return tuple(_unpack(v, mem, mem_offset) for v in value)
+    if isinstance(value, list):
+        return [_unpack(v, mem, mem_offset) for v in value]
+    return value
+
+
+class _SharedMemoryFull(Exception):
+    pass
@@ -0,0 +1,34 @@
+import numpy as np
+
+import chainer
+
+
+def scatter_dataset(dataset, comm, seed=0, return_indices=False):
+    """Split a dataset into shards of data-parallel processes.
+
+    Examples are shuffled with :obj:`seed` shared by all processes,
+    and each process takes a shard of the same length, so that
+    processes run the same number of iterations in an epoch. At most
+    :obj:`comm.size - 1` examples are dropped.
+
+    Args:
+        dataset: Dataset to be split.
+        comm: Communicator, e.g. :class:`~fcis.communicators.
+            SharedMemoryCommunicator`, whose :obj:`rank` is set.
+        seed (int): Random seed to shuffle examples.
+        return_indices (bool): If :obj:`True`, indices of examples in
+            the shard are also returned.
+
+    Returns:
+        :class:`chainer.datasets.SubDataset` or a tuple of it and
+        the indices.
+
+    """
+    order = np.random.RandomState(seed).permutation(len(dataset))
+    n_example = len(dataset) // comm.size
+    start = comm.rank * n_example
+    shard = chainer.datasets.SubDataset(
+        dataset, start, start + n_example, order=order)
+    if return_indices:
+        return shard, order[start:start + n_example]
+    return shard
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import numpy as np
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+try:
+    from pycocotools import mask as coco_mask
+    _available = True
+except ImportError:
+    _available = False
+
+
+_index_keys = (
+    'cat_ids',
+    'img_ids', 'img_heights', 'img_widths', 'img_file_names',
+    'ann_offsets', 'ann_bboxes', 'ann_labels', 'ann_crowded', 'ann_areas',
+    'rle_offsets', 'rle_counts',
+)
+# bump when the arrays or the conversion of annotations change
+_index_version = 1
+
+
+def load_annotation_index(anno_fn, index_root=None):
+    """Load a compiled index of a COCO annotation file.
+
+    The index is built once and stored next to the annotation file as
+    a directory of :obj:`.npy` files keyed by the hash of the file,
+    its modification time and the format version of the index.
+    Arrays are memory-mapped read-only, so loading takes no time and
+    the pages are shared by every process reading the same index.
+
+    Images are ordered as in :obj:`anno['images']`. The annotations of
+    the :math:`k`-th image are
+    :obj:`ann_offsets[k]:ann_offsets[k + 1]`, and their masks are
+    compressed RLEs stored in
+    :obj:`rle_counts[rle_offsets[j]:rle_offsets[j + 1]]`.
+
+    Args:
+        anno_fn (str): Path to :obj:`instances_*.json`.
+        index_root (str): Directory to store indices. By default,
+            the directory of :obj:`anno_fn` is used.
+
+    Returns:
+        dict of arrays
+
+    """
+    if index_root is None:
+        index_root = osp.dirname(anno_fn)
+    name = osp.splitext(osp.basename(anno_fn))[0]
+    index_dir = osp.join(
+        index_root, '{}_{}.index'.format(name, _file_hash(anno_fn)))
+    if not osp.exists(index_dir):
+        build_annotation_index(anno_fn, index_dir)
+    return dict(
+        (key, np.load(osp.join(index_dir, key + '.npy'), mmap_mode='r'))
+        for key in _index_keys)
+
+
+def build_annotation_index(anno_fn, index_dir):
+    if not _available:
+        raise ValueError(
+            'Please install pycocotools\n'
+            'pip install -e'
+            '\'git+https://github.com/cocodataset/cocoapi.git'
+            '#egg=pycocotools&subdirectory=PythonAPI\'')
+
+    anno = json.load(open(anno_fn, 'r'))
+
+    cat_ids = [0] + [cat['id'] for cat in anno['categories']]
+    cat_labels = dict(
+        (cat_id, label) for label, cat_id in enumerate(cat_ids))
+
+    imgs = anno['images']
+    img_index = dict((img['id'], k) for k, img in enumerate(imgs))
+    img_anns = [list() for _ in imgs]
+    for ann in anno['annotations']:
+        img_anns[img_index[ann['image_id']]].append(ann)
+    anns = [ann for anns_k in img_anns for ann in anns_k]
+
+    rles = []
+    for ann in anns:
+        img = imgs[img_index[ann['image_id']]]
+        rles.append(_segm_to_rle(
+            ann['segmentation'], img['height'], img['width']))
+
+    index = {
+        'cat_ids': np.array(cat_ids, dtype=np.int32),
+        'img_ids': np.array([img['id'] for img in imgs], dtype=np.int64),
+        'img_heights': np.array(
+            [img['height'] for img in imgs], dtype=np.int32),
+        'img_widths': np.array(
+            [img['width'] for img in imgs], dtype=np.int32),
+        'img_file_names': np.array([img['file_name'] for img in imgs]),
+        'ann_offsets': np.cumsum(
+            [0] + [len(anns_k) for anns_k in img_anns]).astype(np.int64),
+        'ann_bboxes': np.array(
+            [ann['bbox'] for ann in anns],
+            dtype=np.float32).reshape((-1, 4)),
+        'ann_labels': np.array(
+            [cat_labels[ann['category_id']] for ann in anns],
+            dtype=np.int32),
+        'ann_crowded': np.array(
+            [ann['iscrowd'] for ann in anns], dtype=bool),
+        'ann_areas': np.array(
+            [ann['area'] for ann in anns], dtype=np.float32),
+        'rle_offsets': np.cumsum(
+            [0] + [len(rle) for rle in rles]).astype(np.int64),
+        'rle_counts': np.frombuffer(b''.join(rles), dtype=np.uint8),
+    }
+
+    # write to a temporary directory first not to leave a broken index
+    parent_dir = osp.dirname(osp.abspath(index_dir))
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir)
+    try:
+        for key in _index_keys:
+            np.save(osp.join(tmp_dir, key + '.npy'), index[key])
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        # another process may have built the same index
+        if not osp.exists(index_dir):
+            raise
+
+
+def _segm_to_rle(segm, H, W):
+    # compressed RLE counts of pycocotools.coco.COCO.annToRLE
+    if isinstance(segm, list):
+        rles = coco_mask.frPyObjects(segm, H, W)
+        rle = coco_mask.merge(rles)
+    elif isinstance(segm['counts'], list):
+        rle = coco_mask.frPyObjects(segm, H, W)
+    else:
+        rle = segm
+    counts = rle['counts']
+    if not isinstance(counts, bytes):
+        counts = counts.encode('ascii')
+    return counts
+
+
+def _file_hash(path, chunk_size=2 ** 20):
+    # md5 of the size, the modification time and the first and last
+    # chunks of the file. Hashing the whole annotation file would take
+    # longer than loading the index itself.
+    md5 = hashlib.md5()
+    stat = os.stat(path)
+    md5.update('version={}\nsize={}\nmtime={!r}\n'.format(
+        _index_version, stat.st_size, stat.st_mtime).encode('ascii'))
+    size = stat.st_size
+    with open(path, 'rb') as f:
+        md5.update(f.read(chunk_size))
+        f.seek(max(size - chunk_size, 0))
+        md5.update(f.read(chunk_size))
+    return md5.hexdigest()
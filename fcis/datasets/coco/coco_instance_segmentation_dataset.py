@@ -8,8 +8,10 @@ import chainer
 
 from chainercv import utils
 
+from fcis.datasets.coco.coco_annotation_index import load_annotation_index
 from fcis.datasets.coco.coco_utils import coco_label_names
 from fcis.datasets.coco.coco_utils import get_coco
+from fcis.utils import rle2mask
 from fcis.utils import visualize_mask
 from fcis.utils import whole_mask2mask
 import matplotlib.pyplot as plt
@@ -23,9 +25,19 @@ except ImportError:
 
 class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
 
+    """Instance segmentation dataset of COCO 2014.
+
+    With :obj:`use_annotation_index`, annotations are read from an index
+    compiled by :func:`load_annotation_index` instead of the json file.
+    The index does not keep the raw annotations, so :obj:`anns` and
+    :obj:`imgToAnns` are not available in this mode.
+
+    """
+
     def __init__(self, data_dir=None, split='train',
                  use_crowded=False, return_crowded=False,
-                 return_area=False):
+                 return_area=False, use_annotation_index=False,
+                 index_root=None, mask_format='whole'):
         if not _available:
             raise ValueError(
                 'Please install pycocotools\n'
@@ -33,6 +45,12 @@ class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
                 '\'git+https://github.com/cocodataset/cocoapi.git'
                 '#egg=pycocotools&subdirectory=PythonAPI\'')
 
+        if mask_format not in ('whole', 'bbox', 'rle'):
+            raise ValueError(
+                'mask_format should be one of \'whole\', \'bbox\' '
+                'and \'rle\'')
+
+        self.mask_format = mask_format
         self.use_crowded = use_crowded
         self.return_crowded = return_crowded
         self.return_area = return_area
@@ -56,6 +74,11 @@ class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
             data_dir, 'annotations', 'instances_{}2014.json'.format(split))
 
         self.data_dir = data_dir
+        if use_annotation_index:
+            self._index = load_annotation_index(anno_fn, index_root)
+            self._init_from_index()
+            return
+        self._index = None
         anno = json.load(open(anno_fn, 'r'))
 
         self.img_props = dict()
@@ -65,6 +88,8 @@ class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
 
         cats = anno['categories']
         self.cat_ids = [0] + [cat['id'] for cat in cats]
+        self._cat_labels = dict(
+            (cat_id, label) for label, cat_id in enumerate(self.cat_ids))
 
         self.anns = dict()
         self.imgToAnns = defaultdict(list)
@@ -72,45 +97,71 @@ class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
             self.imgToAnns[ann['image_id']].append(ann)
             self.anns[ann['id']] = ann
 
+    def _init_from_index(self):
+        index = self._index
+        self.ids = index['img_ids'].tolist()
+        # rows of the index are looked up by ids,
+        # as ids may be filtered or reordered.
+        self._index_ids = dict(
+            (img_id, k) for k, img_id in enumerate(self.ids))
+        self.img_props = dict()
+        for img_id, H, W, file_name in zip(
+                self.ids, index['img_heights'].tolist(),
+                index['img_widths'].tolist(),
+                index['img_file_names'].tolist()):
+            self.img_props[img_id] = {
+                'id': img_id, 'height': H, 'width': W,
+                'file_name': file_name}
+        self.cat_ids = index['cat_ids'].tolist()
+
     @property
     def labels(self):
         labels = list()
         for i in range(len(self)):
-            label = self._get_annotations(i)[2]
+            label = self._get_bbox_annotations(i)[1]
             labels.append(label)
         return labels
 
-    def _get_annotations(self, i):
+    def get_img_sizes(self):
+        # sizes are in the annotation file
+        return np.array(
+            [(self.img_props[img_id]['height'],
+              self.img_props[img_id]['width']) for img_id in self.ids],
+            dtype=np.int32).reshape((-1, 2))
+
+    def _load_bbox_annotations(self, i):
         img_id = self.ids[i]
-        # List[{'segmentation', 'area', 'iscrowd',
-        #       'image_id', 'bbox', 'category_id', 'id'}]
-        annotation = self.imgToAnns[img_id]
         H = self.img_props[img_id]['height']
         W = self.img_props[img_id]['width']
-        bbox = np.array([ann['bbox'] for ann in annotation],
-                        dtype=np.float32)
-        if len(bbox) == 0:
-            bbox = np.zeros((0, 4), dtype=np.float32)
+        if self._index is not None:
+            k = self._index_ids[img_id]
+            start, end = self._index['ann_offsets'][k:k + 2]
+            bbox = np.array(self._index['ann_bboxes'][start:end])
+            label = np.array(self._index['ann_labels'][start:end])
+            crowded = np.array(self._index['ann_crowded'][start:end])
+            area = np.array(self._index['ann_areas'][start:end])
+        else:
+            # List[{'segmentation', 'area', 'iscrowd',
+            #       'image_id', 'bbox', 'category_id', 'id'}]
+            annotation = self.imgToAnns[img_id]
+            bbox = np.array([ann['bbox'] for ann in annotation],
+                            dtype=np.float32)
+            if len(bbox) == 0:
+                bbox = np.zeros((0, 4), dtype=np.float32)
+            label = np.array([self._cat_labels[ann['category_id']]
+                              for ann in annotation], dtype=np.int32)
+
+            crowded = np.array([ann['iscrowd']
+                                for ann in annotation], dtype=np.bool)
+
+            area = np.array([ann['area']
+                             for ann in annotation], dtype=np.float32)
+
         # (x, y, width, height)  -> (x_min, y_min, x_max, y_max)
         bbox[:, 2] = bbox[:, 0] + bbox[:, 2]
         bbox[:, 3] = bbox[:, 1] + bbox[:, 3]
         # (x_min, y_min, x_max, y_max) -> (y_min, x_min, y_max, x_max)
         bbox = bbox[:, [1, 0, 3, 2]]
-        label = np.array([self.cat_ids.index(ann['category_id'])
-                          for ann in annotation], dtype=np.int32)
-
-        if len(bbox) > 0:
-            whole_mask = np.stack(
-                [self._segm_to_mask(anno['segmentation'], (H, W))
-                 for anno in annotation])
-        else:
-            whole_mask = np.zeros((0, H, W), dtype=np.bool)
-
-        crowded = np.array([ann['iscrowd']
-                            for ann in annotation], dtype=np.bool)
-
-        area = np.array([ann['area']
-                         for ann in annotation], dtype=np.float32)
 
         # Sanitize boxes using image shape
         bbox[:, :2] = np.maximum(bbox[:, :2], 0)
@@ -122,15 +173,59 @@ class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
         keep_mask = np.logical_and(bbox[:, 0] <= bbox[:, 2],
                                    bbox[:, 1] <= bbox[:, 3])
         keep_mask = np.logical_and(keep_mask, bbox_area > 0)
+        return bbox, label, crowded, area, keep_mask
+
+    def _get_bbox_annotations(self, i):
+        # same as _get_annotations without decoding masks
+        bbox, label, crowded, area, keep_mask = \
+            self._load_bbox_annotations(i)
         bbox = bbox[keep_mask]
         label = label[keep_mask]
         crowded = crowded[keep_mask]
-        whole_mask = whole_mask[keep_mask]
         area = area[keep_mask]
-        return bbox, whole_mask, label, crowded, area
+        return bbox, label, crowded, area
 
-    def _segm_to_mask(self, segm, size):
-        # Copied from pycocotools.coco.COCO.annToMask
+    def _get_segmentations(self, i):
+        if self._index is None:
+            return [ann['segmentation']
+                    for ann in self.imgToAnns[self.ids[i]]]
+        img_id = self.ids[i]
+        size = [self.img_props[img_id]['height'],
+                self.img_props[img_id]['width']]
+        k = self._index_ids[img_id]
+        start, end = self._index['ann_offsets'][k:k + 2]
+        offsets = self._index['rle_offsets'][start:end + 1]
+        counts = self._index['rle_counts']
+        return [{'size': size, 'counts': counts[s:e].tobytes()}
+                for s, e in zip(offsets[:-1], offsets[1:])]
+
+    def _get_annotations(self, i):
+        img_id = self.ids[i]
+        H = self.img_props[img_id]['height']
+        W = self.img_props[img_id]['width']
+        bbox, label, crowded, area, keep_mask = \
+            self._load_bbox_annotations(i)
+        bbox = bbox[keep_mask]
+        label = label[keep_mask]
+        crowded = crowded[keep_mask]
+        area = area[keep_mask]
+
+        # only masks of valid boxes are decoded
+        segms = _index_list_by_mask(self._get_segmentations(i), keep_mask)
+        if self.mask_format == 'whole':
+            if len(bbox) > 0:
+                mask = np.stack(
+                    [self._segm_to_mask(segm, (H, W)) for segm in segms])
+            else:
+                mask = np.zeros((0, H, W), dtype=np.bool)
+        else:
+            mask = [self._segm_to_rle(segm, (H, W)) for segm in segms]
+            if self.mask_format == 'bbox':
+                mask = rle2mask(mask, bbox)
+        return bbox, mask, label, crowded, area
+
+    def _segm_to_rle(self, segm, size):
+        # Copied from pycocotools.coco.COCO.annToRLE
         H, W = size
         if isinstance(segm, list):
             # polygon -- a single object might consist of multiple parts
@@ -141,6 +236,11 @@ class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
             rle = coco_mask.frPyObjects(segm, H, W)
         else:
             rle = segm
+        return rle
+
+    def _segm_to_mask(self, segm, size):
+        # Copied from pycocotools.coco.COCO.annToMask
+        rle = self._segm_to_rle(segm, size)
         mask = coco_mask.decode(rle)
         return mask.astype(np.bool)
 
@@ -160,7 +260,11 @@ class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
         if not self.use_crowded:
             bbox = bbox[np.logical_not(crowded)]
             label = label[np.logical_not(crowded)]
-            whole_mask = whole_mask[np.logical_not(crowded)]
+            if self.mask_format == 'whole':
+                whole_mask = whole_mask[np.logical_not(crowded)]
+            else:
+                whole_mask = _index_list_by_mask(
+                    whole_mask, np.logical_not(crowded))
             area = area[np.logical_not(crowded)]
             crowded = crowded[np.logical_not(crowded)]
 
@@ -176,7 +280,12 @@ class COCOInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
         img = img.transpose(1, 2, 0)
         img = img[:, :, ::-1]
         scores = np.ones(len(label))
-        mask = whole_mask2mask(whole_mask, bbox)
+        if self.mask_format == 'rle':
+            mask = rle2mask(whole_mask, bbox)
+        elif self.mask_format == 'bbox':
+            mask = whole_mask
+        else:
+            mask = whole_mask2mask(whole_mask, bbox)
         visualize_mask(img, mask, bbox, label, scores, coco_label_names)
         plt.show()
 
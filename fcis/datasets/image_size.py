@@ -0,0 +1,83 @@
+import json
+import numpy as np
+import os
+import os.path as osp
+import struct
+import tempfile
+
+
+def read_image_size(path):
+    """Read the size of an image without decoding it.
+
+    Only the headers of JPEG files are parsed. Other formats are
+    opened with PIL, which also reads their headers only.
+
+    Args:
+        path (str): Path to an image file.
+
+    Returns:
+        tuple of ints: (H, W)
+
+    """
+    with open(path, 'rb') as f:
+        size = _read_jpeg_size(f)
+    if size is None:
+        import PIL.Image
+        W, H = PIL.Image.open(path).size
+        size = H, W
+    return size
+
+
+def _read_jpeg_size(f):
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = ord(byte)
+        if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+            # markers without segments
+            continue
+        length, = struct.unpack('>H', f.read(2))
+        # SOFn except DHT, JPG and DAC
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            _, H, W = struct.unpack('>BHH', f.read(5))
+            return H, W
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def load_image_sizes(keys, paths, cache_fn=None):
+    """Load image sizes reading headers only, with an on-disk cache.
+
+    Args:
+        keys (list of strs): Keys of images in the cache.
+        paths (list of strs): Paths to images.
+        cache_fn (str): Path to a JSON file caching the sizes.
+            Sizes missing in it are read and added to it.
+
+    Returns:
+        array of shape (N, 2): (H, W) of each image.
+
+    """
+    sizes = {}
+    if cache_fn is not None and osp.exists(cache_fn):
+        with open(cache_fn, 'r') as f:
+            sizes = json.load(f)
+    keys = [str(key) for key in keys]
+    updated = False
+    for key, path in zip(keys, paths):
+        if key not in sizes:
+            sizes[key] = read_image_size(path)
+            updated = True
+    if cache_fn is not None and updated:
+        fd, tmp_fn = tempfile.mkstemp(dir=osp.dirname(osp.abspath(cache_fn)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(sizes, f)
+        os.rename(tmp_fn, cache_fn)
+    return np.array([sizes[key] for key in keys], dtype=np.int32).reshape(
+        (-1, 2))
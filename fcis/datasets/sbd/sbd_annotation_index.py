@@ -0,0 +1,105 @@
+import hashlib
+import numpy as np
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+from fcis.datasets.voc.voc_utils import prepare_data
+
+
+_index_keys = (
+    'ids', 'heights', 'widths', 'offsets',
+    'bboxes', 'labels', 'mask_offsets', 'mask_bits',
+)
+# bump when the arrays or the conversion of annotations change
+_index_version = 1
+
+
+def load_annotation_index(dataset, index_root, name='sbd'):
+    """Load a compiled index of SBD annotations.
+
+    The index is built once from the :obj:`.mat` files and stored as
+    a directory of :obj:`.npy` files keyed by the hash of the ids of
+    :obj:`dataset` and the format version of the index. Arrays are
+    memory-mapped read-only, so loading annotations of an example is
+    slicing.
+
+    Instances of the :math:`k`-th data are
+    :obj:`offsets[k]:offsets[k + 1]`. The mask of the :math:`j`-th
+    instance is cropped with :obj:`bboxes[j]` and bit-packed into
+    :obj:`mask_bits[mask_offsets[j]:mask_offsets[j + 1]]`.
+
+    Args:
+        dataset (SBDInstanceSegmentationDataset): Dataset whose
+            :obj:`.mat` files are converted.
+        index_root (str): Directory to store indices.
+        name (str): Prefix of the name of the index directory.
+
+    Returns:
+        dict of arrays
+
+    """
+    index_dir = osp.join(
+        index_root, '{}_{}.index'.format(name, _ids_hash(dataset.ids)))
+    if not osp.exists(index_dir):
+        build_annotation_index(dataset, index_dir)
+    return dict(
+        (key, np.load(osp.join(index_dir, key + '.npy'), mmap_mode='r'))
+        for key in _index_keys)
+
+
+def build_annotation_index(dataset, index_dir):
+    heights = []
+    widths = []
+    offsets = [0]
+    bboxes = []
+    labels = []
+    mask_bits = []
+    for data_id in dataset.ids:
+        _, seg_img, ins_img = dataset._load_data(data_id)
+        bbox, mask, label = prepare_data(seg_img, ins_img)
+        H, W = ins_img.shape
+        heights.append(H)
+        widths.append(W)
+        offsets.append(offsets[-1] + len(label))
+        for bb, m, lbl in zip(bbox, mask, label):
+            bboxes.append(bb)
+            labels.append(lbl)
+            mask_bits.append(np.packbits(m[bb[0]:bb[2], bb[1]:bb[3]]))
+
+    index = {
+        'ids': np.array(dataset.ids),
+        'heights': np.array(heights, dtype=np.int32),
+        'widths': np.array(widths, dtype=np.int32),
+        'offsets': np.array(offsets, dtype=np.int64),
+        'bboxes': np.array(bboxes, dtype=np.int32).reshape((-1, 4)),
+        'labels': np.array(labels, dtype=np.int32),
+        'mask_offsets': np.cumsum(
+            [0] + [len(bits) for bits in mask_bits]).astype(np.int64),
+        'mask_bits': np.concatenate(
+            [np.zeros((0,), dtype=np.uint8)] + mask_bits),
+    }
+
+    # write to a temporary directory first not to leave a broken index
+    parent_dir = osp.dirname(osp.abspath(index_dir))
+    if not osp.exists(parent_dir):
+        os.makedirs(parent_dir)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir)
+    try:
+        for key in _index_keys:
+            np.save(osp.join(tmp_dir, key + '.npy'), index[key])
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        # another process may have built the same index
+        if not osp.exists(index_dir):
+            raise
+
+
+def _ids_hash(ids):
+    md5 = hashlib.md5()
+    md5.update('version={}\n'.format(_index_version).encode('ascii'))
+    for data_id in ids:
+        md5.update('{}\n'.format(data_id).encode('utf-8'))
+    return md5.hexdigest()
@@ -1,4 +1,5 @@
 import cv2
+from fcis.datasets.sbd.sbd_annotation_index import load_annotation_index
 from fcis.datasets.voc import VOCInstanceSegmentationDataset
 import numpy as np
 import os.path as osp
@@ -13,16 +14,61 @@ class SBDInstanceSegmentationDataset(VOCInstanceSegmentationDataset):
     data_dir = osp.expanduser('~/data/datasets/VOC/benchmark_RELEASE/dataset')
     imgsets_dir = osp.join(this_dir, 'data/')
 
+    def __init__(self, data_dir=None, split='train',
+                 use_annotation_index=False, index_root=None):
+        super(SBDInstanceSegmentationDataset, self).__init__(
+            data_dir, split)
+        self._index = None
+        if use_annotation_index:
+            if index_root is None:
+                index_root = self.data_dir
+            self._index = load_annotation_index(
+                self, index_root, 'sbd_{}'.format(split))
+            self._index_ids = dict(
+                (data_id, k)
+                for k, data_id in enumerate(self._index['ids'].tolist()))
+
+    def get_example(self, i):
+        if self._index is None:
+            return super(SBDInstanceSegmentationDataset, self).get_example(i)
+
+        data_id = self.ids[i]
+        k = self._index_ids[data_id]
+        img = self._load_img(data_id)
+        H = self._index['heights'][k]
+        W = self._index['widths'][k]
+        start, end = self._index['offsets'][k:k + 2]
+        bboxes = np.array(self._index['bboxes'][start:end])
+        labels = np.array(self._index['labels'][start:end])
+        mask_offsets = self._index['mask_offsets'][start:end + 1]
+        masks = np.zeros((len(bboxes), H, W), dtype=np.bool)
+        for mask, bbox, bits_start, bits_end in zip(
+                masks, bboxes, mask_offsets[:-1], mask_offsets[1:]):
+            y_min, x_min, y_max, x_max = bbox
+            bits = self._index['mask_bits'][bits_start:bits_end]
+            size = (y_max - y_min) * (x_max - x_min)
+            mask[y_min:y_max, x_min:x_max] = np.unpackbits(
+                bits)[:size].reshape((y_max - y_min, x_max - x_min))
+        img = img.astype(np.float32)
+        bboxes = bboxes.astype(np.float32)
+        return img, bboxes, masks, labels
+
+    def _get_imgpath(self, data_id):
+        return osp.join(self.data_dir, 'img/{}.jpg'.format(data_id))
+
+    def _load_img(self, data_id):
+        imgpath = self._get_imgpath(data_id)
+        img = cv2.imread(
+            imgpath, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        img = img.transpose((2, 0, 1))
+        return img
+
     def _load_data(self, data_id):
-        imgpath = osp.join(
-            self.data_dir, 'img/{}.jpg'.format(data_id))
         seg_imgpath = osp.join(
             self.data_dir, 'cls/{}.mat'.format(data_id))
         ins_imgpath = osp.join(
             self.data_dir, 'inst/{}.mat'.format(data_id))
-        img = cv2.imread(
-            imgpath, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
-        img = img.transpose((2, 0, 1))
+        img = self._load_img(data_id)
         mat = scipy.io.loadmat(seg_imgpath)
         seg_img = mat['GTcls'][0]['Segmentation'][0].astype(np.int32)
         seg_img = np.array(seg_img, dtype=np.int32)
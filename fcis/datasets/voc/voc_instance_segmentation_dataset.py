@@ -1,5 +1,6 @@
 import chainer
 import cv2
+from fcis.datasets.image_size import load_image_sizes
 from fcis.datasets.voc.voc_utils import prepare_data
 from fcis.datasets.voc.voc_utils import voc_label_names
 from fcis.utils import visualize_mask
@@ -40,12 +41,24 @@ class VOCInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
         labels = labels.astype(np.int32)
         return img, bboxes, masks, labels
 
+    def get_img_sizes(self, cache_fn=None):
+        """Return (H, W) of the images reading their headers only.
+
+        The sizes are cached in :obj:`cache_fn`. By default,
+        :obj:`img_sizes.json` in :obj:`data_dir` is used.
+
+        """
+        if cache_fn is None:
+            cache_fn = osp.join(self.data_dir, 'img_sizes.json')
+        return load_image_sizes(
+            self.ids, [self._get_imgpath(data_id) for data_id in self.ids],
+            cache_fn)
+
     def aspect_grouping(self):
+        sizes = self.get_img_sizes()
         horz = []
         vert = []
-        for data_id in self.ids:
-            img = self._load_data(data_id)[0]
-            _, H, W = img.shape
+        for data_id, (H, W) in zip(self.ids, sizes):
             if H > W:
                 horz.append(data_id)
             else:
@@ -54,9 +67,11 @@ class VOCInstanceSegmentationDataset(chainer.dataset.DatasetMixin):
         vert = np.random.permutation(np.asarray(vert))
         self.ids = np.append(horz, vert)
 
+    def _get_imgpath(self, data_id):
+        return osp.join(self.data_dir, 'JPEGImages/{}.jpg'.format(data_id))
+
     def _load_data(self, data_id):
-        imgpath = osp.join(
-            self.data_dir, 'JPEGImages/{}.jpg'.format(data_id))
+        imgpath = self._get_imgpath(data_id)
         seg_imgpath = osp.join(
             self.data_dir, 'SegmentationClass/{}.png'.format(data_id))
         ins_imgpath = osp.join(
@@ -1,4 +1,3 @@
-import collections
 import numpy as np
 import os.path as osp
 
@@ -10,28 +9,67 @@ root = 'pfnet/chainercv/voc'
 url = 'http://host.robots.ox.ac.uk/pascal/VOC/voc2012/VOCtrainval_11-May-2012.tar'  # NOQA
 
 
-def prepare_data(seg_img, ins_img):
-    labels = []
-    bboxes = []
-    masks = []
-    instances = np.unique(ins_img)
-    for inst in instances[instances != -1]:
-        mask_inst = ins_img == inst
-        count = collections.Counter(seg_img[mask_inst].tolist())
-        instance_class = max(count.items(), key=lambda x: x[1])[0]
-
-        assert inst not in [-1]
-        assert instance_class not in [-1, 0]
-
-        where = np.argwhere(mask_inst)
-        (y1, x1), (y2, x2) = where.min(0), where.max(0) + 1
-
-        labels.append(instance_class)
-        bboxes.append((y1, x1, y2, x2))
-        masks.append(mask_inst)
-    labels = np.array(labels)
-    bboxes = np.array(bboxes)
-    masks = np.array(masks)
+def prepare_data(seg_img, ins_img, return_mask=True):
+    """Extract instances from class and instance label images.
+
+    The label of an instance is its most frequent class. Ties are broken
+    by the first occurrence in raster order.
+
+    Args:
+        seg_img (array): Class label image of shape (H, W).
+        ins_img (array): Instance label image of shape (H, W).
+            :obj:`-1` is ignored.
+        return_mask (bool): Return image-sized masks of the instances.
+
+    Returns:
+        bboxes, masks and labels, or bboxes and labels if
+        :obj:`return_mask` is :obj:`False`.
+
+    """
+    H, W = ins_img.shape
+    valid = ins_img.ravel() != -1
+    ins = ins_img.ravel()[valid]
+    ins_counts = np.bincount(ins, minlength=1)
+    instances = np.where(ins_counts)[0]
+    n_inst = len(instances)
+    ins_indices = np.zeros(len(ins_counts), dtype=np.int64)
+    ins_indices[instances] = np.arange(n_inst)
+    ins = ins_indices[ins]
+
+    # count classes of each instance
+    cls = seg_img.ravel()[valid].astype(np.int64) + 1  # -1 -> 0
+    n_cls = cls.max() + 1 if len(cls) > 0 else 1
+    codes = ins * n_cls + cls
+    counts = np.bincount(codes, minlength=n_inst * n_cls)
+    counts = counts.reshape((n_inst, n_cls))
+    max_counts = counts.max(axis=1)
+    labels = counts.argmax(axis=1)
+    tied = (counts == max_counts[:, None]).sum(axis=1) > 1
+    if tied.any():
+        first = np.full(n_inst * n_cls, len(codes), dtype=np.int64)
+        np.minimum.at(first, codes, np.arange(len(codes)))
+        first = first.reshape((n_inst, n_cls))
+        first[counts != max_counts[:, None]] = len(codes)
+        labels[tied] = first[tied].argmin(axis=1)
+    labels = labels - 1
+
+    assert not np.any(np.isin(labels, [-1, 0]))
+
+    # bounding boxes from row and column projections
+    ys, xs = np.divmod(np.where(valid)[0], W)
+    rows = np.bincount(ins * H + ys, minlength=n_inst * H)
+    rows = rows.reshape((n_inst, H)) > 0
+    cols = np.bincount(ins * W + xs, minlength=n_inst * W)
+    cols = cols.reshape((n_inst, W)) > 0
+    bboxes = np.stack((
+        rows.argmax(axis=1),
+        cols.argmax(axis=1),
+        H - rows[:, ::-1].argmax(axis=1),
+        W - cols[:, ::-1].argmax(axis=1)), axis=1)
+
+    if not return_mask:
+        return bboxes, labels
+    masks = ins_img[None] == instances[:, None, None]
     return bboxes, masks, labels
 
 
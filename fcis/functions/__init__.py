@@ -1,2 +1,3 @@
+from fcis.functions.psroi_pooling_2d import integral_image  # NOQA
 from fcis.functions.psroi_pooling_2d import psroi_pooling_2d  # NOQA
 from fcis.functions.psroi_pooling_2d import PSROIPooling2D  # NOQA
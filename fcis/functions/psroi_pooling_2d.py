@@ -4,7 +4,9 @@
 # Modified by Shingo Kitagawa (@knorth55)
 
 import numpy
+import six
 
+import chainer
 from chainer import cuda
 from chainer import function
 from chainer.utils import type_check
@@ -12,11 +14,14 @@ from chainer.utils import type_check
 
 class PSROIPooling2D(function.Function):
 
-    def __init__(self, outh, outw, spatial_scale, group_size, output_dim):
+    def __init__(self, outh, outw, spatial_scale, group_size, output_dim,
+                 use_integral_image=False, table=None):
         self.outh, self.outw = outh, outw
         self.spatial_scale = spatial_scale
         self.group_size = group_size
         self.output_dim = output_dim
+        self.use_integral_image = use_integral_image
+        self.table = table
 
     def check_type_forward(self, in_types):
         type_check.expect(in_types.size() == 2)
@@ -30,9 +35,50 @@ class PSROIPooling2D(function.Function):
             roi_type.shape[1] == 5,
         )
 
+    def forward_cpu(self, inputs):
+        self.retain_inputs((1,))
+        self._bottom_data_shape = inputs[0].shape
+        if self.use_integral_image:
+            return self._forward_integral(inputs)
+
+        bottom_data, bottom_rois = inputs
+        channels, height, width = bottom_data.shape[1:]
+        n_rois = bottom_rois.shape[0]
+        roi_batch_ind, hstart, hend, wstart, wend, c = _roi_bins(
+            numpy, bottom_rois, height, width, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+        n = roi_batch_ind[:, None, None, None]
+        hstart = hstart[:, None, :, None]
+        hend = hend[:, None, :, None]
+        wstart = wstart[:, None, None, :]
+        wend = wend[:, None, None, :]
+
+        # accumulate in the same (h, w) order as the cuda kernel
+        out_sum = numpy.zeros(
+            (n_rois, self.output_dim, self.outh, self.outw),
+            dtype=numpy.float32)
+        for dh in six.moves.range(_max_extent(hstart, hend)):
+            h = hstart + dh
+            h_valid = h < hend
+            h = numpy.minimum(h, height - 1)
+            for dw in six.moves.range(_max_extent(wstart, wend)):
+                w = wstart + dw
+                valid = numpy.logical_and(h_valid, w < wend)
+                w = numpy.minimum(w, width - 1)
+                out_sum += numpy.where(
+                    valid, bottom_data[n, c, h, w], numpy.float32(0))
+
+        bin_area = ((hend - hstart) * (wend - wstart)).astype(numpy.float32)
+        is_empty = bin_area == 0
+        bin_area[is_empty] = 1
+        top_data = numpy.where(is_empty, numpy.float32(0), out_sum / bin_area)
+        return top_data.astype(numpy.float32, copy=False),
+
     def forward_gpu(self, inputs):
         self.retain_inputs((1,))
         self._bottom_data_shape = inputs[0].shape
+        if self.use_integral_image:
+            return self._forward_integral(inputs)
 
         bottom_data, bottom_rois = inputs
         channels, height, width = bottom_data.shape[1:]
@@ -114,7 +160,127 @@ class PSROIPooling2D(function.Function):
 
         return top_data,
 
+    def _forward_integral(self, inputs):
+        # every bin average is read from a per-channel summed-area table
+        # in O(1) instead of summing all pixels in the bin
+        xp = cuda.get_array_module(*inputs)
+        bottom_data, bottom_rois = inputs
+        channels, height, width = bottom_data.shape[1:]
+        roi_batch_ind, hstart, hend, wstart, wend, c = _roi_bins(
+            xp, bottom_rois, height, width, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+        n = roi_batch_ind[:, None, None, None]
+        hstart = hstart[:, None, :, None]
+        hend = hend[:, None, :, None]
+        wstart = wstart[:, None, None, :]
+        wend = wend[:, None, None, :]
+
+        table = self.table
+        if table is None:
+            table = _integral_image(xp, bottom_data)
+        elif table.shape != (len(bottom_data), channels,
+                             height + 1, width + 1):
+            raise ValueError('table is not the summed-area table of x')
+        out_sum = table[n, c, hend, wend] - table[n, c, hstart, wend] \
+            - table[n, c, hend, wstart] + table[n, c, hstart, wstart]
+
+        bin_area = (hend - hstart) * (wend - wstart)
+        is_empty = bin_area == 0
+        bin_area = xp.maximum(bin_area, 1)
+        top_data = xp.where(is_empty, 0, out_sum / bin_area)
+        return top_data.astype(numpy.float32),
+
+    def backward_cpu(self, inputs, gy):
+        if self.use_integral_image:
+            return self._backward_integral_cpu(inputs, gy)
+
+        bottom_rois = inputs[1]
+        channels, height, width = self._bottom_data_shape[1:]
+        roi_batch_ind, hstart, hend, wstart, wend, c = _roi_bins(
+            numpy, bottom_rois, height, width, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+        n = roi_batch_ind[:, None, None, None]
+        hstart = hstart[:, None, :, None]
+        hend = hend[:, None, :, None]
+        wstart = wstart[:, None, None, :]
+        wend = wend[:, None, None, :]
+
+        bin_area = ((hend - hstart) * (wend - wstart)).astype(numpy.float32)
+        is_empty = bin_area == 0
+        bin_area[is_empty] = 1
+        diff_val = numpy.where(
+            is_empty, numpy.float32(0), gy[0] / bin_area)
+
+        # gather the pixels of all the bins and scatter them at once
+        indices = []
+        weights = []
+        for dh in six.moves.range(_max_extent(hstart, hend)):
+            h = hstart + dh
+            h_valid = h < hend
+            for dw in six.moves.range(_max_extent(wstart, wend)):
+                w = wstart + dw
+                valid = numpy.logical_and(h_valid, w < wend)
+                valid = numpy.broadcast_to(valid, diff_val.shape)
+                index = ((n * channels + c) * height + h) * width + w
+                index = numpy.broadcast_to(index, diff_val.shape)
+                indices.append(index[valid])
+                weights.append(diff_val[valid])
+        size = numpy.prod(self._bottom_data_shape)
+        if len(indices) == 0:
+            bottom_diff = numpy.zeros((size,), dtype=numpy.float32)
+        else:
+            bottom_diff = numpy.bincount(
+                numpy.concatenate(indices),
+                weights=numpy.concatenate(weights), minlength=size)
+            bottom_diff = bottom_diff.astype(numpy.float32)
+        return bottom_diff.reshape(self._bottom_data_shape), None
+
+    def _backward_integral_cpu(self, inputs, gy):
+        # scatter each bin gradient to the four corners of the
+        # summed-area table and integrate back with reversed cumsums
+        bottom_rois = inputs[1]
+        n_batch, channels, height, width = self._bottom_data_shape
+        roi_batch_ind, hstart, hend, wstart, wend, c = _roi_bins(
+            numpy, bottom_rois, height, width, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+        n = roi_batch_ind[:, None, None, None]
+        hstart = hstart[:, None, :, None]
+        hend = hend[:, None, :, None]
+        wstart = wstart[:, None, None, :]
+        wend = wend[:, None, None, :]
+
+        bin_area = ((hend - hstart) * (wend - wstart)).astype(numpy.float32)
+        is_empty = bin_area == 0
+        bin_area[is_empty] = 1
+        diff_val = numpy.where(
+            is_empty, numpy.float32(0), gy[0] / bin_area)
+
+        table_shape = (n_batch, channels, height + 1, width + 1)
+        size = numpy.prod(table_shape)
+        offset = (n * channels + c) * (height + 1)
+        indices = []
+        weights = []
+        for h, w, sign in ((hend, wend, 1), (hstart, wend, -1),
+                           (hend, wstart, -1), (hstart, wstart, 1)):
+            index = (offset + h) * (width + 1) + w
+            index = numpy.broadcast_to(index, diff_val.shape)
+            indices.append(index.ravel())
+            weights.append(sign * diff_val.ravel())
+        table_diff = numpy.bincount(
+            numpy.concatenate(indices),
+            weights=numpy.concatenate(weights), minlength=size)
+        table_diff = table_diff.reshape(table_shape)[:, :, 1:, 1:]
+
+        # table[h, w] sums bottom_data[:h, :w],
+        # so bottom_diff[h, w] sums table_diff[h + 1:, w + 1:]
+        bottom_diff = table_diff[:, :, ::-1, ::-1]
+        bottom_diff = bottom_diff.cumsum(axis=2).cumsum(axis=3)
+        bottom_diff = bottom_diff[:, :, ::-1, ::-1].astype(numpy.float32)
+        return bottom_diff, None
+
     def backward_gpu(self, inputs, gy):
+        # the gradient of the integral-image formulation is identical to
+        # that of the direct sum, so both modes share this kernel
         bottom_rois = inputs[1]
         channels, height, width = self._bottom_data_shape[1:]
         bottom_diff = cuda.cupy.zeros(self._bottom_data_shape, numpy.float32)
@@ -197,7 +363,86 @@ class PSROIPooling2D(function.Function):
 
 def psroi_pooling_2d(
         x, rois, outh, outw, spatial_scale,
-        group_size, output_dim
+        group_size, output_dim, use_integral_image=False, table=None
 ):
+    # table is the summed-area table of x made by integral_image,
+    # which is reused by calls on the same x if use_integral_image
     return PSROIPooling2D(outh, outw, spatial_scale,
-                          group_size, output_dim)(x, rois)
+                          group_size, output_dim,
+                          use_integral_image, table)(x, rois)
+
+
+def integral_image(x):
+    """Compute the summed-area table of a feature map.
+
+    The table can be given to :func:`psroi_pooling_2d` as :obj:`table`,
+    so that it is computed once for pooling on the same feature map.
+
+    """
+    if isinstance(x, chainer.Variable):
+        x = x.data
+    return _integral_image(cuda.get_array_module(x), x)
+
+
+def _roi_bins(xp, bottom_rois, height, width, outh, outw,
+              spatial_scale, group_size, output_dim):
+    # array port of the index computation in the cuda kernels,
+    # evaluated in float32 to reproduce their rounding
+    float32 = numpy.float32
+    roi_batch_ind = bottom_rois[:, 0].astype(numpy.int32)
+    # round() in cuda rounds half away from zero
+    rounded = bottom_rois[:, 1:].astype(numpy.float64)
+    rounded = xp.sign(rounded) * xp.floor(xp.abs(rounded) + 0.5)
+    rounded = rounded.astype(float32) * float32(spatial_scale)
+    roi_start_w, roi_start_h, roi_end_w, roi_end_h = rounded.T
+
+    # Force too small ROIs to be 1x1
+    roi_width = xp.maximum(roi_end_w - roi_start_w, float32(0.1))
+    roi_height = xp.maximum(roi_end_h - roi_start_h, float32(0.1))
+
+    # Compute w and h at bottom
+    bin_size_h = roi_height / float32(outh)
+    bin_size_w = roi_width / float32(outw)
+
+    ph = xp.arange(outh, dtype=float32)
+    pw = xp.arange(outw, dtype=float32)
+    hstart = xp.floor(
+        ph[None] * bin_size_h[:, None] + roi_start_h[:, None])
+    wstart = xp.floor(
+        pw[None] * bin_size_w[:, None] + roi_start_w[:, None])
+    hend = xp.ceil(
+        (ph[None] + 1) * bin_size_h[:, None] + roi_start_h[:, None])
+    wend = xp.ceil(
+        (pw[None] + 1) * bin_size_w[:, None] + roi_start_w[:, None])
+
+    # Add roi offsets and clip to input boundaries
+    hstart = xp.clip(hstart, 0, height).astype(numpy.int64)
+    hend = xp.clip(hend, 0, height).astype(numpy.int64)
+    wstart = xp.clip(wstart, 0, width).astype(numpy.int64)
+    wend = xp.clip(wend, 0, width).astype(numpy.int64)
+
+    # Compute c at bottom
+    gh = xp.floor(ph * float32(group_size) / float32(outh))
+    gw = xp.floor(pw * float32(group_size) / float32(outw))
+    gh = xp.clip(gh, 0, group_size - 1).astype(numpy.int64)
+    gw = xp.clip(gw, 0, group_size - 1).astype(numpy.int64)
+    ctop = xp.arange(output_dim)
+    c = (ctop[:, None, None] * group_size + gh[None, :, None]) \
+        * group_size + gw[None, None, :]
+    return roi_batch_ind, hstart, hend, wstart, wend, c
+
+
+def _max_extent(start, end):
+    if start.size == 0:
+        return 0
+    return int((end - start).max())
+
+
+def _integral_image(xp, x):
+    # table[:, :, h, w] = x[:, :, :h, :w].sum(axis=(2, 3))
+    n_batch, channels, height, width = x.shape
+    table = xp.zeros(
+        (n_batch, channels, height + 1, width + 1), dtype=numpy.float64)
+    table[:, :, 1:, 1:] = x.astype(numpy.float64).cumsum(
+        axis=2).cumsum(axis=3)
+    return table
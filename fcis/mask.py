@@ -42,56 +42,164 @@ def mask_voting(
         score_thresh=0.7,
         nms_thresh=0.3,
         mask_merge_thresh=0.5,
-        binary_thresh=0.4):
+        binary_thresh=0.4,
+        batched_nms=False):
 
     mask_size = mask_probs.shape[-1]
-    v_labels = np.empty((0, ), dtype=np.int32)
-    v_masks = np.empty((0, mask_size, mask_size), dtype=np.float32)
-    v_bboxes = np.empty((0, 4), dtype=np.float32)
-    v_cls_probs = np.empty((0, ), dtype=np.float32)
-
-    for label in range(0, n_class):
-        if label == 0:
-            # l == 0 is background
-            continue
-        # non maximum suppression
-        cls_prob_l = cls_probs[:, label]
-        thresh_mask = cls_prob_l >= 0.001
-        bbox_l = rois[thresh_mask]
-        cls_prob_l = cls_prob_l[thresh_mask]
-        keep = non_maximum_suppression(
-            bbox_l, nms_thresh, cls_prob_l, limit=100)
-        bbox_l = bbox_l[keep]
-        cls_prob_l = cls_prob_l[keep]
-
-        n_bbox_l = len(bbox_l)
-        v_mask_l = np.zeros((n_bbox_l, mask_size, mask_size))
-        v_bbox_l = np.zeros((n_bbox_l, 4))
-
-        for i, bbox in enumerate(bbox_l):
-            iou = bbox_iou(rois, bbox[np.newaxis, :])
-            idx = np.where(iou > mask_merge_thresh)[0]
-            mask_weights = cls_probs[idx, label]
-            mask_weights = mask_weights / mask_weights.sum()
-            mask_prob_l = mask_probs[idx]
-            rois_l = rois[idx]
-            v_bbox_l[i], clipped_mask = mask_aggregation(
-                rois_l, mask_prob_l, mask_weights, H, W, binary_thresh)
-            v_mask_l[i] = cv2.resize(
-                clipped_mask.astype(np.float32), (mask_size, mask_size))
-
-        score_thresh_mask = cls_prob_l > score_thresh
-        v_mask_l = v_mask_l[score_thresh_mask]
-        v_bbox_l = v_bbox_l[score_thresh_mask]
-        v_label_l = np.repeat(label, v_bbox_l.shape[0])
-        v_cls_prob_l = cls_prob_l[score_thresh_mask]
-        v_masks = np.concatenate((v_masks, v_mask_l))
-        v_bboxes = np.concatenate((v_bboxes, v_bbox_l))
-        v_labels = np.concatenate((v_labels, v_label_l))
-        v_cls_probs = np.concatenate((v_cls_probs, v_cls_prob_l))
+
+    # IoU between rois is shared by all classes,
+    # and each roi is binarized at most once.
+    iou = bbox_iou(rois, rois)
+    int_rois = np.round(rois).astype(np.int32)
+    binary_masks = dict()
+
+    # non maximum suppression
+    # l == 0 is background
+    if batched_nms:
+        keep_indices, keep_labels = batched_non_maximum_suppression(
+            iou, cls_probs[:, 1:n_class], nms_thresh, limit=100)
+        keep_labels = keep_labels + 1
+    else:
+        keep_indices = []
+        keep_labels = []
+        for label in range(1, n_class):
+            cls_prob_l = cls_probs[:, label]
+            thresh_indices = np.where(cls_prob_l >= 0.001)[0]
+            keep = non_maximum_suppression(
+                rois[thresh_indices], nms_thresh,
+                cls_prob_l[thresh_indices], limit=100)
+            keep_indices.append(thresh_indices[keep])
+            keep_labels.append(np.repeat(label, len(keep)))
+        keep_indices = np.concatenate(keep_indices).astype(np.int32)
+        keep_labels = np.concatenate(keep_labels).astype(np.int32)
+
+    # only voted masks over score_thresh are returned
+    keep = cls_probs[keep_indices, keep_labels] > score_thresh
+    keep_indices = keep_indices[keep]
+    v_labels = keep_labels[keep]
+    v_cls_probs = cls_probs[keep_indices, v_labels]
+
+    n_bbox = len(keep_indices)
+    v_masks = np.zeros((n_bbox, mask_size, mask_size))
+    v_bboxes = np.zeros((n_bbox, 4))
+    for i, (keep_index, label) in enumerate(zip(keep_indices, v_labels)):
+        idx = np.where(iou[:, keep_index] > mask_merge_thresh)[0]
+        mask_weights = cls_probs[idx, label]
+        mask_weights = mask_weights / mask_weights.sum()
+        for j in idx:
+            if j not in binary_masks:
+                binary_masks[j] = _binarize_mask_prob(
+                    mask_probs[j], int_rois[j], binary_thresh)
+        v_bboxes[i], clipped_mask = _local_mask_aggregation(
+            int_rois[idx], [binary_masks[j] for j in idx],
+            mask_weights, H, W, binary_thresh)
+        v_masks[i] = cv2.resize(
+            clipped_mask.astype(np.float32), (mask_size, mask_size))
     return v_bboxes, v_masks, v_labels, v_cls_probs
 
 
+def batched_non_maximum_suppression(
+        iou, scores, thresh, score_thresh=0.001, limit=None):
+    """Suppress bounding boxes of all classes at once.
+
+    This is equivalent to calling
+    :func:`chainercv.utils.non_maximum_suppression` for each class on the
+    boxes whose score is at least :obj:`score_thresh`, and boxes with
+    tied scores are ordered in the same way. Each step of the greedy
+    suppression is processed for all classes together.
+
+    Args:
+        iou (array): IoU between the boxes, whose shape is :math:`(R, R)`.
+        scores (array): Scores of the boxes for each class,
+            whose shape is :math:`(R, L)`.
+        thresh (float): Threshold of IoU for suppression.
+        score_thresh (float): Boxes under this score are ignored.
+        limit (int): Maximum number of boxes kept for each class.
+
+    Returns:
+        tuple of two arrays: Indices of the kept boxes and their class
+        indices, sorted by class and then by descending score.
+
+    """
+    R, n_class = scores.shape
+    scores = scores.T
+    n_valid = (scores >= score_thresh).sum(axis=1)
+    # candidates over score_thresh come first for each class,
+    # sorted as non_maximum_suppression does to break ties alike
+    order = np.zeros((n_class, R), dtype=np.int64)
+    for label in range(n_class):
+        valid_indices = np.where(scores[label] >= score_thresh)[0]
+        order[label, :len(valid_indices)] = valid_indices[
+            scores[label][valid_indices].argsort()[::-1]]
+    suppress = iou >= thresh
+
+    classes = np.arange(n_class)
+    suppressed = np.zeros((n_class, R), dtype=bool)
+    selected = np.zeros((n_class, R), dtype=bool)
+    n_selected = np.zeros((n_class,), dtype=np.int32)
+    if limit is None:
+        limit = R
+    for k in range(n_valid.max() if n_class > 0 else 0):
+        # classes are done when they reach limit or run out of candidates
+        if np.all(np.logical_or(n_selected >= limit, k >= n_valid)):
+            break
+        index = order[:, k]
+        keep = np.logical_and(k < n_valid, n_selected < limit)
+        keep = np.logical_and(keep, ~suppressed[classes, index])
+        selected[:, k] = keep
+        n_selected += keep
+        suppressed[keep] |= suppress[index[keep]]
+
+    labels, ranks = np.nonzero(selected)
+    indices = order[labels, ranks]
+    return indices.astype(np.int32), labels.astype(np.int32)
+
+
+def _binarize_mask_prob(mask_prob, int_bbox, binary_thresh):
+    y_min, x_min, y_max, x_max = int_bbox
+    mask_prob = cv2.resize(mask_prob, (x_max - x_min, y_max - y_min))
+    return (mask_prob >= binary_thresh).astype(np.float64)
+
+
+def _local_mask_aggregation(
+        int_bboxes, binary_masks, mask_weights,
+        H, W, binary_thresh):
+    # same as mask_aggregation, but accumulates on a canvas
+    # that only covers the union of int_bboxes
+    y_offset, x_offset = int_bboxes[:, :2].min(axis=0)
+    y_end, x_end = int_bboxes[:, 2:].max(axis=0)
+    mask = np.zeros((y_end - y_offset, x_end - x_offset))
+    for bbox, binary_mask, mask_weight in zip(
+            int_bboxes, binary_masks, mask_weights):
+        y_min, x_min, y_max, x_max = bbox
+        mask[y_min - y_offset:y_max - y_offset,
+             x_min - x_offset:x_max - x_offset] += binary_mask * mask_weight
+
+    y_idx, x_idx = np.where(mask >= binary_thresh)
+    if len(y_idx) == 0 or len(x_idx) == 0:
+        new_y_min = int(np.ceil(H / 2.0))
+        new_x_min = int(np.ceil(W / 2.0))
+        y = new_y_min - y_offset
+        x = new_x_min - x_offset
+        clipped_mask = np.zeros((1, 1))
+        if 0 <= y < mask.shape[0] and 0 <= x < mask.shape[1]:
+            clipped_mask[0, 0] = mask[y, x]
+        clipped_bbox = np.array(
+            [new_y_min, new_x_min, new_y_min + 1, new_x_min + 1],
+            dtype=np.float32)
+        return clipped_bbox, clipped_mask
+
+    new_y_min = y_idx.min()
+    new_x_min = x_idx.min()
+    new_y_max = y_idx.max() + 1
+    new_x_max = x_idx.max() + 1
+    clipped_mask = mask[new_y_min:new_y_max, new_x_min:new_x_max]
+    clipped_bbox = np.array(
+        [new_y_min + y_offset, new_x_min + x_offset,
+         new_y_max + y_offset, new_x_max + x_offset], dtype=np.float32)
+    return clipped_bbox, clipped_mask
+
+
 def intersect_bbox_mask(bbox, gt_bbox, gt_mask, mask_size=21):
     min_y = max(bbox[0], gt_bbox[0])
     min_x = max(bbox[1], gt_bbox[1])
@@ -4,7 +4,7 @@ import chainer.links as L
 from chainercv.links.model.faster_rcnn.region_proposal_network import \
     RegionProposalNetwork
 from chainercv.links.model.faster_rcnn.utils.loc2bbox import loc2bbox
-import cupy
+import collections
 import fcis.functions
 from fcis.models.resnet101 import ResNet101C1
 from fcis.models.resnet101 import ResNet101C2
@@ -33,6 +33,7 @@ class FCISResNet101(chainer.Chain):
             group_size=7, roi_size=21,
             loc_normalize_mean=(0.0, 0.0, 0.0, 0.0),
             loc_normalize_std=(0.2, 0.2, 0.5, 0.5),
+            use_integral_image=False,
     ):
         super(FCISResNet101, self).__init__()
         proposal_creator_params = {
@@ -51,6 +52,9 @@ class FCISResNet101(chainer.Chain):
         self.roi_size = roi_size
         self.loc_normalize_mean = loc_normalize_mean
         self.loc_normalize_std = loc_normalize_std
+        self.use_integral_image = use_integral_image
+        # original labels of the classes after restrict_classes
+        self.class_ids = None
 
         initialW = chainer.initializers.Normal(0.01)
 
@@ -81,8 +85,25 @@ class FCISResNet101(chainer.Chain):
             self.psroi_conv3 = L.Convolution2D(
                 1024, group_size*group_size*2*4, 1, 1, 0, initialW=initialW)
 
-    def __call__(self, x, scale=1.0):
-        img_size = x.shape[2:]
+    def __call__(self, x, scale=1.0, img_sizes=None,
+                 second_iteration=True, second_iteration_top_k=None):
+        # x may be a zero padded batch of images.
+        # scale and img_sizes are per-image scales and unpadded (H, W).
+        # Images are padded at the bottom and the right, and features
+        # near these edges of smaller images differ from those of the
+        # images alone, as convolutions see the padded areas, where
+        # features are not zero after biases. Outputs of images of
+        # the size of the batch do not depend on the other images,
+        # so predict only batches images of the same size.
+        # The RPN runs on each image with its own size and scale.
+        # The 2nd iteration is skipped if second_iteration is False,
+        # and only runs on the top second_iteration_top_k rois
+        # by foreground probability of each image if it is given.
+        n = x.shape[0]
+        if img_sizes is None:
+            img_sizes = [x.shape[2:]] * n
+        if np.isscalar(scale):
+            scale = [scale] * n
 
         # Feature Extractor
         h = self.res1(x)
@@ -91,9 +112,16 @@ class FCISResNet101(chainer.Chain):
         h = self.res4(h)
 
         # RPN
-        rpn_locs, rpn_scores, rois, roi_indices, anchor = self.rpn(
-            h, img_size, scale)
-        roi_indices = roi_indices.astype(np.float32)
+        # proposals are clipped and filtered with each image's own size
+        rois = []
+        roi_indices = []
+        for i in range(n):
+            _, _, rois_i, _, _ = self.rpn(h[i:i + 1], img_sizes[i], scale[i])
+            rois.append(rois_i)
+            roi_indices.append(
+                self.xp.full((len(rois_i),), i, dtype=np.float32))
+        rois = self.xp.concatenate(rois)
+        roi_indices = self.xp.concatenate(roi_indices)
         indices_and_rois = self.xp.concatenate(
             (roi_indices[:, None], rois), axis=1)
 
@@ -104,12 +132,19 @@ class FCISResNet101(chainer.Chain):
         h = F.relu(self.psroi_conv1(h))
         h_seg = self.psroi_conv2(h)
         h_locs = self.psroi_conv3(h)
+        tables = None
+        if self.use_integral_image:
+            # summed-area tables are shared by the two iterations
+            tables = (fcis.functions.integral_image(h_seg),
+                      fcis.functions.integral_image(h_locs))
 
         # PSROI pooling and regression
         roi_seg_scores, roi_cls_locs, roi_cls_scores = self._pool_and_predict(
-            indices_and_rois, h_seg, h_locs)
+            indices_and_rois, h_seg, h_locs, tables=tables)
         roi_cls_probs = F.softmax(roi_cls_scores)
         roi_seg_probs = F.softmax(roi_seg_scores)
+        if not second_iteration:
+            return roi_indices, rois, roi_seg_probs.data, roi_cls_probs.data
 
         # 2nd Iteration
         # get rois2 for more precise prediction
@@ -119,22 +154,31 @@ class FCISResNet101(chainer.Chain):
         std = self.xp.array(self.loc_normalize_std)
         roi_locs = roi_locs * std + mean
         rois2 = loc2bbox(rois, roi_locs)
-        H, W = img_size
-        rois2[:, 0::2] = self.xp.clip(rois2[:, 0::2], 0, H)
-        rois2[:, 1::2] = self.xp.clip(rois2[:, 1::2], 0, W)
+        img_sizes = self.xp.asarray(img_sizes, dtype=np.float32)
+        img_sizes = img_sizes[roi_indices.astype(np.int32)]
+        rois2[:, 0::2] = self.xp.minimum(
+            self.xp.maximum(rois2[:, 0::2], 0), img_sizes[:, 0:1])
+        rois2[:, 1::2] = self.xp.minimum(
+            self.xp.maximum(rois2[:, 1::2], 0), img_sizes[:, 1:2])
+        roi_indices2 = roi_indices
+        if second_iteration_top_k is not None:
+            keep = _top_k_fg_indices(
+                roi_indices, roi_cls_probs.data, n, second_iteration_top_k)
+            rois2 = rois2[keep]
+            roi_indices2 = roi_indices[keep]
 
         # PSROI pooling and regression
         indices_and_rois2 = self.xp.concatenate(
-            (roi_indices[:, None], rois2), axis=1)
+            (roi_indices2[:, None], rois2), axis=1)
         indices_and_rois2 = indices_and_rois2.astype(self.xp.float32)
         roi_seg_scores2, _, roi_cls_scores2 = self._pool_and_predict(
-            indices_and_rois2, h_seg, h_locs)
+            indices_and_rois2, h_seg, h_locs, tables=tables)
         roi_cls_probs2 = F.softmax(roi_cls_scores2)
         roi_seg_probs2 = F.softmax(roi_seg_scores2)
 
         # concat 1st and 2nd iteration results
         rois = self.xp.concatenate((rois, rois2))
-        roi_indices = self.xp.concatenate((roi_indices, roi_indices))
+        roi_indices = self.xp.concatenate((roi_indices, roi_indices2))
         roi_cls_probs = self.xp.concatenate(
             (roi_cls_probs.data, roi_cls_probs2.data))
         roi_seg_probs = self.xp.concatenate(
@@ -142,14 +186,80 @@ class FCISResNet101(chainer.Chain):
 
         return roi_indices, rois, roi_seg_probs, roi_cls_probs
 
+    def restrict_classes(self, class_ids):
+        """Restrict prediction to a subset of classes in place.
+
+        The output channels of :obj:`psroi_conv2` are sliced down to the
+        background and :obj:`class_ids`, so the score maps and the voting
+        only cover these classes. :meth:`predict` maps labels back to the
+        original ones. Note that class probabilities are normalized among
+        the kept classes.
+
+        Args:
+            class_ids (iterable of ints): Labels of the classes to keep.
+                The background :obj:`0` is always kept. These are the
+                original labels even if the model is already restricted.
+
+        """
+        class_ids = sorted(set(int(label) for label in class_ids) - {0})
+        class_ids = np.array([0] + class_ids, dtype=np.int32)
+        if self.class_ids is None:
+            if class_ids[-1] >= self.n_class:
+                raise ValueError('class_ids should be less than n_class')
+            positions = class_ids
+        else:
+            # positions of the original labels in the current channels
+            positions = np.searchsorted(self.class_ids, class_ids)
+            positions = np.minimum(positions, len(self.class_ids) - 1)
+            if np.any(self.class_ids[positions] != class_ids):
+                raise ValueError(
+                    'class_ids should be kept by the previous restriction')
+
+        # channel c belongs to ctop = c // group_size ** 2,
+        # and ctop = 2 * label + {0: bg, 1: fg} of the instance mask
+        group_area = self.group_size * self.group_size
+        ctop = (2 * positions[:, None] + np.arange(2)).ravel()
+        index = (ctop[:, None] * group_area + np.arange(group_area)).ravel()
+        index = self.xp.asarray(index)
+        conv = self.psroi_conv2
+        conv.W.data = conv.W.data[index]
+        conv.b.data = conv.b.data[index]
+        conv.out_channels = len(index)
+        conv.cleargrads()
+
+        self.class_ids = class_ids
+        self.n_class = len(class_ids)
+
+    def fuse_for_inference(self):
+        """Fold BatchNormalizations of ResNet101 into convolutions.
+
+        This is a one-time in-place transform for inference only.
+        BatchNormalizations use fixed statistics at test time, so they are
+        folded into the weights and biases of the preceding convolutions.
+        The model cannot be trained or serialized into the original
+        format afterwards.
+
+        """
+        self.res1.fuse_bn()
+        self.res2.fuse_bn()
+        self.res3.fuse_bn()
+        self.res4.fuse_bn()
+        self.res5.fuse_bn()
+
     def _pool_and_predict(
-            self, indices_and_rois, h_seg, h_locs, gt_roi_labels=None):
+            self, indices_and_rois, h_seg, h_locs, gt_roi_labels=None,
+            use_integral_image=None, tables=None):
+        if use_integral_image is None:
+            use_integral_image = self.use_integral_image
+        seg_table, locs_table = (None, None) if tables is None else tables
+
         # PSROI Pooling
         # shape: (n_rois, n_class*2, roi_size, roi_size)
         pool_cls_seg = _psroi_pooling_2d_yx(
             h_seg, indices_and_rois, self.roi_size, self.roi_size,
             self.spatial_scale, group_size=self.group_size,
-            output_dim=self.n_class*2)
+            output_dim=self.n_class*2,
+            use_integral_image=use_integral_image, table=seg_table)
         # shape: (n_rois, n_class, 2, roi_size, roi_size)
         pool_cls_seg = pool_cls_seg.reshape(
             (-1, self.n_class, 2, self.roi_size, self.roi_size))
@@ -157,7 +267,8 @@ class FCISResNet101(chainer.Chain):
         pool_locs = _psroi_pooling_2d_yx(
             h_locs, indices_and_rois, self.roi_size, self.roi_size,
             self.spatial_scale, group_size=self.group_size,
-            output_dim=2*4)
+            output_dim=2*4, use_integral_image=use_integral_image,
+            table=locs_table)
 
         # Classfication
         # Group Max
@@ -200,46 +311,87 @@ class FCISResNet101(chainer.Chain):
             self, orig_imgs,
             target_height=600, max_width=1000,
             score_thresh=0.7, nms_thresh=0.3,
-            mask_merge_thresh=0.5, binary_thresh=0.4):
+            mask_merge_thresh=0.5, binary_thresh=0.4,
+            batch_size=1, batched_nms=False, pool=None,
+            second_iteration=True, second_iteration_top_k=None):
+        # voting and binarization are handed to pool (e.g.
+        # multiprocessing.Pool) if given, so that they overlap
+        # with the forward pass of the following batches.
+        # Only images of the same size are batched without padding,
+        # so that outputs are the same as those of each image alone.
+
+        results = []
+        orig_imgs = list(orig_imgs)
+        for start in range(0, len(orig_imgs), batch_size):
+            batch_orig_imgs = orig_imgs[start:start + batch_size]
+            imgs = []
+            scales = []
+            for orig_img in batch_orig_imgs:
+                img = self.prepare(
+                    orig_img, target_height, max_width)
+                img = img.astype(np.float32)
+                imgs.append(img)
+                scales.append(img.shape[1] / float(orig_img.shape[1]))
+
+            groups = collections.OrderedDict()
+            for i, img in enumerate(imgs):
+                groups.setdefault(img.shape, []).append(i)
+            batch_results = [None] * len(imgs)
+            for indices in groups.values():
+                group_scales = [scales[i] for i in indices]
+                with chainer.using_config('train', False), \
+                        chainer.function.no_backprop_mode():
+                    # inference
+                    x = chainer.Variable(self.xp.array(
+                        np.stack([imgs[i] for i in indices])))
+                    roi_indices, rois, roi_seg_probs, roi_cls_probs = \
+                        self.__call__(
+                            x, group_scales, None, second_iteration,
+                            second_iteration_top_k)
+
+                for j, i in enumerate(indices):
+                    _, orig_H, orig_W = batch_orig_imgs[i].shape
+                    keep = self.xp.where(roi_indices == j)[0]
+                    rois_i = rois[keep] / scales[i]
+
+                    # shape: (n_rois, H, W)
+                    roi_mask_probs = roi_seg_probs[keep, 1, :, :]
+
+                    # shape: (n_rois, 4)
+                    rois_i[:, 0::2] = self.xp.clip(
+                        rois_i[:, 0::2], 0, orig_H)
+                    rois_i[:, 1::2] = self.xp.clip(
+                        rois_i[:, 1::2], 0, orig_W)
+
+                    # voting
+                    # cpu voting is only implemented
+                    rois_i = chainer.cuda.to_cpu(rois_i)
+                    roi_cls_probs_i = chainer.cuda.to_cpu(
+                        roi_cls_probs[keep])
+                    roi_mask_probs = chainer.cuda.to_cpu(roi_mask_probs)
+
+                    args = (
+                        rois_i, roi_mask_probs, roi_cls_probs_i,
+                        self.n_class, orig_H, orig_W, score_thresh,
+                        nms_thresh, mask_merge_thresh, binary_thresh,
+                        batched_nms)
+                    if pool is None:
+                        batch_results[i] = _postprocess(*args)
+                    else:
+                        batch_results[i] = pool.apply_async(
+                            _postprocess, args)
+            results.extend(batch_results)
 
         masks = []
         bboxes = []
         labels = []
         cls_probs = []
-
-        for orig_img in orig_imgs:
-            _, orig_H, orig_W = orig_img.shape
-            img = self.prepare(
-                orig_img, target_height, max_width)
-            img = img.astype(np.float32)
-            scale = img.shape[1] / float(orig_H)
-            with chainer.using_config('train', False), \
-                    chainer.function.no_backprop_mode():
-                # inference
-                x = chainer.Variable(self.xp.array(img[None]))
-                _, rois, roi_seg_probs, roi_cls_probs = self.__call__(x, scale)
-
-            # assume that batch_size = 1
-            rois = rois / scale
-
-            # shape: (n_rois, H, W)
-            roi_mask_probs = roi_seg_probs[:, 1, :, :]
-
-            # shape: (n_rois, 4)
-            rois[:, 0::2] = cupy.clip(rois[:, 0::2], 0, orig_H)
-            rois[:, 1::2] = cupy.clip(rois[:, 1::2], 0, orig_W)
-
-            # voting
-            # cpu voting is only implemented
-            rois = chainer.cuda.to_cpu(rois)
-            roi_cls_probs = chainer.cuda.to_cpu(roi_cls_probs)
-            roi_mask_probs = chainer.cuda.to_cpu(roi_mask_probs)
-
-            bbox, mask_prob, label, cls_prob = fcis.mask.mask_voting(
-                rois, roi_mask_probs, roi_cls_probs, self.n_class,
-                orig_H, orig_W, score_thresh, nms_thresh, mask_merge_thresh,
-                binary_thresh)
-            mask = fcis.utils.mask_probs2mask(mask_prob, bbox, binary_thresh)
+        for result in results:
+            if pool is not None:
+                result = result.get()
+            bbox, mask, label, cls_prob = result
+            if self.class_ids is not None:
+                label = self.class_ids[label]
             masks.append(mask)
             bboxes.append(bbox)
             labels.append(label)
@@ -310,13 +462,40 @@ class FCISResNet101(chainer.Chain):
         copy_block(self.res5, resnet101.res5, 'res5')
 
 
+def _postprocess(
+        rois, roi_mask_probs, roi_cls_probs, n_class, H, W,
+        score_thresh, nms_thresh, mask_merge_thresh, binary_thresh,
+        batched_nms):
+    bbox, mask_prob, label, cls_prob = fcis.mask.mask_voting(
+        rois, roi_mask_probs, roi_cls_probs, n_class,
+        H, W, score_thresh, nms_thresh,
+        mask_merge_thresh, binary_thresh,
+        batched_nms=batched_nms)
+    mask = fcis.utils.mask_probs2mask(mask_prob, bbox, binary_thresh)
+    return bbox, mask, label, cls_prob
+
+
+def _top_k_fg_indices(roi_indices, roi_cls_probs, n, k):
+    xp = chainer.cuda.get_array_module(roi_cls_probs)
+    # l == 0 is background
+    fg_probs = 1 - roi_cls_probs[:, 0]
+    keep = []
+    for i in range(n):
+        index = xp.where(roi_indices == i)[0]
+        order = xp.argsort(-fg_probs[index])[:k]
+        keep.append(index[order])
+    return xp.concatenate(keep)
+
+
 def _psroi_pooling_2d_yx(
         x, indices_and_rois, outh, outw,
-        spatial_scale, group_size, output_dim):
+        spatial_scale, group_size, output_dim,
+        use_integral_image=False, table=None):
     xy_indices_and_rois = indices_and_rois[:, [0, 2, 1, 4, 3]]
     pool = fcis.functions.psroi_pooling_2d(
         x, xy_indices_and_rois, outh, outw, spatial_scale,
-        group_size, output_dim)
+        group_size, output_dim, use_integral_image=use_integral_image,
+        table=table)
     return pool
 
 
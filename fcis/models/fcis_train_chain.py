@@ -4,14 +4,27 @@
 
 import chainer
 import chainer.functions as F
-from chainercv.links.model.faster_rcnn.utils.anchor_target_creator import\
-    AnchorTargetCreator
+from fcis.anchor_target_creator import AnchorTargetCreator
 from fcis.proposal_target_creator import ProposalTargetCreator
 import numpy as np
 
 
 class FCISTrainChain(chainer.Chain):
 
+    """Calculate losses for FCIS and report them.
+
+    Args:
+        fcis (~fcis.models.FCISResNet101): A model to be trained.
+        feature_cache: :class:`~fcis.dataset.LRUCache` or
+            :class:`~fcis.dataset.MemmapCache` to cache outputs of
+            :obj:`res1` and :obj:`res2`, which are used only when
+            examples have keys. The outputs are stored in float16, and
+            the layers should not be updated. Batches should have one
+            image, as outputs for images in padded batches depend on
+            the other images.
+
+    """
+
     def __init__(
             self, fcis, rpn_sigma=3.0, roi_sigma=1.0,
             n_sample=None,
@@ -19,13 +32,15 @@ class FCISTrainChain(chainer.Chain):
             loc_normalize_std=(0.2, 0.2, 0.5, 0.5),
             fg_ratio=0.25, fg_iou_thresh=0.5,
             bg_iou_thresh_hi=0.5, bg_iou_thresh_lo=0.0,
-            mask_size=21, binary_thresh=0.4):
+            mask_size=21, binary_thresh=0.4,
+            feature_cache=None):
 
         super(FCISTrainChain, self).__init__()
         with self.init_scope():
             self.fcis = fcis
         self.rpn_sigma = rpn_sigma
         self.roi_sigma = roi_sigma
+        self.feature_cache = feature_cache
 
         self.loc_normalize_mean = fcis.loc_normalize_mean
         self.loc_normalize_std = fcis.loc_normalize_std
@@ -39,27 +54,39 @@ class FCISTrainChain(chainer.Chain):
             bg_iou_thresh_hi=bg_iou_thresh_hi,
             bg_iou_thresh_lo=bg_iou_thresh_lo,
             mask_size=mask_size, binary_thresh=binary_thresh)
+        # anchors on device for each feature size
+        self._anchors = {}
 
-    def __call__(self, x, bboxes, whole_mask, labels, scale=1.0):
-        scale = scale[0]
-        n = bboxes.shape[0]
-        # batch size = 1
-        if n != 1:
-            raise ValueError('Currently only batch size 1 is supported.')
-
-        _, _, H, W = x.shape
-        img_size = (H, W)
-        assert img_size == whole_mask.shape[2:]
+    def __call__(self, x, bboxes, whole_mask, labels, scale=1.0,
+                 n_bboxes=None, img_sizes=None, keys=None):
+        # inputs are padded by fcis.dataset.concat_examples.
+        # n_bboxes and img_sizes are the number of instances and
+        # unpadded (H, W) of each image, and keys are the keys of
+        # cached features.
+        n, _, H, W = x.shape
+        if not isinstance(whole_mask, list):
+            assert (H, W) == whole_mask.shape[2:]
+        if n_bboxes is None:
+            n_bboxes = [bboxes.shape[1]] * n
+        if img_sizes is None:
+            img_sizes = [(H, W)] * n
+        if np.isscalar(scale):
+            scale = [scale] * n
+        # targets are created on the device of x.
+        # whole_mask is left where it is, and only used on it.
+        bboxes = self.xp.asarray(bboxes)
+        labels = self.xp.asarray(labels)
 
         with chainer.using_config('train', False):
             with chainer.function.no_backprop_mode():
-                h = self.fcis.res1(x)
-                h = self.fcis.res2(h)
+                if self.feature_cache is None or keys is None:
+                    h = self.fcis.res1(x)
+                    h = self.fcis.res2(h)
+                else:
+                    h = self._get_res2_features(x, keys)
             h = self.fcis.res3(h)
             h = self.fcis.res4(h)
-
-        rpn_locs, rpn_scores, rois, roi_indices, anchor = self.fcis.rpn(
-            h, img_size, scale)
+        h_rpn = h
 
         h = self.fcis.res5(h)
 
@@ -67,35 +94,56 @@ class FCISTrainChain(chainer.Chain):
         h_seg = self.fcis.psroi_conv2(h)
         h_locs = self.fcis.psroi_conv3(h)
 
-        # batch size = 1
-        bboxes = bboxes[0]
-        whole_mask = whole_mask[0]
-        labels = labels[0]
-        rpn_scores = rpn_scores[0]
-        rpn_locs = rpn_locs[0]
-
-        # target creator
-        gt_rpn_locs, gt_rpn_labels = self.anchor_target_creator(
-            bboxes, anchor, img_size)
-        gt_rpn_locs = chainer.cuda.to_gpu(gt_rpn_locs)
-        gt_rpn_labels = chainer.cuda.to_gpu(gt_rpn_labels)
-
-        # RPN losses
-        rpn_loc_loss = _fast_rcnn_loc_loss(
-            rpn_locs, gt_rpn_locs, gt_rpn_labels, self.rpn_sigma)
-        rpn_cls_loss = F.softmax_cross_entropy(
-            rpn_scores, gt_rpn_labels)
-        rpn_loss = rpn_loc_loss + rpn_cls_loss
+        # RPN and target creators run for each image
+        rpn_loc_losses = []
+        rpn_cls_losses = []
+        rpn_scores = []
+        gt_rpn_labels = []
+        sample_indices_and_rois = []
+        gt_roi_locs = []
+        gt_roi_masks = []
+        gt_roi_labels = []
+        for i in range(n):
+            img_size = tuple(int(s) for s in img_sizes[i])
+            rpn_locs_i, rpn_scores_i, rois, _, anchor = self.fcis.rpn(
+                h_rpn[i:i + 1], img_size, scale[i])
+            rpn_locs_i = rpn_locs_i[0]
+            anchor = self._get_anchor(anchor, h_rpn.shape[2:])
+            rpn_scores_i = rpn_scores_i[0]
 
-        # Sample RoIs and forward
-        sample_rois, gt_roi_locs, gt_roi_masks, gt_roi_labels = \
-            self.proposal_target_creator(rois, bboxes, whole_mask, labels)
+            bboxes_i = bboxes[i][:n_bboxes[i]]
+            whole_mask_i = whole_mask[i][:n_bboxes[i]]
+            labels_i = labels[i][:n_bboxes[i]]
 
-        sample_roi_indices = self.xp.zeros(
-            (len(sample_rois),), dtype=np.float32)
-        sample_indices_and_rois = self.xp.concatenate(
-            (sample_roi_indices[:, None], sample_rois), axis=1)
+            # target creator
+            gt_rpn_locs_i, gt_rpn_labels_i = self.anchor_target_creator(
+                bboxes_i, anchor, img_size)
 
+            # RPN losses
+            rpn_loc_losses.append(_fast_rcnn_loc_loss(
+                rpn_locs_i, gt_rpn_locs_i, gt_rpn_labels_i, self.rpn_sigma))
+            rpn_cls_losses.append(F.softmax_cross_entropy(
+                rpn_scores_i, gt_rpn_labels_i))
+            rpn_scores.append(rpn_scores_i.data)
+            gt_rpn_labels.append(gt_rpn_labels_i)
+
+            # Sample RoIs
+            sample_rois_i, gt_roi_locs_i, gt_roi_masks_i, gt_roi_labels_i = \
+                self.proposal_target_creator(
+                    rois, bboxes_i, whole_mask_i, labels_i)
+            sample_roi_indices_i = self.xp.full(
+                (len(sample_rois_i),), i, dtype=np.float32)
+            sample_indices_and_rois.append(self.xp.concatenate(
+                (sample_roi_indices_i[:, None], sample_rois_i), axis=1))
+            gt_roi_locs.append(gt_roi_locs_i)
+            gt_roi_masks.append(gt_roi_masks_i)
+            gt_roi_labels.append(gt_roi_labels_i)
+
+        # Forward sampled RoIs of all images at once
+        n_samples = [len(gt_roi_labels_i) for gt_roi_labels_i in gt_roi_labels]
+        sections = np.cumsum(n_samples)[:-1]
+        sample_indices_and_rois = self.xp.concatenate(sample_indices_and_rois)
+        gt_roi_labels = self.xp.concatenate(gt_roi_labels)
         roi_seg_scores, roi_cls_locs, roi_cls_scores = \
             self.fcis._pool_and_predict(
                 sample_indices_and_rois, h_seg, h_locs,
@@ -104,20 +152,33 @@ class FCISTrainChain(chainer.Chain):
         gt_roi_fg_labels = (gt_roi_labels > 0).astype(int)
         roi_locs = roi_cls_locs[self.xp.arange(n_rois), gt_roi_fg_labels, :]
 
-        # FCIS losses
-        fcis_loc_loss = _fast_rcnn_loc_loss(
-            roi_locs, gt_roi_locs, gt_roi_fg_labels, self.roi_sigma)
-        fcis_cls_loss = F.softmax_cross_entropy(
-            roi_cls_scores, gt_roi_labels)
-        fcis_mask_loss = F.softmax_cross_entropy(
-            roi_seg_scores, gt_roi_masks)
+        # FCIS losses are normalized in each image
+        fcis_loc_losses = []
+        fcis_cls_losses = []
+        fcis_mask_losses = []
+        for i, (start, end) in enumerate(
+                zip([0] + list(sections), list(sections) + [n_rois])):
+            fcis_loc_losses.append(_fast_rcnn_loc_loss(
+                roi_locs[start:end], gt_roi_locs[i],
+                gt_roi_fg_labels[start:end], self.roi_sigma))
+            fcis_cls_losses.append(F.softmax_cross_entropy(
+                roi_cls_scores[start:end], gt_roi_labels[start:end]))
+            fcis_mask_losses.append(F.softmax_cross_entropy(
+                roi_seg_scores[start:end], gt_roi_masks[i]))
+
+        # average over images
+        rpn_loc_loss = sum(rpn_loc_losses) / n
+        rpn_cls_loss = sum(rpn_cls_losses) / n
+        rpn_loss = rpn_loc_loss + rpn_cls_loss
+        fcis_loc_loss = sum(fcis_loc_losses) / n
+        fcis_cls_loss = sum(fcis_cls_losses) / n
+        fcis_mask_loss = sum(fcis_mask_losses) / n
         fcis_loss = fcis_loc_loss + fcis_cls_loss + 10.0 * fcis_mask_loss
 
         # RPN acc
-        rpn_probs = F.softmax(rpn_scores)
-        rpn_probs = rpn_probs.data.argmax(axis=1)
+        rpn_probs = self.xp.concatenate(rpn_scores).argmax(axis=1)
         rpn_probs = rpn_probs.ravel()
-        gt_rpn_labels = gt_rpn_labels.ravel()
+        gt_rpn_labels = self.xp.concatenate(gt_rpn_labels).ravel()
         keep_indices = self.xp.where(gt_rpn_labels.ravel() != -1)
         rpn_probs = rpn_probs[keep_indices]
         gt_rpn_labels = gt_rpn_labels[keep_indices]
@@ -161,6 +222,28 @@ class FCISTrainChain(chainer.Chain):
         }, self)
         return loss
 
+    def _get_res2_features(self, x, keys):
+        if len(x) != 1:
+            raise ValueError(
+                'Features are cached only for batches of one image')
+        key = '{}_{}'.format(keys[0][0], int(keys[0][1]))
+        h = self.feature_cache.get(key)
+        if h is None:
+            h = self.fcis.res1(x)
+            h = self.fcis.res2(h).data[0].astype(np.float16)
+            self.feature_cache.put(key, chainer.cuda.to_cpu(h))
+        # features are rounded to float16 on cache misses as well
+        h = self.xp.asarray(h)[None].astype(np.float32)
+        return chainer.Variable(h)
+
+    def _get_anchor(self, anchor, feat_size):
+        if self.xp is np:
+            return anchor
+        key = tuple(feat_size)
+        if key not in self._anchors:
+            self._anchors[key] = self.xp.asarray(anchor)
+        return self._anchors[key]
+
 
 def _smooth_l1_loss(x, t, in_weight, sigma):
     sigma2 = sigma ** 2
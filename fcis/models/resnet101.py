@@ -3,11 +3,38 @@
 #
 # Modified by Shingo Kitagawa (@knorth55)
 
+import copy
+
 import chainer
+from chainer import cuda
 import chainer.functions as F
 import chainer.links as L
 
 
+def fuse_conv_bn(conv, bn):
+    """Fold a BatchNormalization with fixed statistics into a convolution.
+
+    Returns a copy of :obj:`conv` with a bias whose output is equal to
+    :obj:`bn(conv(x))` at test time.
+
+    """
+    xp = cuda.get_array_module(conv.W.data)
+    scale = bn.gamma.data / xp.sqrt(bn.avg_var + bn.eps)
+    W = conv.W.data * scale[:, None, None, None]
+    b = bn.beta.data - bn.avg_mean * scale
+    if conv.b is not None:
+        b += conv.b.data * scale
+
+    fused = copy.deepcopy(conv)
+    fused.W.data[:] = W
+    if fused.b is None:
+        with fused.init_scope():
+            fused.b = chainer.Parameter(b)
+    else:
+        fused.b.data[:] = b
+    return fused
+
+
 class BottleNeckA(chainer.Chain):
 
     eps = 1e-5
@@ -52,6 +79,13 @@ class BottleNeckA(chainer.Chain):
             self.bn3.disable_update()
             self.bn4.disable_update()
 
+    def fuse_bn(self):
+        return FusedBottleNeckA(
+            fuse_conv_bn(self.conv1, self.bn1),
+            fuse_conv_bn(self.conv2, self.bn2),
+            fuse_conv_bn(self.conv3, self.bn3),
+            fuse_conv_bn(self.conv4, self.bn4))
+
 
 class DilatedBottleNeckA(chainer.Chain):
 
@@ -98,6 +132,13 @@ class DilatedBottleNeckA(chainer.Chain):
             self.bn3.disable_update()
             self.bn4.disable_update()
 
+    def fuse_bn(self):
+        return FusedBottleNeckA(
+            fuse_conv_bn(self.conv1, self.bn1),
+            fuse_conv_bn(self.conv2, self.bn2),
+            fuse_conv_bn(self.conv3, self.bn3),
+            fuse_conv_bn(self.conv4, self.bn4))
+
 
 class BottleNeckB(chainer.Chain):
 
@@ -135,6 +176,12 @@ class BottleNeckB(chainer.Chain):
             self.bn2.disable_update()
             self.bn3.disable_update()
 
+    def fuse_bn(self):
+        return FusedBottleNeckB(
+            fuse_conv_bn(self.conv1, self.bn1),
+            fuse_conv_bn(self.conv2, self.bn2),
+            fuse_conv_bn(self.conv3, self.bn3))
+
 
 class DilatedBottleNeckB(chainer.Chain):
 
@@ -173,6 +220,50 @@ class DilatedBottleNeckB(chainer.Chain):
             self.bn2.disable_update()
             self.bn3.disable_update()
 
+    def fuse_bn(self):
+        return FusedBottleNeckB(
+            fuse_conv_bn(self.conv1, self.bn1),
+            fuse_conv_bn(self.conv2, self.bn2),
+            fuse_conv_bn(self.conv3, self.bn3))
+
+
+class FusedBottleNeckA(chainer.Chain):
+    """BottleNeckA whose BatchNormalizations are folded into convolutions."""
+
+    def __init__(self, conv1, conv2, conv3, conv4):
+        super(FusedBottleNeckA, self).__init__()
+        with self.init_scope():
+            self.conv1 = conv1
+            self.conv2 = conv2
+            self.conv3 = conv3
+            self.conv4 = conv4
+
+    def __call__(self, x):
+        h1 = F.relu(self.conv1(x))
+        h1 = F.relu(self.conv2(h1))
+        h1 = self.conv3(h1)
+        h2 = self.conv4(x)
+
+        return F.relu(h1 + h2)
+
+
+class FusedBottleNeckB(chainer.Chain):
+    """BottleNeckB whose BatchNormalizations are folded into convolutions."""
+
+    def __init__(self, conv1, conv2, conv3):
+        super(FusedBottleNeckB, self).__init__()
+        with self.init_scope():
+            self.conv1 = conv1
+            self.conv2 = conv2
+            self.conv3 = conv3
+
+    def __call__(self, x):
+        h = F.relu(self.conv1(x))
+        h = F.relu(self.conv2(h))
+        h = self.conv3(h)
+
+        return F.relu(h + x)
+
 
 class ResNet101C1(chainer.Chain):
 
@@ -188,7 +279,10 @@ class ResNet101C1(chainer.Chain):
             self.bn1 = L.BatchNormalization(64, eps=self.eps)
 
     def __call__(self, x):
-        h = F.relu(self.bn1(self.conv1(x)))
+        h = self.conv1(x)
+        if self.bn1 is not None:
+            h = self.bn1(h)
+        h = F.relu(h)
         h = F.max_pooling_2d(F.relu(h), 3, stride=2, pad=0)
         return h
 
@@ -196,6 +290,15 @@ class ResNet101C1(chainer.Chain):
         self.conv1.disable_update()
         self.bn1.disable_update()
 
+    def fuse_bn(self):
+        # swap conv1 with the fused one and remove bn1 in place
+        fused = fuse_conv_bn(self.conv1, self.bn1)
+        delattr(self, 'conv1')
+        delattr(self, 'bn1')
+        with self.init_scope():
+            self.conv1 = fused
+        self.bn1 = None
+
 
 class ResNet101C2(chainer.Chain):
 
@@ -219,6 +322,16 @@ class ResNet101C2(chainer.Chain):
         for i in range(1, self.n_layer):
             self['res2_b{}'.format(i)].disable_update(conv, bn)
 
+    def fuse_bn(self):
+        # swap bottlenecks with BN-free ones in place
+        names = ['res2_a'] + [
+            'res2_b{}'.format(i) for i in range(1, self.n_layer)]
+        for name in names:
+            fused = self[name].fuse_bn()
+            delattr(self, name)
+            with self.init_scope():
+                setattr(self, name, fused)
+
 
 class ResNet101C3(chainer.Chain):
 
@@ -242,6 +355,16 @@ class ResNet101C3(chainer.Chain):
         for i in range(1, self.n_layer):
             self['res3_b{}'.format(i)].disable_update(conv, bn)
 
+    def fuse_bn(self):
+        # swap bottlenecks with BN-free ones in place
+        names = ['res3_a'] + [
+            'res3_b{}'.format(i) for i in range(1, self.n_layer)]
+        for name in names:
+            fused = self[name].fuse_bn()
+            delattr(self, name)
+            with self.init_scope():
+                setattr(self, name, fused)
+
 
 class ResNet101C4(chainer.Chain):
 
@@ -265,6 +388,16 @@ class ResNet101C4(chainer.Chain):
         for i in range(1, self.n_layer):
             self['res4_b{}'.format(i)].disable_update(conv, bn)
 
+    def fuse_bn(self):
+        # swap bottlenecks with BN-free ones in place
+        names = ['res4_a'] + [
+            'res4_b{}'.format(i) for i in range(1, self.n_layer)]
+        for name in names:
+            fused = self[name].fuse_bn()
+            delattr(self, name)
+            with self.init_scope():
+                setattr(self, name, fused)
+
 
 class ResNet101C5(chainer.Chain):
 
@@ -288,3 +421,13 @@ class ResNet101C5(chainer.Chain):
         self.res5_a.disable_update(conv, bn)
         for i in range(1, self.n_layer):
             self['res5_b{}'.format(i)].disable_update(conv, bn)
+
+    def fuse_bn(self):
+        # swap bottlenecks with BN-free ones in place
+        names = ['res5_a'] + [
+            'res5_b{}'.format(i) for i in range(1, self.n_layer)]
+        for name in names:
+            fused = self[name].fuse_bn()
+            delattr(self, name)
+            with self.init_scope():
+                setattr(self, name, fused)
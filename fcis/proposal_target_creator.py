@@ -5,8 +5,6 @@
 from chainer import cuda
 from chainercv.links.model.faster_rcnn.utils.bbox2loc import bbox2loc
 from chainercv.utils.bbox.bbox_iou import bbox_iou
-import cv2
-import fcis
 import numpy as np
 
 
@@ -30,15 +28,16 @@ class ProposalTargetCreator(object):
         self.binary_thresh = binary_thresh
 
     def __call__(self, rois, bboxes, whole_mask, labels):
+        # whole_mask is either an array of shape (R, H, W) or
+        # a list of masks cropped with the rounded bboxes.
 
-        rois = cuda.to_cpu(rois)
-        bboxes = cuda.to_cpu(bboxes)
-        whole_mask = cuda.to_cpu(whole_mask)
-        labels = cuda.to_cpu(labels)
+        xp = cuda.get_array_module(rois)
+        bboxes = xp.asarray(bboxes)
+        labels = xp.asarray(labels)
 
         n_bbox, _ = bboxes.shape
 
-        rois = np.concatenate((rois, bboxes), axis=0)
+        rois = xp.concatenate((rois, bboxes), axis=0)
         if self.n_sample is None:
             n_sample = rois.shape[0]
         else:
@@ -50,56 +49,57 @@ class ProposalTargetCreator(object):
         max_iou = iou.max(axis=1)
 
         # Select foreground RoIs as those with >= fg_iou_thresh IoU.
-        fg_indices = np.where(max_iou >= self.fg_iou_thresh)[0]
+        fg_indices = xp.where(max_iou >= self.fg_iou_thresh)[0]
         fg_rois_per_this_image = int(min(fg_rois_per_image, fg_indices.size))
         if fg_indices.size > 0:
-            fg_indices = np.random.choice(
-                fg_indices, size=fg_rois_per_this_image, replace=False)
+            fg_indices = _random_choice(fg_indices, fg_rois_per_this_image)
 
         # Select background RoIs as those within
         # [bg_iou_thresh_lo, bg_iou_thresh_hi).
-        bg_indices = np.where((max_iou < self.bg_iou_thresh_hi) &
+        bg_indices = xp.where((max_iou < self.bg_iou_thresh_hi) &
                               (max_iou >= self.bg_iou_thresh_lo))[0]
         bg_rois_per_this_image = n_sample - fg_rois_per_this_image
         bg_rois_per_this_image = int(min(bg_rois_per_this_image,
                                          bg_indices.size))
         if bg_indices.size > 0:
-            bg_indices = np.random.choice(
-                bg_indices, size=bg_rois_per_this_image, replace=False)
+            bg_indices = _random_choice(bg_indices, bg_rois_per_this_image)
 
         # The indices that we're selecting (both foreground and background).
-        keep_indices = np.append(fg_indices, bg_indices)
+        keep_indices = xp.concatenate((fg_indices, bg_indices))
 
         # sample_rois
         sample_rois = rois[keep_indices]
 
         # locs
         # Compute offsets and scales to match sampled RoIs to the GTs.
-        loc_normalize_mean = np.array(self.loc_normalize_mean, np.float32)
-        loc_normalize_std = np.array(self.loc_normalize_std, np.float32)
+        loc_normalize_mean = xp.array(self.loc_normalize_mean, np.float32)
+        loc_normalize_std = xp.array(self.loc_normalize_std, np.float32)
         gt_roi_locs = bbox2loc(
             sample_rois, bboxes[gt_assignment[keep_indices]])
         gt_roi_locs = gt_roi_locs - loc_normalize_mean
         gt_roi_locs = gt_roi_locs / loc_normalize_std
 
         # masks
-        gt_roi_masks = -1 * np.ones(
+        gt_roi_masks = -1 * xp.ones(
             (len(keep_indices), self.mask_size, self.mask_size),
             dtype=np.int32)
 
-        for i, fg_index in enumerate(fg_indices):
-            roi = np.round(sample_rois[i]).astype(np.int32)
-            gt_roi = np.round(bboxes[gt_assignment[fg_index]])
-            gt_roi = gt_roi.astype(np.int32)
-            gt_mask = whole_mask[gt_assignment[fg_index]]
-            gt_roi_mask = fcis.mask.intersect_bbox_mask(
-                roi, gt_roi, gt_mask)
-            gt_roi_mask = cv2.resize(
-                gt_roi_mask, (self.mask_size, self.mask_size),
-                interpolation=cv2.INTER_NEAREST)
-            gt_roi_mask = gt_roi_mask >= self.binary_thresh
-            gt_roi_mask = gt_roi_mask.astype(np.int32)
-            gt_roi_masks[i, ...] = gt_roi_mask
+        # mask targets are created where whole_mask is,
+        # and only RoIs and targets are transferred.
+        if isinstance(whole_mask, list):
+            mask_xp = np
+        else:
+            mask_xp = cuda.get_array_module(whole_mask)
+        n_fg = len(fg_indices)
+        fg_rois = sample_rois[:n_fg].round().astype(np.int32)
+        fg_gt_indices = gt_assignment[fg_indices]
+        fg_gt_rois = bboxes[fg_gt_indices].round().astype(np.int32)
+        fg_roi_masks = _create_mask_targets(
+            _to_array_module(fg_rois, mask_xp),
+            _to_array_module(fg_gt_rois, mask_xp),
+            _to_array_module(fg_gt_indices, mask_xp),
+            whole_mask, self.mask_size, self.binary_thresh)
+        gt_roi_masks[:n_fg] = _to_array_module(fg_roi_masks, xp)
 
         # labels
         # The label with value 0 is the background.
@@ -108,9 +108,63 @@ class ProposalTargetCreator(object):
         # set labels of bg_rois to be 0
         gt_roi_labels[fg_rois_per_this_image:] = 0
 
-        sample_rois = cuda.to_gpu(sample_rois)
-        gt_roi_locs = cuda.to_gpu(gt_roi_locs)
-        gt_roi_masks = cuda.to_gpu(gt_roi_masks)
-        gt_roi_labels = cuda.to_gpu(gt_roi_labels)
-
         return sample_rois, gt_roi_locs, gt_roi_masks, gt_roi_labels
+
+
+def _random_choice(indices, size):
+    # same as np.random.choice(indices, size, replace=False),
+    # and the random state is shared by CPU and GPU.
+    xp = cuda.get_array_module(indices)
+    order = np.random.permutation(len(indices))[:size]
+    return indices[xp.asarray(order)]
+
+
+def _to_array_module(array, xp):
+    if xp is np:
+        return cuda.to_cpu(array)
+    return cuda.to_gpu(array)
+
+
+def _create_mask_targets(
+        rois, gt_rois, gt_indices, whole_mask, mask_size, binary_thresh):
+    # Equivalent to cropping each gt mask with intersect_bbox_mask,
+    # resizing it to (mask_size, mask_size) with cv2.INTER_NEAREST and
+    # thresholding it, but samples the gt masks directly.
+    # whole_mask is an array of shape (R, H, W) or a list of masks
+    # cropped with gt_rois.
+    xp = cuda.get_array_module(rois)
+    n_rois = len(rois)
+    gt_roi_masks = xp.zeros((n_rois, mask_size, mask_size), dtype=np.int32)
+    if n_rois == 0:
+        return gt_roi_masks
+
+    # same index mapping as cv2.INTER_NEAREST
+    grid = xp.arange(mask_size, dtype=np.float64)
+    roi_H = xp.maximum(rois[:, 2] - rois[:, 0], 1)
+    roi_W = xp.maximum(rois[:, 3] - rois[:, 1], 1)
+    ys = xp.floor(grid[None] * (1. / (mask_size / roi_H[:, None]))).astype(
+        np.int32)
+    xs = xp.floor(grid[None] * (1. / (mask_size / roi_W[:, None]))).astype(
+        np.int32)
+    ys = xp.minimum(ys, roi_H[:, None] - 1) + rois[:, 0:1]
+    xs = xp.minimum(xs, roi_W[:, None] - 1) + rois[:, 1:2]
+    # pixels outside of the gt box are background
+    valid = ((ys >= gt_rois[:, 0:1]) & (ys < gt_rois[:, 2:3]))[:, :, None] & \
+        ((xs >= gt_rois[:, 1:2]) & (xs < gt_rois[:, 3:4]))[:, None, :]
+
+    for gt_index in np.unique(cuda.to_cpu(gt_indices)):
+        indices = xp.where(gt_indices == gt_index)[0]
+        gt_mask = whole_mask[gt_index]
+        if isinstance(whole_mask, list):
+            # move to the coordinates of the cropped mask
+            offset_y, offset_x = cuda.to_cpu(gt_rois[indices[0], :2])
+        else:
+            offset_y, offset_x = 0, 0
+        mask_H, mask_W = gt_mask.shape
+        ys_i = xp.clip(ys[indices] - int(offset_y), 0, max(mask_H - 1, 0))
+        xs_i = xp.clip(xs[indices] - int(offset_x), 0, max(mask_W - 1, 0))
+        if mask_H == 0 or mask_W == 0:
+            continue
+        values = gt_mask[ys_i[:, :, None], xs_i[:, None, :]]
+        gt_roi_masks[indices] = (values >= binary_thresh) & valid[indices]
+    return gt_roi_masks
@@ -0,0 +1 @@
+from fcis.updaters.gradient_accumulation_updater import GradientAccumulationUpdater  # NOQA
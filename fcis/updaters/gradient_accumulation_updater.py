@@ -0,0 +1,169 @@
+import collections
+
+import chainer
+from chainer.dataset import convert
+import numpy as np
+
+
+_EpochState = collections.namedtuple(
+    '_EpochState',
+    ('epoch', 'is_new_epoch', 'epoch_detail', 'previous_epoch_detail'))
+
+
+class GradientAccumulationUpdater(chainer.training.updater.StandardUpdater):
+
+    """Updater accumulating gradients over iterations.
+
+    Gradients of :obj:`n_accumulation` batches are accumulated before
+    parameters are updated once, including optimizer hooks such as
+    weight decay. Each batch is still an iteration, so losses and
+    metrics are reported for each batch. The loss is divided by
+    :obj:`n_accumulation` so that gradients are averaged over batches.
+    Training should stop at a multiple of :obj:`n_accumulation`
+    iterations, as gradients of the batches after the last update are
+    not used.
+
+    If :obj:`overlap` is :obj:`True`, the next batch is loaded and
+    converted after the backward computation of the current batch is
+    queued, so that the host prepares it while the device computes.
+    Epochs are those of the batch being processed, and snapshots store
+    the iterator before the batch loaded ahead, so that it is loaded
+    again when the updater is resumed.
+
+    If :obj:`communicator` is given, gradients are averaged over
+    data-parallel processes before each update.
+
+    Args:
+        iterator: Dataset iterator for the training dataset.
+        optimizer: Optimizer to update parameters.
+        converter: Converter function to build input arrays.
+        device: Device to which the training data is sent.
+        loss_func: Loss function. The target link of the optimizer is
+            used by default.
+        n_accumulation (int): Number of batches per update.
+        overlap (bool): If :obj:`True`, the next batch is loaded
+            during the computation of the current batch.
+        communicator: Communicator of data-parallel processes, e.g.
+            :class:`~fcis.communicators.SharedMemoryCommunicator`.
+
+    """
+
+    def __init__(self, iterator, optimizer,
+                 converter=convert.concat_examples, device=None,
+                 loss_func=None, n_accumulation=1, overlap=False,
+                 communicator=None):
+        super(GradientAccumulationUpdater, self).__init__(
+            iterator, optimizer, converter=converter, device=device,
+            loss_func=loss_func)
+        if n_accumulation < 1:
+            raise ValueError('n_accumulation should be positive')
+        self.n_accumulation = n_accumulation
+        self.overlap = overlap
+        self.communicator = communicator
+        self._next = None
+        self._state = None
+        self._iterator_state = None
+
+    @property
+    def epoch(self):
+        if self._state is None:
+            return super(GradientAccumulationUpdater, self).epoch
+        return self._state.epoch
+
+    @property
+    def epoch_detail(self):
+        if self._state is None:
+            return super(GradientAccumulationUpdater, self).epoch_detail
+        return self._state.epoch_detail
+
+    @property
+    def previous_epoch_detail(self):
+        if self._state is None:
+            return super(
+                GradientAccumulationUpdater, self).previous_epoch_detail
+        return self._state.previous_epoch_detail
+
+    @property
+    def is_new_epoch(self):
+        if self._state is None:
+            return super(GradientAccumulationUpdater, self).is_new_epoch
+        return self._state.is_new_epoch
+
+    def update_core(self):
+        optimizer = self._optimizers['main']
+        loss_func = self.loss_func or optimizer.target
+
+        if self._next is None:
+            self._next = self._load()
+        in_arrays, self._state = self._next
+        self._next = None
+
+        if self.iteration % self.n_accumulation == 0:
+            optimizer.target.cleargrads()
+        if isinstance(in_arrays, tuple):
+            loss = loss_func(*in_arrays)
+        elif isinstance(in_arrays, dict):
+            loss = loss_func(**in_arrays)
+        else:
+            loss = loss_func(in_arrays)
+        loss = loss / self.n_accumulation
+        loss.backward()
+        del loss, in_arrays
+
+        iterator = self._iterators['main']
+        if self.overlap and (iterator.repeat or iterator.epoch == 0):
+            self._iterator_state = _save_state(iterator)
+            self._next = self._load()
+        else:
+            self._iterator_state = None
+
+        if (self.iteration + 1) % self.n_accumulation == 0:
+            if self.communicator is not None:
+                self.communicator.allreduce_grad(optimizer.target)
+            optimizer.update()
+
+    def serialize(self, serializer):
+        if isinstance(serializer, chainer.serializer.Deserializer):
+            super(GradientAccumulationUpdater, self).serialize(serializer)
+            self._next = None
+            self._state = None
+            self._iterator_state = None
+            return
+
+        iterators = self._iterators
+        if self._next is not None:
+            # the iterator is one batch ahead of the updater
+            self._iterators = dict(iterators)
+            self._iterators['main'] = _IteratorState(self._iterator_state)
+        try:
+            super(GradientAccumulationUpdater, self).serialize(serializer)
+        finally:
+            self._iterators = iterators
+
+    def _load(self):
+        iterator = self._iterators['main']
+        batch = iterator.next()
+        state = _EpochState(
+            iterator.epoch, iterator.is_new_epoch,
+            iterator.epoch_detail, iterator.previous_epoch_detail)
+        return self.converter(batch, self.device), state
+
+
+class _IteratorState(object):
+
+    # stand-in serializing a saved state of an iterator
+
+    def __init__(self, state):
+        self.state = state
+
+    def serialize(self, serializer):
+        for key, value in self.state.items():
+            serializer(key, value)
+
+
+def _save_state(iterator):
+    serializer = chainer.serializers.DictionarySerializer()
+    iterator.serialize(serializer)
+    # arrays may be updated in place by the iterator
+    return dict((key, np.array(value))
+                for key, value in serializer.target.items())
@@ -2,6 +2,7 @@ import cv2
 import fcn
 import matplotlib.pyplot as plt
 import numpy as np
+import six
 
 
 def visualize_mask(
@@ -83,6 +84,114 @@ def whole_mask2mask(whole_mask, bbox):
     return mask
 
 
+def rle2mask(rle, bbox):
+    """Decode COCO compressed RLEs only inside of bounding boxes.
+
+    Args:
+        rle (list of dicts): [{'size': [H, W], 'counts': bytes}, ...]
+        bbox (array): Array of shape (R, 4)
+
+    Returns:
+        [(H_1, W_1), ..., (H_R, W_R)]
+
+    """
+    if len(rle) != len(bbox):
+        raise ValueError('The length of rle and bbox should be the same')
+    mask = list()
+    for r, bb in zip(rle, bbox):
+        H, _ = r['size']
+        y_min, x_min, y_max, x_max = np.round(bb).astype(np.int32)
+        # RLE runs are in column-major order and alternate 0s and 1s.
+        # Only the columns covered by the box are decoded.
+        start = x_min * H
+        end = max(x_max * H, start)
+        counts = _rle_counts(r['counts'])
+        run_ends = np.cumsum(counts)
+        run_starts = run_ends - counts
+        run_starts = np.clip(run_starts[1::2], start, end) - start
+        run_ends = np.clip(run_ends[1::2], start, end) - start
+        delta = np.zeros(end - start + 1, dtype=np.int32)
+        np.add.at(delta, run_starts, 1)
+        np.add.at(delta, run_ends, -1)
+        m = np.cumsum(delta[:-1]) > 0
+        m = m.reshape((-1, H)).T[y_min:y_max]
+        mask.append(np.ascontiguousarray(m))
+    return mask
+
+
+def _rle_counts(counts):
+    # Python version of rleFrString in pycocotools/maskApi.c
+    if not isinstance(counts, bytes):
+        counts = counts.encode('ascii')
+    cnts = []
+    p = 0
+    while p < len(counts):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = six.indexbytes(counts, p) - 48
+            x |= (c & 0x1f) << 5 * k
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << 5 * k
+        if len(cnts) > 2:
+            x += cnts[-2]
+        cnts.append(x)
+    return np.array(cnts, dtype=np.int64)
+
+
+def resize_mask(mask, bbox, size, out_bbox, out_size, x_flip=False):
+    """Resize list representation of instance masks.
+
+    This is equivalent to converting :obj:`mask` to an image-sized array,
+    resizing it to :obj:`out_size` with nearest neighbor interpolation,
+    flipping it and cropping it with :obj:`out_bbox`, without allocating
+    image-sized arrays. Pixels outside of :obj:`bbox` are background.
+
+    Args:
+        mask (list): [(H_1, W_1), ..., (H_R, W_R)]
+        bbox (array): Array of shape (R, 4)
+        size (tuple of ints): (H, W)
+        out_bbox (array): Array of shape (R, 4) in the resized image
+        out_size (tuple of ints): Size of the resized image
+        x_flip (bool): Flip horizontally after resizing
+
+    Returns:
+        list of masks cropped with :obj:`out_bbox`
+
+    """
+    if len(mask) != len(bbox) or len(mask) != len(out_bbox):
+        raise ValueError(
+            'The length of mask, bbox and out_bbox should be the same')
+    H, W = size
+    out_H, out_W = out_size
+    # same index mapping as cv2.INTER_NEAREST
+    scale_y = 1. / (out_H / float(H))
+    scale_x = 1. / (out_W / float(W))
+    out_mask = list()
+    for m, bb, out_bb in zip(mask, bbox, out_bbox):
+        bb = np.round(bb).astype(np.int32)
+        out_bb = np.round(out_bb).astype(np.int32)
+        ys = np.arange(out_bb[0], out_bb[2])
+        xs = np.arange(out_bb[1], out_bb[3])
+        if x_flip:
+            xs = out_W - 1 - xs
+        ys = np.minimum(np.floor(ys * scale_y).astype(np.int32), H - 1)
+        xs = np.minimum(np.floor(xs * scale_x).astype(np.int32), W - 1)
+        ys = ys - bb[0]
+        xs = xs - bb[1]
+        valid_y = np.where((ys >= 0) & (ys < m.shape[0]))[0]
+        valid_x = np.where((xs >= 0) & (xs < m.shape[1]))[0]
+        out_m = np.zeros((len(ys), len(xs)), dtype=m.dtype)
+        out_m[np.ix_(valid_y, valid_x)] = \
+            m[np.ix_(ys[valid_y], xs[valid_x])]
+        out_mask.append(out_m)
+    return out_mask
+
+
 def whole_mask2label_mask(mask):
     _, H, W = mask.shape
     label_mask = np.zeros((H, W), dtype=np.int32)
@@ -0,0 +1,88 @@
+import multiprocessing
+import unittest
+
+import numpy
+
+import chainer
+from chainer import testing
+
+from fcis.communicators import create_communicator
+
+
+class _Model(object):
+
+    def __init__(self, seed):
+        random_state = numpy.random.RandomState(seed)
+        self.params = {}
+        for name, shape in [('/a', (3, 4)), ('/b', (5,)), ('/c', (2, 2))]:
+            param = chainer.Parameter(
+                random_state.uniform(size=shape).astype(numpy.float32))
+            param.grad = random_state.uniform(
+                size=shape).astype(numpy.float32)
+            self.params[name] = param
+
+    def namedparams(self):
+        return list(self.params.items())
+
+
+def _run(comm, rank, queue):
+    comm.setup(rank)
+    random_state = numpy.random.RandomState(rank)
+    array = random_state.uniform(size=(7, 5)).astype(numpy.float32)
+    comm.allreduce(array)
+
+    model = _Model(rank)
+    comm.allreduce_grad(model)
+    grads = dict((name, param.grad) for name, param in model.namedparams())
+
+    model = _Model(rank)
+    comm.bcast_data(model)
+    data = dict((name, param.data) for name, param in model.namedparams())
+    comm.finalize()
+    queue.put((rank, array, grads, data))
+
+
+@testing.parameterize(
+    {'name': 'shared_memory', 'kwargs': {'chunk_size': 8}},
+    {'name': 'tcp', 'kwargs': {}},
+)
+class TestCommunicator(unittest.TestCase):
+
+    def setUp(self):
+        self.size = 2
+        self.comm = create_communicator(
+            self.name, self.size, **self.kwargs)
+
+    def test_communicator(self):
+        queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_run, args=(self.comm, rank, queue))
+            for rank in range(self.size)]
+        for process in processes:
+            process.start()
+        results = dict(
+            (result[0], result[1:])
+            for result in [queue.get(timeout=60) for _ in processes])
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        expected_array = numpy.mean(
+            [numpy.random.RandomState(rank).uniform(size=(7, 5))
+             for rank in range(self.size)], axis=0)
+        models = [_Model(rank) for rank in range(self.size)]
+        for rank in range(self.size):
+            array, grads, data = results[rank]
+            numpy.testing.assert_allclose(
+                array, expected_array, rtol=1e-6)
+            for name, _ in models[0].namedparams():
+                expected_grad = numpy.mean(
+                    [model.params[name].grad for model in models], axis=0)
+                numpy.testing.assert_allclose(
+                    grads[name], expected_grad, rtol=1e-6)
+                numpy.testing.assert_equal(
+                    data[name], models[0].params[name].data)
+
+
+testing.run_module(__name__, __file__)
@@ -0,0 +1,48 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from chainer import testing
+
+from fcis.dataset import LRUCache
+from fcis.dataset import MemmapCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_lru_cache(self):
+        cache = LRUCache(250)
+        for key in range(3):
+            cache.put(key, numpy.zeros((100,), dtype=numpy.uint8))
+        # the least recently used value is evicted
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 200)
+        self.assertIsNone(cache.get(0))
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNotNone(cache.get(2))
+
+
+class TestLRUCacheMemmap(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_lru_cache_memmap(self):
+        # memory-mapped arrays are not counted in the budget
+        cache = LRUCache(250, next_cache=MemmapCache(self.cache_dir))
+        for key in range(3):
+            cache.put(key, numpy.zeros((100,), dtype=numpy.uint8))
+        cache = LRUCache(250, next_cache=cache.next_cache)
+        for key in range(3):
+            value = cache.get(key)
+            self.assertIsInstance(value, numpy.memmap)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 0)
+
+
+testing.run_module(__name__, __file__)
@@ -0,0 +1,61 @@
+import unittest
+
+import numpy
+
+from chainer import testing
+
+from fcis.dataset import concat_examples
+
+
+def _create_example(H, W, n_bbox):
+    img = numpy.random.uniform(size=(3, H, W)).astype(numpy.float32)
+    bboxes = numpy.random.uniform(size=(n_bbox, 4)).astype(numpy.float32)
+    whole_mask = numpy.random.uniform(size=(n_bbox, H, W)) > 0.5
+    labels = numpy.random.randint(1, 10, size=n_bbox).astype(numpy.int32)
+    return img, bboxes, whole_mask, labels, 1.5
+
+
+class TestConcatExamples(unittest.TestCase):
+
+    def test_concat_examples(self):
+        batch = [_create_example(30, 40, 2), _create_example(35, 20, 3)]
+        x, bboxes, whole_mask, labels, scales, n_bboxes, img_sizes = \
+            concat_examples(batch, stride=16)
+
+        self.assertEqual(x.shape, (2, 3, 48, 48))
+        self.assertEqual(whole_mask.shape, (2, 3, 48, 48))
+        numpy.testing.assert_equal(n_bboxes, (2, 3))
+        numpy.testing.assert_equal(img_sizes, ((30, 40), (35, 20)))
+        for i, (img, bbox, mask, label, _) in enumerate(batch):
+            H, W = img.shape[1:]
+            expected = numpy.zeros((3, 48, 48), dtype=numpy.float32)
+            expected[:, :H, :W] = img
+            numpy.testing.assert_equal(x[i], expected)
+            numpy.testing.assert_equal(bboxes[i, :len(bbox)], bbox)
+            numpy.testing.assert_equal(whole_mask[i, :len(bbox), :H, :W], mask)
+            expected = -numpy.ones((3,), dtype=numpy.int32)
+            expected[:len(bbox)] = label
+            numpy.testing.assert_equal(labels[i], expected)
+        numpy.testing.assert_equal(scales, (1.5, 1.5))
+
+    def test_concat_examples_single(self):
+        # a batch of one image is not padded
+        batch = [_create_example(30, 40, 2)]
+        x, _, whole_mask, _, _, _, img_sizes = concat_examples(
+            batch, stride=16)
+
+        self.assertEqual(x.shape, (1, 3, 30, 40))
+        self.assertEqual(whole_mask.shape, (1, 2, 30, 40))
+        numpy.testing.assert_equal(x[0], batch[0][0])
+        numpy.testing.assert_equal(img_sizes, ((30, 40),))
+
+    def test_concat_examples_keys(self):
+        batch = [_create_example(30, 40, 2) + ((1, True),),
+                 _create_example(30, 40, 1) + ((2, False),)]
+        out = concat_examples(batch)
+
+        self.assertEqual(len(out), 8)
+        self.assertEqual(out[7], [(1, True), (2, False)])
+
+
+testing.run_module(__name__, __file__)
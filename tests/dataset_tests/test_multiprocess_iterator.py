@@ -0,0 +1,50 @@
+import unittest
+
+import numpy
+
+import chainer
+from chainer import testing
+
+from fcis.dataset import MultiprocessIterator
+
+
+@testing.parameterize(*testing.product({
+    'aspect_grouping': [False, True],
+}))
+class TestMultiprocessIteratorSerialize(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset = numpy.arange(23, dtype=numpy.float32)
+        self.img_sizes = None
+        if self.aspect_grouping:
+            self.img_sizes = numpy.random.randint(10, 50, size=(23, 2))
+
+    def _create_iterator(self):
+        return MultiprocessIterator(
+            self.dataset, 3, shuffle=False, n_processes=2, n_prefetch=3,
+            img_sizes=self.img_sizes)
+
+    def test_serialize(self):
+        it = self._create_iterator()
+        for _ in range(5):
+            it.next()
+        epoch_detail = it.epoch_detail
+        serializer = chainer.serializers.DictionarySerializer()
+        it.serialize(serializer)
+        # saving does not change the state
+        self.assertEqual(it.epoch_detail, epoch_detail)
+        expected = [it.next() for _ in range(6)]
+        it.finalize()
+
+        # prefetched batches are loaded again
+        it = self._create_iterator()
+        it.serialize(chainer.serializers.NpzDeserializer(serializer.target))
+        self.assertEqual(it.epoch_detail, epoch_detail)
+        batches = [it.next() for _ in range(6)]
+        it.finalize()
+        for batch, expected_batch in zip(batches, expected):
+            numpy.testing.assert_equal(
+                numpy.array(batch), numpy.array(expected_batch))
+
+
+testing.run_module(__name__, __file__)
@@ -0,0 +1,40 @@
+import unittest
+
+import numpy
+
+from chainer import testing
+
+from fcis.dataset import scatter_dataset
+
+
+class _Communicator(object):
+
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+
+@testing.parameterize(*testing.product({
+    'n_example': [10, 11],
+    'size': [1, 2, 3],
+}))
+class TestScatterDataset(unittest.TestCase):
+
+    def test_scatter_dataset(self):
+        dataset = numpy.arange(self.n_example)
+        shards = []
+        for rank in range(self.size):
+            shard, indices = scatter_dataset(
+                dataset, _Communicator(rank, self.size), seed=0,
+                return_indices=True)
+            self.assertEqual(len(shard), self.n_example // self.size)
+            numpy.testing.assert_equal(
+                [shard[i] for i in range(len(shard))], dataset[indices])
+            shards.append(indices)
+        shards = numpy.concatenate(shards)
+        self.assertEqual(len(numpy.unique(shards)), len(shards))
+        self.assertGreaterEqual(
+            len(shards), self.n_example - self.size + 1)
+
+
+testing.run_module(__name__, __file__)
@@ -0,0 +1,122 @@
+import json
+import os
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from chainer import testing
+
+from fcis.datasets.coco import COCOInstanceSegmentationDataset
+from fcis.datasets.coco.coco_annotation_index import _file_hash
+
+
+def _create_annotations(n_img, n_cat):
+    images = []
+    annotations = []
+    for img_id in range(1, n_img + 1):
+        H = numpy.random.randint(20, 40)
+        W = numpy.random.randint(20, 40)
+        images.append({'id': img_id, 'height': H, 'width': W,
+                       'file_name': '{}.jpg'.format(img_id)})
+        # some images have no annotations
+        for _ in range(numpy.random.randint(0, 4)):
+            y_min, x_min = numpy.random.uniform(0, 10, size=2)
+            y_max = y_min + numpy.random.uniform(2, H - 10)
+            x_max = x_min + numpy.random.uniform(2, W - 10)
+            annotations.append({
+                'id': len(annotations) + 1,
+                'image_id': img_id,
+                'category_id': numpy.random.randint(1, n_cat + 1) * 2,
+                'iscrowd': int(numpy.random.uniform() < 0.2),
+                'area': float((y_max - y_min) * (x_max - x_min)),
+                'bbox': [x_min, y_min, x_max - x_min, y_max - y_min],
+                'segmentation': [[x_min, y_min, x_max, y_min,
+                                  x_max, y_max, x_min, y_max]],
+            })
+    categories = [{'id': (k + 1) * 2, 'name': str(k)}
+                  for k in range(n_cat)]
+    return {'images': images, 'annotations': annotations,
+            'categories': categories}
+
+
+@testing.parameterize(*testing.product({
+    'mask_format': ['whole', 'bbox', 'rle'],
+}))
+class TestCOCOAnnotationIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        os.makedirs(osp.join(self.data_dir, 'annotations'))
+        anno = _create_annotations(8, 3)
+        with open(osp.join(self.data_dir, 'annotations',
+                           'instances_train2014.json'), 'w') as f:
+            json.dump(anno, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def _check_annotations(self, dataset, index_dataset):
+        self.assertEqual(dataset.ids, index_dataset.ids)
+        for i in range(len(dataset)):
+            values = dataset._get_annotations(i)
+            index_values = index_dataset._get_annotations(i)
+            for value, index_value in zip(values, index_values):
+                if isinstance(value, list):
+                    self.assertEqual(len(value), len(index_value))
+                    for v, index_v in zip(value, index_value):
+                        if isinstance(v, dict):
+                            self.assertEqual(v['counts'], index_v['counts'])
+                        else:
+                            numpy.testing.assert_equal(v, index_v)
+                else:
+                    numpy.testing.assert_equal(value, index_value)
+
+    def test_annotation_index(self):
+        dataset = COCOInstanceSegmentationDataset(
+            data_dir=self.data_dir, mask_format=self.mask_format)
+        index_dataset = COCOInstanceSegmentationDataset(
+            data_dir=self.data_dir, mask_format=self.mask_format,
+            use_annotation_index=True)
+        dataset.ids = sorted(dataset.ids)
+        self._check_annotations(dataset, index_dataset)
+
+    def test_annotation_index_filtered_ids(self):
+        dataset = COCOInstanceSegmentationDataset(
+            data_dir=self.data_dir, mask_format=self.mask_format)
+        index_dataset = COCOInstanceSegmentationDataset(
+            data_dir=self.data_dir, mask_format=self.mask_format,
+            use_annotation_index=True)
+        # ids are filtered and reordered as in remove_zero_bbox
+        ids = [2, 5, 8, 1, 4]
+        dataset.ids = ids
+        index_dataset.ids = list(ids)
+        self._check_annotations(dataset, index_dataset)
+
+
+class TestFileHash(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        with open(self.path, 'wb') as f:
+            f.write(b'a' * 100)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_file_hash_modified(self):
+        # the middle of the file is not read, but it is
+        # not modified without updating the modification time
+        os.utime(self.path, (1000000000, 1000000000))
+        file_hash = _file_hash(self.path, chunk_size=10)
+        self.assertEqual(_file_hash(self.path, chunk_size=10), file_hash)
+        with open(self.path, 'wb') as f:
+            f.write(b'a' * 50 + b'b' + b'a' * 49)
+        os.utime(self.path, (1000000001, 1000000001))
+        self.assertNotEqual(_file_hash(self.path, chunk_size=10), file_hash)
+
+
+testing.run_module(__name__, __file__)
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from chainer import testing
+
+from fcis.datasets.sbd.sbd_annotation_index import load_annotation_index
+from fcis.datasets.voc.voc_utils import prepare_data
+
+
+class _Dataset(object):
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.n_load = 0
+
+    def _load_data(self, data_id):
+        self.n_load += 1
+        random_state = numpy.random.RandomState(int(data_id))
+        H, W = random_state.randint(20, 40, size=2)
+        seg_img = numpy.zeros((H, W), dtype=numpy.int32)
+        ins_img = -numpy.ones((H, W), dtype=numpy.int32)
+        for inst in range(random_state.randint(0, 4)):
+            y, x = random_state.randint(0, 15, size=2)
+            h, w = random_state.randint(1, 8, size=2)
+            ins_img[y:y + h, x:x + w] = inst
+            seg_img[y:y + h, x:x + w] = random_state.randint(1, 21)
+        return None, seg_img, ins_img
+
+
+class TestSBDAnnotationIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.index_root)
+
+    def test_load_annotation_index(self):
+        dataset = _Dataset(['3', '1', '4', '5'])
+        index = load_annotation_index(dataset, self.index_root)
+        self.assertEqual(index['ids'].tolist(), dataset.ids)
+        for k, data_id in enumerate(dataset.ids):
+            _, seg_img, ins_img = dataset._load_data(data_id)
+            bboxes, masks, labels = prepare_data(seg_img, ins_img)
+            self.assertEqual(index['heights'][k], ins_img.shape[0])
+            self.assertEqual(index['widths'][k], ins_img.shape[1])
+            start, end = index['offsets'][k:k + 2]
+            numpy.testing.assert_equal(index['bboxes'][start:end], bboxes)
+            numpy.testing.assert_equal(index['labels'][start:end], labels)
+            for j, (bbox, mask) in enumerate(zip(bboxes, masks)):
+                bits = index['mask_bits'][
+                    index['mask_offsets'][start + j]:
+                    index['mask_offsets'][start + j + 1]]
+                y_min, x_min, y_max, x_max = bbox
+                numpy.testing.assert_equal(
+                    bits, numpy.packbits(mask[y_min:y_max, x_min:x_max]))
+
+    def test_load_annotation_index_ids(self):
+        # the index is reused only for the same ids
+        dataset = _Dataset(['3', '1', '4'])
+        load_annotation_index(dataset, self.index_root)
+        n_load = dataset.n_load
+        load_annotation_index(dataset, self.index_root)
+        self.assertEqual(dataset.n_load, n_load)
+
+        dataset = _Dataset(['3', '1', '5'])
+        index = load_annotation_index(dataset, self.index_root)
+        self.assertEqual(index['ids'].tolist(), dataset.ids)
+        self.assertEqual(len(os.listdir(self.index_root)), 2)
+
+
+testing.run_module(__name__, __file__)
@@ -0,0 +1,82 @@
+import collections
+import unittest
+
+import numpy
+
+from chainer import testing
+
+from fcis.datasets.voc.voc_utils import prepare_data
+
+
+def _prepare_data_loop(seg_img, ins_img):
+    # previous implementation
+    labels = []
+    bboxes = []
+    masks = []
+    instances = numpy.unique(ins_img)
+    for inst in instances[instances != -1]:
+        mask_inst = ins_img == inst
+        count = collections.Counter(seg_img[mask_inst].tolist())
+        instance_class = max(count.items(), key=lambda x: x[1])[0]
+        where = numpy.argwhere(mask_inst)
+        (y1, x1), (y2, x2) = where.min(0), where.max(0) + 1
+        labels.append(instance_class)
+        bboxes.append((y1, x1, y2, x2))
+        masks.append(mask_inst)
+    return numpy.array(bboxes), numpy.array(masks), numpy.array(labels)
+
+
+@testing.parameterize(*testing.product({
+    # instances of two classes often tie
+    'n_class': [2, 20],
+    'n_inst': [0, 1, 6],
+    'return_mask': [True, False],
+}))
+class TestPrepareData(unittest.TestCase):
+
+    def setUp(self):
+        H, W = 30, 40
+        self.seg_img = numpy.zeros((H, W), dtype=numpy.int32)
+        self.ins_img = -numpy.ones((H, W), dtype=numpy.int32)
+        # instance ids are not contiguous, and later instances
+        # may hide earlier ones
+        for inst in numpy.random.choice(20, self.n_inst, replace=False):
+            y, x = numpy.random.randint(0, 25), numpy.random.randint(0, 35)
+            h, w = numpy.random.randint(1, 8, size=2)
+            self.ins_img[y:y + h, x:x + w] = inst
+            self.seg_img[y:y + h, x:x + w] = numpy.random.randint(
+                1, self.n_class + 1, size=(h, w))[:H - y, :W - x]
+        # boundaries are ignored
+        boundary = numpy.random.uniform(size=(H, W)) < 0.1
+        self.seg_img[boundary] = -1
+        self.ins_img[boundary] = -1
+
+    def test_prepare_data(self):
+        out = prepare_data(
+            self.seg_img, self.ins_img, return_mask=self.return_mask)
+        bboxes, masks, labels = _prepare_data_loop(
+            self.seg_img, self.ins_img)
+
+        if self.return_mask:
+            out_bboxes, out_masks, out_labels = out
+        else:
+            self.assertEqual(len(out), 2)
+            out_bboxes, out_labels = out
+
+        if len(labels) == 0:
+            self.assertEqual(out_bboxes.shape, (0, 4))
+            self.assertEqual(out_labels.shape, (0,))
+            if self.return_mask:
+                self.assertEqual(out_masks.shape, (0,) + self.ins_img.shape)
+            return
+
+        self.assertEqual(out_bboxes.dtype, bboxes.dtype)
+        self.assertEqual(out_labels.dtype, labels.dtype)
+        numpy.testing.assert_equal(out_bboxes, bboxes)
+        numpy.testing.assert_equal(out_labels, labels)
+        if self.return_mask:
+            self.assertEqual(out_masks.dtype, masks.dtype)
+            numpy.testing.assert_equal(out_masks, masks)
+
+
+testing.run_module(__name__, __file__)
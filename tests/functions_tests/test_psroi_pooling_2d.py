@@ -12,6 +12,43 @@ from chainer.testing import condition
 from fcis import functions
 
 
+def _psroi_pooling_2d_loop(x, rois, outh, outw, spatial_scale,
+                           group_size, output_dim):
+    # port of the cuda kernel
+    height, width = x.shape[2:]
+    y = numpy.zeros(
+        (len(rois), output_dim, outh, outw), dtype=numpy.float32)
+    for n, roi in enumerate(rois):
+        roi_batch_ind = int(roi[0])
+        roi_start_w, roi_start_h, roi_end_w, roi_end_h = \
+            numpy.round(roi[1:]) * spatial_scale
+        roi_width = max(roi_end_w - roi_start_w, 0.1)
+        roi_height = max(roi_end_h - roi_start_h, 0.1)
+        bin_size_h = roi_height / outh
+        bin_size_w = roi_width / outw
+        for ctop in range(output_dim):
+            for ph in range(outh):
+                for pw in range(outw):
+                    hstart = int(numpy.floor(ph * bin_size_h + roi_start_h))
+                    wstart = int(numpy.floor(pw * bin_size_w + roi_start_w))
+                    hend = int(numpy.ceil(
+                        (ph + 1) * bin_size_h + roi_start_h))
+                    wend = int(numpy.ceil(
+                        (pw + 1) * bin_size_w + roi_start_w))
+                    hstart = min(max(hstart, 0), height)
+                    hend = min(max(hend, 0), height)
+                    wstart = min(max(wstart, 0), width)
+                    wend = min(max(wend, 0), width)
+                    if hend <= hstart or wend <= wstart:
+                        continue
+                    gh = min(ph * group_size // outh, group_size - 1)
+                    gw = min(pw * group_size // outw, group_size - 1)
+                    c = (ctop * group_size + gh) * group_size + gw
+                    y[n, ctop, ph, pw] = x[
+                        roi_batch_ind, c, hstart:hend, wstart:wend].mean()
+    return y
+
+
 class TestPSROIPolling2D(unittest.TestCase):
 
     def setUp(self):
@@ -29,7 +66,8 @@ class TestPSROIPolling2D(unittest.TestCase):
             [0, 1, 1, 6, 6],
             [2, 6, 2, 7, 11],
             [1, 3, 1, 5, 10],
-            [0, 3, 3, 3, 3]
+            [0, 3, 3, 3, 3],
+            [2, -4, 25, 45, 35]
         ])
         self.rois = self.rois.astype(numpy.float32)
         self.n_rois = self.rois.shape[0]
@@ -51,11 +89,69 @@ class TestPSROIPolling2D(unittest.TestCase):
         self.assertEqual(
             (self.n_rois, self.output_dim, self.outh, self.outw), y_data.shape)
 
+    @condition.retry(3)
+    def test_forward_cpu(self):
+        self.check_forward(self.x, self.rois)
+
+    def test_forward_cpu_value(self):
+        y = functions.psroi_pooling_2d(
+            self.x, self.rois, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+        expected = _psroi_pooling_2d_loop(
+            self.x, self.rois, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+        testing.assert_allclose(y.data, expected)
+
     @attr.gpu
     @condition.retry(3)
     def test_forward_gpu(self):
         self.check_forward(cuda.to_gpu(self.x), cuda.to_gpu(self.rois))
 
+    @attr.gpu
+    def test_forward_cpu_gpu_equal(self):
+        x_cpu = chainer.Variable(self.x)
+        rois_cpu = chainer.Variable(self.rois)
+        y_cpu = functions.psroi_pooling_2d(
+            x_cpu, rois_cpu, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+
+        x_gpu = chainer.Variable(cuda.to_gpu(self.x))
+        rois_gpu = chainer.Variable(cuda.to_gpu(self.rois))
+        y_gpu = functions.psroi_pooling_2d(
+            x_gpu, rois_gpu, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+        testing.assert_allclose(y_cpu.data, cuda.to_cpu(y_gpu.data))
+
+    def check_forward_integral_image(self, x_data, roi_data):
+        x = chainer.Variable(x_data)
+        rois = chainer.Variable(roi_data)
+        y = functions.psroi_pooling_2d(
+            x, rois, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim)
+        y_integral = functions.psroi_pooling_2d(
+            x, rois, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim,
+            use_integral_image=True)
+        self.assertEqual(y_integral.data.dtype, numpy.float32)
+        testing.assert_allclose(
+            cuda.to_cpu(y.data), cuda.to_cpu(y_integral.data))
+
+        # the summed-area table can be computed beforehand
+        y_table = functions.psroi_pooling_2d(
+            x, rois, self.outh, self.outw,
+            self.spatial_scale, self.group_size, self.output_dim,
+            use_integral_image=True, table=functions.integral_image(x))
+        testing.assert_allclose(
+            cuda.to_cpu(y_integral.data), cuda.to_cpu(y_table.data))
+
+    def test_forward_integral_image_cpu(self):
+        self.check_forward_integral_image(self.x, self.rois)
+
+    @attr.gpu
+    def test_forward_integral_image_gpu(self):
+        self.check_forward_integral_image(
+            cuda.to_gpu(self.x), cuda.to_gpu(self.rois))
+
     def check_backward(self, x_data, roi_data, y_grad):
         gradient_check.check_backward(
             functions.PSROIPooling2D(
@@ -64,11 +160,25 @@ class TestPSROIPolling2D(unittest.TestCase):
             (x_data, roi_data), y_grad, no_grads=[False, True],
             **self.check_backward_options)
 
+    @condition.retry(3)
+    def test_backward_cpu(self):
+        self.check_backward(self.x, self.rois, self.gy)
+
     @attr.gpu
     @condition.retry(3)
     def test_backward_gpu(self):
         self.check_backward(cuda.to_gpu(self.x), cuda.to_gpu(self.rois),
                             cuda.to_gpu(self.gy))
 
+    @condition.retry(3)
+    def test_backward_integral_image_cpu(self):
+        gradient_check.check_backward(
+            functions.PSROIPooling2D(
+                self.outh, self.outw,
+                self.spatial_scale, self.group_size, self.output_dim,
+                use_integral_image=True),
+            (self.x, self.rois), self.gy, no_grads=[False, True],
+            **self.check_backward_options)
+
 
 testing.run_module(__name__, __file__)
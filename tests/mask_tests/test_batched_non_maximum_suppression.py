@@ -0,0 +1,55 @@
+import unittest
+
+import numpy
+
+from chainer import testing
+from chainercv.utils import bbox_iou
+from chainercv.utils import non_maximum_suppression
+
+from fcis.mask import batched_non_maximum_suppression
+
+
+@testing.parameterize(*testing.product({
+    'thresh': [0.3, 0.7],
+    'limit': [None, 5],
+    'score_tie': [False, True],
+}))
+class TestBatchedNonMaximumSuppression(unittest.TestCase):
+
+    def setUp(self):
+        self.n_bbox = 60
+        self.n_class = 4
+        y_min = numpy.random.uniform(0, 40, size=self.n_bbox)
+        x_min = numpy.random.uniform(0, 40, size=self.n_bbox)
+        self.bbox = numpy.stack((
+            y_min, x_min,
+            y_min + numpy.random.uniform(5, 20, size=self.n_bbox),
+            x_min + numpy.random.uniform(5, 20, size=self.n_bbox)),
+            axis=1).astype(numpy.float32)
+        self.scores = numpy.random.uniform(
+            size=(self.n_bbox, self.n_class)).astype(numpy.float32)
+        if self.score_tie:
+            # tied scores are ordered as non_maximum_suppression does
+            self.scores = numpy.round(self.scores * 5) / 5
+        self.scores[self.scores < 0.2] = 0
+
+    def test_batched_non_maximum_suppression(self):
+        iou = bbox_iou(self.bbox, self.bbox)
+        indices, labels = batched_non_maximum_suppression(
+            iou, self.scores, self.thresh, score_thresh=0.001,
+            limit=self.limit)
+
+        for label in range(self.n_class):
+            score_l = self.scores[:, label]
+            thresh_indices = numpy.where(score_l >= 0.001)[0]
+            expected = non_maximum_suppression(
+                self.bbox[thresh_indices], self.thresh,
+                score_l[thresh_indices], limit=self.limit)
+            numpy.testing.assert_equal(
+                indices[labels == label], thresh_indices[expected])
+
+        # sorted by class
+        numpy.testing.assert_equal(labels, numpy.sort(labels))
+
+
+testing.run_module(__name__, __file__)
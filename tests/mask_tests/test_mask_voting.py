@@ -0,0 +1,127 @@
+import unittest
+
+import cv2
+import numpy
+
+from chainer import testing
+from chainercv.utils import bbox_iou
+from chainercv.utils import non_maximum_suppression
+
+from fcis.mask import mask_aggregation
+from fcis.mask import mask_voting
+
+
+def _mask_voting_loop(
+        rois, mask_probs, cls_probs, n_class, H, W,
+        score_thresh, nms_thresh, mask_merge_thresh, binary_thresh):
+    # previous implementation
+    mask_size = mask_probs.shape[-1]
+    v_labels = numpy.empty((0, ), dtype=numpy.int32)
+    v_masks = numpy.empty((0, mask_size, mask_size), dtype=numpy.float32)
+    v_bboxes = numpy.empty((0, 4), dtype=numpy.float32)
+    v_cls_probs = numpy.empty((0, ), dtype=numpy.float32)
+
+    for label in range(1, n_class):
+        cls_prob_l = cls_probs[:, label]
+        thresh_mask = cls_prob_l >= 0.001
+        bbox_l = rois[thresh_mask]
+        cls_prob_l = cls_prob_l[thresh_mask]
+        keep = non_maximum_suppression(
+            bbox_l, nms_thresh, cls_prob_l, limit=100)
+        bbox_l = bbox_l[keep]
+        cls_prob_l = cls_prob_l[keep]
+
+        n_bbox_l = len(bbox_l)
+        v_mask_l = numpy.zeros((n_bbox_l, mask_size, mask_size))
+        v_bbox_l = numpy.zeros((n_bbox_l, 4))
+        for i, bbox in enumerate(bbox_l):
+            iou = bbox_iou(rois, bbox[numpy.newaxis, :])
+            idx = numpy.where(iou > mask_merge_thresh)[0]
+            mask_weights = cls_probs[idx, label]
+            mask_weights = mask_weights / mask_weights.sum()
+            v_bbox_l[i], clipped_mask = mask_aggregation(
+                rois[idx], mask_probs[idx], mask_weights, H, W,
+                binary_thresh)
+            v_mask_l[i] = cv2.resize(
+                clipped_mask.astype(numpy.float32), (mask_size, mask_size))
+
+        score_thresh_mask = cls_prob_l > score_thresh
+        v_masks = numpy.concatenate((v_masks, v_mask_l[score_thresh_mask]))
+        v_bboxes = numpy.concatenate(
+            (v_bboxes, v_bbox_l[score_thresh_mask]))
+        v_labels = numpy.concatenate((v_labels, numpy.repeat(
+            label, score_thresh_mask.sum())))
+        v_cls_probs = numpy.concatenate(
+            (v_cls_probs, cls_prob_l[score_thresh_mask]))
+    return v_bboxes, v_masks, v_labels, v_cls_probs
+
+
+@testing.parameterize(
+    # mask_type: 'random', 'tie' (values equal to binary_thresh)
+    # or 'empty' (no pixels over binary_thresh)
+    *testing.product({
+        'mask_type': ['random', 'tie', 'empty'],
+        'score_tie': [False, True],
+        'score_thresh': [0.3, 1.0],
+        'batched_nms': [False, True],
+    }))
+class TestMaskVoting(unittest.TestCase):
+
+    def setUp(self):
+        self.H, self.W = 80, 100
+        n_roi = 50
+        self.n_class = 5
+        mask_size = 21
+        self.binary_thresh = 0.4
+
+        y_min = numpy.random.uniform(0, 50, size=n_roi)
+        x_min = numpy.random.uniform(0, 70, size=n_roi)
+        self.rois = numpy.stack((
+            y_min, x_min,
+            y_min + numpy.random.uniform(5, 30, size=n_roi),
+            x_min + numpy.random.uniform(5, 30, size=n_roi)),
+            axis=1).astype(numpy.float32)
+
+        if self.mask_type == 'random':
+            mask_probs = numpy.random.uniform(
+                size=(n_roi, mask_size, mask_size))
+        elif self.mask_type == 'tie':
+            mask_probs = numpy.random.choice(
+                [0, self.binary_thresh, 1],
+                size=(n_roi, mask_size, mask_size))
+        else:
+            mask_probs = numpy.random.uniform(
+                0, self.binary_thresh / 2,
+                size=(n_roi, mask_size, mask_size))
+        self.mask_probs = mask_probs.astype(numpy.float32)
+
+        cls_probs = numpy.random.uniform(size=(n_roi, self.n_class))
+        cls_probs /= cls_probs.sum(axis=1, keepdims=True)
+        if self.score_tie:
+            cls_probs = numpy.round(cls_probs * 10) / 10
+        self.cls_probs = cls_probs.astype(numpy.float32)
+
+    def test_mask_voting(self):
+        kwargs = {
+            'score_thresh': self.score_thresh,
+            'nms_thresh': 0.3,
+            'mask_merge_thresh': 0.5,
+            'binary_thresh': self.binary_thresh,
+        }
+        v_bboxes, v_masks, v_labels, v_cls_probs = mask_voting(
+            self.rois, self.mask_probs, self.cls_probs,
+            self.n_class, self.H, self.W,
+            batched_nms=self.batched_nms, **kwargs)
+        expected = _mask_voting_loop(
+            self.rois, self.mask_probs, self.cls_probs,
+            self.n_class, self.H, self.W, **kwargs)
+
+        if self.score_thresh == 1.0:
+            self.assertEqual(len(v_bboxes), 0)
+        numpy.testing.assert_equal(v_bboxes, expected[0])
+        numpy.testing.assert_equal(v_masks, expected[1])
+        numpy.testing.assert_equal(v_labels, expected[2])
+        numpy.testing.assert_equal(v_cls_probs, expected[3])
+
+
+testing.run_module(__name__, __file__)
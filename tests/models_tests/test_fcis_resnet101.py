@@ -0,0 +1,232 @@
+import copy
+import multiprocessing
+import unittest
+
+import numpy
+
+import chainer
+import chainer.links as L
+from chainer import testing
+from chainer.testing import attr
+
+from fcis.models import FCISResNet101
+
+
+def _create_model():
+    model = FCISResNet101(
+        n_class=3, n_test_pre_nms=100, n_test_post_nms=20)
+    # keep activations of the randomly initialized model small
+    for link in model.links():
+        if isinstance(link, L.BatchNormalization):
+            link.gamma.data[:] = 0.5
+    # proposals are anchors
+    model.rpn.loc.W.data[:] = 0
+    model.rpn.loc.b.data[:] = 0
+    return model
+
+
+def _check_predictions(outs, expected, rtol=1e-4, atol=1e-4):
+    # bboxes, masks, labels and scores of each image,
+    # where masks are lists of masks cropped by bboxes
+    bboxes, masks, labels, scores = outs
+    expected_bboxes, expected_masks, expected_labels, expected_scores = \
+        expected
+    assert len(bboxes) == len(expected_bboxes)
+    for i in range(len(bboxes)):
+        numpy.testing.assert_allclose(
+            bboxes[i], expected_bboxes[i], rtol=rtol, atol=atol)
+        numpy.testing.assert_equal(labels[i], expected_labels[i])
+        numpy.testing.assert_allclose(
+            scores[i], expected_scores[i], rtol=rtol, atol=atol)
+        assert len(masks[i]) == len(expected_masks[i])
+        for mask, expected_mask in zip(masks[i], expected_masks[i]):
+            numpy.testing.assert_equal(mask, expected_mask)
+
+
+@attr.slow
+class TestFCISResNet101Batch(unittest.TestCase):
+
+    def setUp(self):
+        self.model = _create_model()
+        # images of the same size are not padded
+        self.imgs = numpy.random.uniform(
+            0, 255, size=(2, 3, 64, 80)).astype(numpy.float32)
+
+    def test_call(self):
+        x = self.imgs - self.model.mean_bgr[:, None, None]
+        x = x.astype(numpy.float32)
+        with chainer.using_config('train', False), \
+                chainer.function.no_backprop_mode():
+            outs = self.model(x, [1.0, 1.0])
+            expected = [self.model(x[i:i + 1], 1.0) for i in range(2)]
+
+        roi_indices = outs[0]
+        for i in range(2):
+            keep = roi_indices == i
+            expected_indices = expected[i][0]
+            numpy.testing.assert_equal(
+                expected_indices, numpy.zeros_like(expected_indices))
+            self.assertEqual(keep.sum(), len(expected_indices))
+            for out, expected_out in zip(outs[1:], expected[i][1:]):
+                numpy.testing.assert_allclose(
+                    out[keep], expected_out, rtol=1e-4, atol=1e-4)
+
+    def test_call_second_iteration_top_k(self):
+        x = self.imgs - self.model.mean_bgr[:, None, None]
+        x = x.astype(numpy.float32)
+        k = 5
+        with chainer.using_config('train', False), \
+                chainer.function.no_backprop_mode():
+            outs = self.model(
+                x, [1.0, 1.0], second_iteration_top_k=k)
+            expected = self.model(x, [1.0, 1.0])
+
+        # the 1st iteration is not changed, and the 2nd iteration
+        # only runs on the top k rois by foreground probability
+        n_roi = len(expected[0]) // 2
+        roi_indices, cls_probs = expected[0][:n_roi], expected[3][:n_roi]
+        keep = []
+        for i in range(2):
+            index = numpy.where(roi_indices == i)[0]
+            fg_probs = 1 - cls_probs[index, 0]
+            order = numpy.argsort(-fg_probs)[:k]
+            keep.append(index[order])
+        keep = numpy.concatenate(keep)
+        self.assertEqual(len(outs[0]), n_roi + len(keep))
+        for out, expected_out in zip(outs, expected):
+            numpy.testing.assert_equal(out[:n_roi], expected_out[:n_roi])
+            numpy.testing.assert_allclose(
+                out[n_roi:], expected_out[n_roi:][keep],
+                rtol=1e-5, atol=1e-5)
+
+    def test_predict(self):
+        # the last image is resized to another size
+        imgs = list(self.imgs) + [numpy.random.uniform(
+            0, 255, size=(3, 48, 80)).astype(numpy.float32)]
+        kwargs = {
+            'target_height': 64, 'max_width': 120, 'score_thresh': 0.1}
+        outs = self.model.predict(imgs, batch_size=3, **kwargs)
+        expected = self.model.predict(imgs, batch_size=1, **kwargs)
+        self.assertEqual(len(outs[0]), 3)
+        _check_predictions(outs, expected)
+
+    def test_predict_pool(self):
+        kwargs = {
+            'target_height': 64, 'max_width': 120, 'score_thresh': 0.1}
+        pool = multiprocessing.Pool(2)
+        try:
+            outs = self.model.predict(self.imgs, pool=pool, **kwargs)
+        finally:
+            pool.close()
+            pool.join()
+        expected = self.model.predict(self.imgs, **kwargs)
+        _check_predictions(outs, expected, rtol=0, atol=0)
+
+
+@attr.slow
+class TestFCISResNet101FuseForInference(unittest.TestCase):
+
+    def setUp(self):
+        self.model = _create_model()
+        for link in self.model.links():
+            if isinstance(link, L.BatchNormalization):
+                shape = link.avg_mean.shape
+                link.avg_mean[:] = numpy.random.uniform(-1, 1, size=shape)
+                link.avg_var[:] = numpy.random.uniform(0.5, 2, size=shape)
+                link.beta.data[:] = numpy.random.uniform(
+                    -0.1, 0.1, size=shape)
+        self.fused_model = copy.deepcopy(self.model)
+        self.fused_model.fuse_for_inference()
+        x = numpy.random.uniform(0, 255, size=(1, 3, 64, 80))
+        x -= self.model.mean_bgr[:, None, None]
+        self.x = x.astype(numpy.float32)
+
+    def test_fuse_for_inference(self):
+        # all the BatchNormalizations are fused in place
+        for link in self.fused_model.links():
+            self.assertNotIsInstance(link, L.BatchNormalization)
+        self.assertIsNone(self.fused_model.res1.bn1)
+
+        with chainer.using_config('train', False), \
+                chainer.function.no_backprop_mode():
+            outs = self.fused_model(self.x, 1.0, second_iteration=False)
+            expected = self.model(self.x, 1.0, second_iteration=False)
+        for out, expected_out in zip(outs, expected):
+            numpy.testing.assert_allclose(
+                out, expected_out, rtol=1e-4, atol=1e-4)
+
+
+@attr.slow
+class TestFCISResNet101RestrictClasses(unittest.TestCase):
+
+    def setUp(self):
+        self.model = _create_model()
+        self.h = numpy.random.uniform(
+            -1, 1, size=(1, 1024, 8, 10)).astype(numpy.float32)
+        self.indices_and_rois = numpy.array([
+            [0, 0, 0, 64, 80],
+            [0, 16, 8, 120, 150],
+            [0, 40, 30, 60, 70]], dtype=numpy.float32)
+
+    def _pool_and_predict(self, model, gt_roi_labels):
+        with chainer.using_config('train', False), \
+                chainer.function.no_backprop_mode():
+            h_seg = model.psroi_conv2(self.h)
+            h_locs = model.psroi_conv3(self.h)
+            roi_seg_scores, _, roi_cls_scores = model._pool_and_predict(
+                self.indices_and_rois, h_seg, h_locs,
+                gt_roi_labels=gt_roi_labels)
+        return roi_seg_scores.data, roi_cls_scores.data
+
+    def check_restrict_classes(self, model, class_ids):
+        numpy.testing.assert_equal(model.class_ids, class_ids)
+        self.assertEqual(model.n_class, len(class_ids))
+        positions = numpy.array([1, len(class_ids) - 1, 0])
+        seg_scores, cls_scores = self._pool_and_predict(model, positions)
+        expected_seg_scores, expected_cls_scores = self._pool_and_predict(
+            self.model, class_ids[positions])
+        numpy.testing.assert_allclose(
+            cls_scores, expected_cls_scores[:, class_ids],
+            rtol=1e-5, atol=1e-5)
+        numpy.testing.assert_allclose(
+            seg_scores, expected_seg_scores, rtol=1e-5, atol=1e-5)
+
+    def test_restrict_classes(self):
+        model = copy.deepcopy(self.model)
+        model.restrict_classes([2])
+        self.check_restrict_classes(model, numpy.array([0, 2]))
+
+    def test_restrict_classes_twice(self):
+        # labels of the second call are the original ones
+        model = copy.deepcopy(self.model)
+        model.restrict_classes([1, 2])
+        model.restrict_classes([2])
+        self.check_restrict_classes(model, numpy.array([0, 2]))
+
+    def test_predict(self):
+        imgs = numpy.random.uniform(
+            0, 255, size=(2, 3, 64, 80)).astype(numpy.float32)
+        kwargs = {
+            'target_height': 64, 'max_width': 120, 'score_thresh': 0.1}
+        expected = self.model.predict(imgs, **kwargs)
+
+        # keeping all the classes does not change the outputs
+        model = copy.deepcopy(self.model)
+        model.restrict_classes([1, 2])
+        outs = model.predict(imgs, **kwargs)
+        _check_predictions(outs, expected, rtol=1e-5, atol=1e-5)
+
+        # labels are mapped back to the original ones
+        model.restrict_classes([2])
+        labels = model.predict(imgs, **kwargs)[2]
+        for label in labels:
+            numpy.testing.assert_equal(label, numpy.full_like(label, 2))
+
+    def test_restrict_classes_removed(self):
+        model = copy.deepcopy(self.model)
+        model.restrict_classes([2])
+        with self.assertRaises(ValueError):
+            model.restrict_classes([1])
+
+
+testing.run_module(__name__, __file__)
@@ -0,0 +1,92 @@
+import unittest
+
+import cv2
+import numpy
+
+from chainer import testing
+
+from fcis.mask import intersect_bbox_mask
+from fcis.proposal_target_creator import _create_mask_targets
+
+
+def _create_mask_targets_loop(
+        rois, gt_rois, gt_indices, whole_mask, mask_size, binary_thresh):
+    # previous implementation
+    gt_roi_masks = numpy.zeros(
+        (len(rois), mask_size, mask_size), dtype=numpy.int32)
+    for i, (roi, gt_roi, gt_index) in enumerate(
+            zip(rois, gt_rois, gt_indices)):
+        gt_mask = whole_mask[gt_index]
+        if isinstance(whole_mask, list):
+            offset = numpy.tile(gt_roi[:2], 2)
+            roi = roi - offset
+            gt_roi = gt_roi - offset
+        gt_roi_mask = intersect_bbox_mask(roi, gt_roi, gt_mask)
+        gt_roi_mask = cv2.resize(
+            gt_roi_mask, (mask_size, mask_size),
+            interpolation=cv2.INTER_NEAREST)
+        gt_roi_masks[i] = gt_roi_mask >= binary_thresh
+    return gt_roi_masks
+
+
+@testing.parameterize(*testing.product({
+    'cropped': [False, True],
+    'n_roi': [0, 1, 40],
+}))
+class TestCreateMaskTargets(unittest.TestCase):
+
+    def setUp(self):
+        H, W = 60, 80
+        n_bbox = 4
+        self.mask_size = 21
+        self.binary_thresh = 0.4
+
+        y_min = numpy.random.randint(0, 30, size=n_bbox)
+        x_min = numpy.random.randint(0, 40, size=n_bbox)
+        self.gt_bbox = numpy.stack((
+            y_min, x_min,
+            y_min + numpy.random.randint(10, 30, size=n_bbox),
+            x_min + numpy.random.randint(10, 40, size=n_bbox)),
+            axis=1).astype(numpy.int32)
+        # values equal to binary_thresh are foreground
+        whole_mask = numpy.random.choice(
+            [0, self.binary_thresh, 1], size=(n_bbox, H, W))
+        whole_mask = whole_mask.astype(numpy.float32)
+        # an instance without foreground pixels
+        whole_mask[0] = 0
+        if self.cropped:
+            self.whole_mask = [
+                mask[y0:y1, x0:x1]
+                for mask, (y0, x0, y1, x1) in zip(whole_mask, self.gt_bbox)]
+        else:
+            self.whole_mask = whole_mask
+
+        self.gt_indices = numpy.random.randint(
+            0, n_bbox, size=self.n_roi).astype(numpy.int32)
+        gt_rois = self.gt_bbox[self.gt_indices]
+        # RoIs around their gt boxes, partially outside of them
+        # and of the image
+        y_min = gt_rois[:, 0] + numpy.random.randint(-10, 10, self.n_roi)
+        x_min = gt_rois[:, 1] + numpy.random.randint(-10, 10, self.n_roi)
+        self.rois = numpy.stack((
+            y_min, x_min,
+            y_min + numpy.random.randint(1, 40, size=self.n_roi),
+            x_min + numpy.random.randint(1, 50, size=self.n_roi)),
+            axis=1).astype(numpy.int32)
+        self.gt_rois = gt_rois
+
+    def test_create_mask_targets(self):
+        gt_roi_masks = _create_mask_targets(
+            self.rois, self.gt_rois, self.gt_indices, self.whole_mask,
+            self.mask_size, self.binary_thresh)
+        expected = _create_mask_targets_loop(
+            self.rois, self.gt_rois, self.gt_indices, self.whole_mask,
+            self.mask_size, self.binary_thresh)
+
+        self.assertEqual(gt_roi_masks.dtype, numpy.int32)
+        self.assertEqual(
+            gt_roi_masks.shape, (self.n_roi, self.mask_size, self.mask_size))
+        numpy.testing.assert_equal(gt_roi_masks, expected)
+
+
+testing.run_module(__name__, __file__)